@@ -0,0 +1,44 @@
+import torch
+from torch.nn import functional as F
+
+
+# batched versions of the torchvision per-sample transforms used in data_builder.py.
+# inputs are BCHW uint8 batches straight out of the DataLoader, all ops run once per batch.
+
+
+def to_float(x):
+    """ ToTensor for a uint8 batch """
+    return x.float().div_(255)
+
+
+def normalize(x, mean=0.5, std=0.5):
+    """ Normalize((mean, ...), (std, ...)), in place """
+    return x.sub_(mean).div_(std)
+
+
+def resize(x, size, mode='bicubic'):
+    """ resize a float [0, 1] batch to size x size, a no-op when it already has that size """
+    if x.shape[-2] == size and x.shape[-1] == size:
+        return x
+    if mode == 'nearest':
+        return F.interpolate(x, size=(size, size), mode='nearest')
+    return F.interpolate(x, size=(size, size), mode=mode, align_corners=False).clamp_(0, 1)
+
+
+def random_crop(xs, size, max_offset=None):
+    """ size x size crop at a random offset per sample, the same offsets for every batch in xs """
+    b, h, w = xs[0].shape[0], xs[0].shape[-2], xs[0].shape[-1]
+    device = xs[0].device
+    max_h = h - size if max_offset is None else min(max_offset, h - size)
+    max_w = w - size if max_offset is None else min(max_offset, w - size)
+    rows = torch.randint(0, max_h + 1, (b, 1), device=device) + torch.arange(size, device=device)
+    cols = torch.randint(0, max_w + 1, (b, 1), device=device) + torch.arange(size, device=device)
+    batch = torch.arange(b, device=device).view(-1, 1, 1)
+    # advanced indexing on dims 0, 2, 3 gives B x size x size x C
+    return [x[batch, :, rows.view(b, size, 1), cols.view(b, 1, size)].permute(0, 3, 1, 2) for x in xs]
+
+
+def random_flip(xs, p=0.5):
+    """ horizontal flip with the same per-sample decision for every batch in xs """
+    flip = (torch.rand(xs[0].shape[0], device=xs[0].device) < p).view(-1, 1, 1, 1)
+    return [torch.where(flip, x.flip(3), x) for x in xs]
@@ -25,9 +25,9 @@ def load_CIFAR_batch(filename):
 
         # reshape, 一维数组转为矩阵10000行3列。每个entries是32x32
         # transpose，转置
-        # astype，复制，同时指定类型
-        X = X.reshape(10000, 3, 32, 32).transpose(0, 2, 3, 1).astype("float")
-        Y = np.array(Y)
+        # 保持uint8, HWC
+        X = X.reshape(10000, 3, 32, 32).transpose(0, 2, 3, 1)
+        Y = np.array(Y, dtype=np.int64)
         return X, Y
 
 
@@ -50,3 +50,26 @@ def load_CIFAR10(ROOT):
     # 测试集
     Xte, Yte = load_CIFAR_batch(os.path.join(ROOT, 'test_batch'))
     return Xtr, Ytr, Xte, Yte
+
+
+def load_CIFAR10_split(ROOT, train=True):
+    """ load only one split of cifar, cached as .npy and memory-mapped on later starts """
+    split = "train" if train else "test"
+    x_cache = os.path.join(ROOT, "cifar10_{}_x.npy".format(split))
+    y_cache = os.path.join(ROOT, "cifar10_{}_y.npy".format(split))
+    if os.path.exists(x_cache) and os.path.exists(y_cache):
+        return np.load(x_cache, mmap_mode='r'), np.load(y_cache)
+
+    if train:
+        batches = [load_CIFAR_batch(os.path.join(ROOT, 'data_batch_%d' % (b,))) for b in range(1, 6)]
+    else:
+        batches = [load_CIFAR_batch(os.path.join(ROOT, 'test_batch'))]
+    X = np.ascontiguousarray(np.concatenate([b[0] for b in batches]))
+    Y = np.concatenate([b[1] for b in batches])
+    try:
+        np.save(x_cache, X)
+        np.save(y_cache, Y)
+    except OSError:
+        # 只读目录, 不缓存
+        return X, Y
+    return np.load(x_cache, mmap_mode='r'), Y
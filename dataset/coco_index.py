@@ -0,0 +1,296 @@
+import os
+import math
+import shutil
+import numpy as np
+from tqdm import tqdm
+
+# compact replacement for pycocotools.coco.COCO at runtime. one directory of .npy columns per annotation file,
+# memory-mapped on open:
+#   image_ids [Ni] (sorted), image_hw [Ni, 2], file_names [Ni], ann_start [Ni + 1]
+#   ann_ids [Na], category [Na], bbox [Na, 4] (floored x, y, w, h), area [Na], iscrowd [Na]
+#   mask_box [Na, 4] (x, y, w, h), rle_start [Na + 1], rle_counts: the mask of every annotation cropped to its
+#   mask_box, row-major runs starting with a run of zeros. mask_box is the floored bbox grown to every pixel the
+#   rasterized mask covers, the float bboxes are tight and the floored ones miss the last column or row of many masks
+COLUMNS = ['image_ids', 'image_hw', 'file_names', 'ann_start', 'ann_ids', 'category', 'bbox', 'area', 'iscrowd',
+           'mask_box', 'rle_start', 'rle_counts']
+
+
+def index_dir(annotation_file):
+    return os.path.splitext(annotation_file)[0] + "_index"
+
+
+def floor_bbox(bbox):
+    return [math.floor(x) for x in bbox]
+
+
+def crop_mask(mask, x0, y0, w, h):
+    """ mask[y0:y0 + h, x0:x0 + w] padded with zeros outside the image, like PIL's crop """
+    H, W = mask.shape
+    out = np.zeros([max(h, 0), max(w, 0)], dtype=np.uint8)
+    sx0, sy0, sx1, sy1 = max(x0, 0), max(y0, 0), min(x0 + w, W), min(y0 + h, H)
+    if sx1 > sx0 and sy1 > sy0:
+        out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = mask[sy0:sy1, sx0:sx1]
+    return out
+
+
+def rle_encode(mask):
+    flat = np.ascontiguousarray(mask, dtype=np.uint8).reshape(-1)
+    if flat.size == 0:
+        return np.zeros([0], dtype=np.uint32)
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate([[0], change, [flat.size]]))
+    if flat[0] != 0:
+        runs = np.concatenate([[0], runs])
+    return runs.astype(np.uint32)
+
+
+def rle_decode(counts, h, w):
+    values = (np.arange(len(counts)) % 2).astype(np.uint8)
+    return np.repeat(values, counts.astype(np.int64)).reshape(h, w)
+
+
+def rle_from_string(counts):
+    """ run lengths of a compressed coco RLE string (pycocotools' rleFrString) """
+    if isinstance(counts, bytes):
+        counts = counts.decode('ascii')
+    runs = []
+    p = 0
+    while p < len(counts):
+        x, k, more = 0, 0, True
+        while more:
+            c = ord(counts[p]) - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = bool(c & 0x20)
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << (5 * k)
+        if len(runs) > 2:
+            x += runs[-2]
+        runs.append(x)
+    return np.array(runs, dtype=np.int64)
+
+
+def ann_rle(coco, ann):
+    """ run lengths of the annotation rasterized at image size as annToMask does, column-major, and the image size """
+    rle = coco.annToRLE(ann)
+    counts = rle['counts']
+    counts = rle_from_string(counts) if isinstance(counts, (str, bytes)) else np.asarray(counts, dtype=np.int64)
+    H, W = rle['size']
+    return counts, H, W
+
+
+def rle_extent(counts, H):
+    """ (x0, y0, x1, y1) bounding the foreground of column-major run lengths counts, None for an empty mask """
+    ends = np.cumsum(counts)
+    starts = (ends - counts)[1::2]
+    ends = ends[1::2]
+    nonempty = ends > starts
+    if not nonempty.any():
+        return None
+    starts, last = starts[nonempty], ends[nonempty] - 1
+    x0, x1 = int(starts[0] // H), int(last[-1] // H) + 1
+    # a run reaching into the next column covers whole columns of rows
+    if (starts // H != last // H).any():
+        return x0, 0, x1, H
+    return x0, int((starts % H).min()), x1, int((last % H).max()) + 1
+
+
+def expand_window(counts, H, W, x0, y0, w, h):
+    """ the window [x0, x0 + w) x [y0, y0 + h) of the mask in column-major run lengths, zeros outside the image.
+    only the runs of the window's columns are expanded """
+    out = np.zeros([max(h, 0), max(w, 0)], dtype=np.uint8)
+    sx0, sy0, sx1, sy1 = max(x0, 0), max(y0, 0), min(x0 + w, W), min(y0 + h, H)
+    if sx1 <= sx0 or sy1 <= sy0:
+        return out
+    # coco RLE is column-major, the window's columns are one contiguous range of it
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    lo, hi = sx0 * H, sx1 * H
+    lengths = np.clip(ends, lo, hi) - np.clip(starts, lo, hi)
+    columns = np.repeat((np.arange(len(counts)) % 2).astype(np.uint8), lengths).reshape(sx1 - sx0, H)
+    out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = columns[:, sy0:sy1].T
+    return out
+
+
+def window_mask(coco, ann, x0, y0, w, h):
+    """ the mask of ann inside the window [x0, x0 + w) x [y0, y0 + h), same as crop_mask(coco.annToMask(ann), ...).
+    the annotation is rasterized at image size as RLE, as annToMask does, and only the runs of the window's columns
+    are expanded. shifting the polygons into the window instead is off by a pixel now and then: pycocotools rounds
+    5 * x + .5, and coordinates like 12.3 sit on that rounding edge """
+    if w <= 0 or h <= 0:
+        return np.zeros([max(h, 0), max(w, 0)], dtype=np.uint8)
+    counts, H, W = ann_rle(coco, ann)
+    return expand_window(counts, H, W, x0, y0, w, h)
+
+
+def mask_box(bbox, extent):
+    """ the floored bbox (x, y, w, h) grown to the mask extent (x0, y0, x1, y1) """
+    x0, y0, w, h = bbox
+    if extent is None:
+        return [x0, y0, w, h]
+    x1, y1 = max(x0 + w, extent[2]), max(y0 + h, extent[3])
+    x0, y0 = min(x0, extent[0]), min(y0, extent[1])
+    return [x0, y0, x1 - x0, y1 - y0]
+
+
+def build_coco_index(annotation_file, output_dir=None):
+    """ one-time conversion of instances_*.json, needs pycocotools """
+    from pycocotools.coco import COCO
+    if output_dir is None:
+        output_dir = index_dir(annotation_file)
+    coco = COCO(annotation_file)
+    image_ids = np.array(sorted(coco.getImgIds()), dtype=np.int64)
+    columns = {k: [] for k in ['ann_ids', 'category', 'bbox', 'area', 'iscrowd', 'mask_box', 'rle']}
+    image_hw, file_names, ann_start = [], [], [0]
+    print("indexing {}".format(annotation_file))
+    for img_id in tqdm(image_ids):
+        img = coco.loadImgs(int(img_id))[0]
+        image_hw.append([img['height'], img['width']])
+        file_names.append(img['file_name'])
+        anns = coco.loadAnns(coco.getAnnIds(imgIds=int(img_id), iscrowd=None))
+        for ann in anns:
+            bbox = floor_bbox(ann['bbox'])
+            counts, H, W = ann_rle(coco, ann)
+            box = mask_box(bbox, rle_extent(counts, H))
+            columns['ann_ids'].append(ann['id'])
+            columns['category'].append(ann['category_id'])
+            columns['bbox'].append(bbox)
+            columns['area'].append(ann['area'])
+            columns['iscrowd'].append(ann['iscrowd'])
+            columns['mask_box'].append(box)
+            columns['rle'].append(rle_encode(expand_window(counts, H, W, *box)))
+        ann_start.append(ann_start[-1] + len(anns))
+
+    rle_start = np.zeros([len(columns['rle']) + 1], dtype=np.int64)
+    rle_start[1:] = np.cumsum([len(r) for r in columns['rle']])
+    data = {
+        'image_ids': image_ids,
+        'image_hw': np.array(image_hw, dtype=np.int32).reshape(-1, 2),
+        'file_names': np.array(file_names, dtype=np.str_),
+        'ann_start': np.array(ann_start, dtype=np.int64),
+        'ann_ids': np.array(columns['ann_ids'], dtype=np.int64),
+        'category': np.array(columns['category'], dtype=np.int32),
+        'bbox': np.array(columns['bbox'], dtype=np.int32).reshape(-1, 4),
+        'area': np.array(columns['area'], dtype=np.float32),
+        'iscrowd': np.array(columns['iscrowd'], dtype=np.uint8),
+        'mask_box': np.array(columns['mask_box'], dtype=np.int32).reshape(-1, 4),
+        'rle_start': rle_start,
+        'rle_counts': np.concatenate(columns['rle'] + [np.zeros([0], dtype=np.uint32)]),
+    }
+    # write into a temporary directory first, a half written index is never picked up
+    tmp_dir = output_dir + ".tmp"
+    if not os.path.exists(tmp_dir):
+        os.mkdir(tmp_dir)
+    for name in COLUMNS:
+        np.save(os.path.join(tmp_dir, name + ".npy"), data[name])
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.replace(tmp_dir, output_dir)
+    return output_dir
+
+
+class CocoIndex(object):
+    """ lookup API over the columns written by build_coco_index; annotations come back as small dicts with the
+    keys the pycocotools based code reads, plus 'index' to fetch the cropped mask with ann_mask """
+
+    def __init__(self, path):
+        self.path = path
+        for name in COLUMNS:
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def img_index(self, img_id):
+        i = int(np.searchsorted(self.image_ids, img_id))
+        if i >= len(self.image_ids) or self.image_ids[i] != img_id:
+            raise KeyError("image {} is not in {}".format(img_id, self.path))
+        return i
+
+    def load_img(self, img_id):
+        i = self.img_index(img_id)
+        return {'id': int(img_id), 'file_name': str(self.file_names[i]), 'height': int(self.image_hw[i, 0]),
+                'width': int(self.image_hw[i, 1])}
+
+    def ann_range(self, img_id):
+        i = self.img_index(img_id)
+        return int(self.ann_start[i]), int(self.ann_start[i + 1])
+
+    def select_anns(self, img_id, cat_ids=None, iscrowd=None, min_size=None, border=None):
+        """ indices of the annotations of img_id that pass the filters, checked at once over all of them:
+        min_size: floored bbox width and height at least this, border: x0, y0 >= border and x0 + w, y0 + h
+        < image size - border """
+        i = self.img_index(img_id)
+        start, end = int(self.ann_start[i]), int(self.ann_start[i + 1])
+        keep = np.ones([end - start], dtype=bool)
+        if cat_ids is not None and len(cat_ids) > 0:
+            keep &= np.isin(self.category[start:end], cat_ids)
+        if iscrowd is not None:
+            keep &= self.iscrowd[start:end].astype(bool) == bool(iscrowd)
+        x0, y0, w, h = np.asarray(self.bbox[start:end]).T
+        if min_size is not None:
+            keep &= (w >= min_size) & (h >= min_size)
+        if border is not None:
+            H, W = self.image_hw[i]
+            keep &= (x0 >= border) & (y0 >= border) & (x0 + w < W - border) & (y0 + h < H - border)
+        return start + np.nonzero(keep)[0]
+
+    def ann(self, k):
+        return {'id': int(self.ann_ids[k]), 'category_id': int(self.category[k]),
+                'bbox': [int(x) for x in self.bbox[k]], 'area': float(self.area[k]),
+                'iscrowd': int(self.iscrowd[k]), 'index': int(k)}
+
+    def load_anns(self, img_id, cat_ids=None, iscrowd=None, min_size=None, border=None):
+        """ same selection as COCO.loadAnns(COCO.getAnnIds(imgIds=img_id, catIds=cat_ids, iscrowd=iscrowd)),
+        optionally restricted by select_anns' bbox filters """
+        return [self.ann(k) for k in self.select_anns(img_id, cat_ids, iscrowd, min_size, border)]
+
+    def ann_mask(self, ann):
+        """ uint8 0/1 mask of the annotation cropped to its floored bbox, shape [bbox h, bbox w] """
+        k = ann['index'] if isinstance(ann, dict) else ann
+        x0, y0, w, h = [int(x) for x in self.bbox[k]]
+        mx, my, mw, mh = [int(x) for x in self.mask_box[k]]
+        mask = rle_decode(self.rle_counts[self.rle_start[k]:self.rle_start[k + 1]], mh, mw)
+        return np.ascontiguousarray(mask[y0 - my:y0 - my + h, x0 - mx:x0 - mx + w])
+
+    def instance_map(self, img_id, cat_ids=None, iscrowd=False):
+        """ uint16 [H, W] map of the selected annotations: 0 background, k + 1 for the k-th of them, later ones
+        drawn over earlier ones. the foreground runs of all masks are scattered into the map in one call """
+        i = self.img_index(img_id)
+        H, W = [int(x) for x in self.image_hw[i]]
+        ks = self.select_anns(img_id, cat_ids, iscrowd)
+        if len(ks) >= 65535:
+            print("image {} has {} instances, more than a uint16 map holds".format(img_id, len(ks)))
+            assert 0
+        starts, lengths, owners = [], [], []
+        for n, k in enumerate(ks):
+            counts = self.rle_counts[self.rle_start[k]:self.rle_start[k + 1]].astype(np.int64)
+            ends = np.cumsum(counts)
+            # odd runs are the foreground ones
+            starts.append((ends - counts)[1::2])
+            lengths.append(counts[1::2])
+            owners.append(np.full([len(counts) // 2], n, dtype=np.int64))
+        out = np.zeros([H, W], dtype=np.uint16)
+        if len(ks) == 0:
+            return out
+        starts, lengths, owners = np.concatenate(starts), np.concatenate(lengths), np.concatenate(owners)
+        # every foreground pixel: its position inside the mask window, then in the image
+        run = np.repeat(np.arange(len(lengths)), lengths)
+        pos = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(len(run))
+        x0, y0, w, h = np.asarray(self.mask_box[ks], dtype=np.int64).T
+        owner = owners[run]
+        ys = y0[owner] + pos // w[owner]
+        xs = x0[owner] + pos % w[owner]
+        inside = (xs >= 0) & (xs < W) & (ys >= 0) & (ys < H)
+        # maximum keeps the last annotation where masks overlap, whatever the order of the writes
+        np.maximum.at(out.reshape(-1), ys[inside] * W + xs[inside], (owner[inside] + 1).astype(np.uint16))
+        return out
+
+
+def open_coco_index(annotation_file):
+    """ the index next to annotation_file, built on first use and rebuilt when it lacks a column (older format) """
+    path = index_dir(annotation_file)
+    if not all(os.path.exists(os.path.join(path, name + ".npy")) for name in COLUMNS):
+        build_coco_index(annotation_file, path)
+    return CocoIndex(path)
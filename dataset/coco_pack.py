@@ -0,0 +1,123 @@
+import os
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+# one record per object and size: 3 image channels, 1 label channel, 1 mask channel, all uint8 CHW
+RECORD_CHANNELS = 5
+
+
+def pack_dir(path, train=True):
+    return os.path.join(path, "{}_pack".format("train" if train else "val"))
+
+
+def record_bytes(size):
+    return RECORD_CHANNELS * size * size
+
+
+def read_data_list(data_list_path):
+    """ parse data_list.txt into (file names, object ids, coco class numbers) """
+    names, obj_ids, class_nums = [], [], []
+    with open(data_list_path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if len(line) == 0:
+                continue
+            filename, class_num, class_name = line.split(' ', 2)
+            id, obj_id = filename.split('.')[0].split('_')
+            names.append(filename)
+            obj_ids.append(int(obj_id))
+            class_nums.append(int(class_num))
+    return names, np.array(obj_ids, dtype=np.int64), np.array(class_nums, dtype=np.int32)
+
+
+def _load_crops(image_path, label_path, mask_path):
+    """ the decoded image, label and mask of one object, resized to every packed size by _resize_record """
+    image = Image.open(image_path)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')  # grayscale crops are expanded to 3 channels here once
+    label = Image.open(label_path)
+    mask = Image.open(mask_path)
+    image.load()
+    label.load()
+    mask.load()
+    return image, label, mask
+
+
+def _resize_record(crops, size):
+    image, label, mask = crops
+    record = np.empty([RECORD_CHANNELS, size, size], dtype=np.uint8)
+    record[0:3] = np.asarray(image.resize((size, size), Image.BICUBIC)).transpose(2, 0, 1)
+    record[3] = np.asarray(label.resize((size, size), Image.BICUBIC))
+    record[4] = np.asarray(mask.resize((size, size), Image.NEAREST))
+    return record
+
+
+def write_pack(path, sizes, train=True):
+    """ pack {split}_cut, {split}_label_cut and {split}_mask_cut into {split}_pack/data.bin + index.npz """
+    split = "train" if train else "val"
+    image_dir = os.path.join(path, "{}_cut".format(split))
+    label_dir = os.path.join(path, "{}_label_cut".format(split))
+    mask_dir = os.path.join(path, "{}_mask_cut".format(split))
+    output_dir = pack_dir(path, train)
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+
+    names, obj_ids, class_nums = read_data_list(os.path.join(image_dir, "data_list.txt"))
+    sizes = sorted(set(int(s) for s in sizes))
+    n = len(names)
+
+    # size-major layout: all objects at sizes[0], then all objects at sizes[1], ...
+    offsets = np.zeros([len(sizes), n], dtype=np.int64)
+    base = 0
+    for k, size in enumerate(sizes):
+        offsets[k] = base + np.arange(n, dtype=np.int64) * record_bytes(size)
+        base += n * record_bytes(size)
+
+    data_file = os.path.join(output_dir, "data.bin")
+    data = np.memmap(data_file + ".tmp", dtype=np.uint8, mode='w+', shape=(max(base, 1),))
+    print("packing {} objects at sizes {} into {}".format(n, sizes, data_file))
+    for i in tqdm(range(n)):
+        # decoded once, every size is resized from the same copy
+        crops = _load_crops(os.path.join(image_dir, names[i]), os.path.join(label_dir, names[i]),
+                            os.path.join(mask_dir, names[i]))
+        for k, size in enumerate(sizes):
+            record = _resize_record(crops, size)
+            data[offsets[k, i]:offsets[k, i] + record_bytes(size)] = record.reshape(-1)
+    data.flush()
+    del data
+    os.replace(data_file + ".tmp", data_file)
+    np.savez(os.path.join(output_dir, "index.npz"), names=np.array(names), obj_ids=obj_ids, class_nums=class_nums,
+             sizes=np.array(sizes, dtype=np.int64), offsets=offsets)
+
+
+class PackReader(object):
+    """ read-only view of a pack; the memmap is opened lazily so every DataLoader worker maps it itself """
+
+    def __init__(self, path, train=True):
+        self.dir = pack_dir(path, train)
+        index = np.load(os.path.join(self.dir, "index.npz"))
+        self.names = index['names']
+        self.obj_ids = index['obj_ids']
+        self.class_nums = index['class_nums']
+        self.sizes = [int(s) for s in index['sizes']]
+        self.offsets = index['offsets']
+        self.data = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def record(self, i, size):
+        if size not in self.sizes:
+            print("size {} is not packed in {}, available: {}".format(size, self.dir, self.sizes))
+            assert 0
+        if self.data is None:
+            # copy-on-write mapping: slices are writable views, nothing is read until touched
+            self.data = np.memmap(os.path.join(self.dir, "data.bin"), dtype=np.uint8, mode='c')
+        offset = self.offsets[self.sizes.index(size), i]
+        return self.data[offset:offset + record_bytes(size)].reshape(RECORD_CHANNELS, size, size)
@@ -1,5 +1,5 @@
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset
 from torchvision import datasets as tv_datasets
 from torch.nn import functional as F
 from torch import nn
@@ -9,32 +9,45 @@ from torchvision import transforms
 import os
 import numpy as np
 import dataset.cifar10 as cifar10
+from dataset.coco_pack import PackReader, read_data_list
+from dataset.obj_index import read_obj_index, select_objects
+from dataset.sampler import build_sampler, balances_classes
+from dataset.shards import ShardStream, obj_shard_dir, synthesis_shard_dir
+from dataset.decode import open_image, resolve_backend
+from dataset.loader import BatchTransformLoader, DevicePrefetcher
+from dataset.synthesis_engine import SynthesisEngine
+from dataset.synthesis_manifest import SynthesisManifest
+import dataset.batch_transforms as bt
 import random
 import matplotlib.pyplot as plt
-from pycocotools.coco import COCO
+from dataset.coco_index import open_coco_index
 import math
 from tqdm import tqdm
 from torchvision.utils import save_image
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# uint8 CHW tensor without the float conversion of ToTensor, used by the batch_transform mode
+to_uint8 = transforms.PILToTensor()
+
 
 class cifar10_dataset(Dataset):
     def __init__(self, path, train=True, **kwargs):
         super(cifar10_dataset, self).__init__()
-        data_all = cifar10.load_CIFAR10(path)
-        if train:
-            self.set = [data_all[0], data_all[1]]
-        else:
-            self.set = [data_all[2], data_all[3]]
+        x, y = cifar10.load_CIFAR10_split(path, train)
         labels = kwargs.get('labels')
         data_sum = kwargs.get('data_sum')
+        index = np.arange(len(y))
         if labels is not None:
-            self.set[0] = [self.set[0][i] for i in range(len(self.set[0])) if self.set[1][i] in labels]
-            self.set[1] = [self.set[1][i] for i in range(len(self.set[1])) if self.set[1][i] in labels]
+            index = index[np.isin(y, labels)]
         if data_sum is not None:
-            self.set[0] = self.set[0][0:data_sum]
-            self.set[1] = self.set[1][0:data_sum]
+            index = index[0:data_sum]
+        if len(index) == len(y):
+            self.set = [x, y]
+        else:
+            # gather once; the memmap itself is left untouched
+            self.set = [x[index], y[index]]
+        self.uint8 = kwargs.get('batch_transform', False)
         self.transform = transforms.Compose(
             [transforms.Resize(32),
              transforms.ToTensor(),
@@ -45,11 +58,17 @@ class cifar10_dataset(Dataset):
         return len(self.set[0])
 
     def __getitem__(self, id):
-        return [self.transform(Image.fromarray(self.set[0][id].astype(np.uint8))), self.set[1][id]]
+        if self.uint8:
+            return [torch.from_numpy(np.array(self.set[0][id])).permute(2, 0, 1), self.set[1][id]]
+        return [self.transform(Image.fromarray(np.asarray(self.set[0][id]))), self.set[1][id]]
+
+    def batch_transform(self, batch):
+        x, y = batch
+        return [bt.normalize(bt.resize(bt.to_float(x), 32)), y]
 
 
 class facades_dataset(Dataset):
-    def __init__(self, path, train=True):
+    def __init__(self, path, train=True, **kwargs):
         super(facades_dataset, self).__init__()
         if train:
             path = os.path.join(path, "train")
@@ -58,6 +77,14 @@ class facades_dataset(Dataset):
         self.a_path = os.path.join(path, "a")
         self.b_path = os.path.join(path, "b")
         self.image_filenames = [x for x in os.listdir(self.a_path)]
+        self.uint8 = kwargs.get('batch_transform', False)
+        self.decode_backend = resolve_backend(kwargs.get('decode_backend', 'pil'))
+        # 'ram' or 'mmap': keep the 286x286 uint8 pairs, crop and flip whole batches in batch_transform
+        self.cache = kwargs.get('cache', None)
+        self.data = None
+        if self.cache is not None:
+            self.uint8 = True
+            self.data = self.build_cache(path)
 
         self.transform = transforms.Compose(
             [  # transforms.Resize(32),
@@ -68,11 +95,53 @@ class facades_dataset(Dataset):
     def __len__(self):
         return len(self.image_filenames)
 
-    def __getitem__(self, id):
-        a = Image.open(os.path.join(self.a_path, self.image_filenames[id])).convert('RGB')
-        b = Image.open(os.path.join(self.b_path, self.image_filenames[id])).convert('RGB')
+    def load_pair(self, id):
+        a = open_image(os.path.join(self.a_path, self.image_filenames[id]), self.decode_backend).convert('RGB')
+        b = open_image(os.path.join(self.b_path, self.image_filenames[id]), self.decode_backend).convert('RGB')
         a = a.resize((286, 286), Image.BICUBIC)
         b = b.resize((286, 286), Image.BICUBIC)
+        return a, b
+
+    def build_cache(self, path):
+        if self.cache == 'mmap':
+            cache_path = path.rstrip('/') + "_286.npy"
+            names_path = path.rstrip('/') + "_286.txt"
+            if os.path.exists(cache_path) and os.path.exists(names_path):
+                with open(names_path) as f:
+                    names = f.read().split('\n')
+                if names == self.image_filenames:
+                    return np.load(cache_path, mmap_mode='r')
+            data = np.lib.format.open_memmap(cache_path + ".tmp.npy", mode='w+', dtype=np.uint8,
+                                             shape=(len(self.image_filenames), 2, 286, 286, 3))
+        elif self.cache == 'ram':
+            data = np.empty([len(self.image_filenames), 2, 286, 286, 3], dtype=np.uint8)
+        else:
+            print("unknown facades cache: {}".format(self.cache))
+            assert 0
+        print("caching facades")
+        for id in tqdm(range(len(self.image_filenames))):
+            a, b = self.load_pair(id)
+            data[id, 0] = np.asarray(a)
+            data[id, 1] = np.asarray(b)
+        if self.cache == 'mmap':
+            data.flush()
+            del data
+            os.replace(cache_path + ".tmp.npy", cache_path)
+            with open(names_path, "w") as f:
+                f.write('\n'.join(self.image_filenames))
+            return np.load(cache_path, mmap_mode='r')
+        return data
+
+    def __getitem__(self, id):
+        if self.uint8:
+            # uncropped 286x286 pair, batch_transform crops and flips
+            if self.data is not None:
+                pair = torch.from_numpy(np.array(self.data[id])).permute(0, 3, 1, 2)
+                return pair[0], pair[1]
+            a, b = self.load_pair(id)
+            return to_uint8(a), to_uint8(b)
+
+        a, b = self.load_pair(id)
         a = transforms.ToTensor()(a)
         b = transforms.ToTensor()(b)
         w_offset = random.randint(0, max(0, 286 - 256 - 1))
@@ -91,6 +160,53 @@ class facades_dataset(Dataset):
             b = b.index_select(2, idx)
         return a, b
 
+    def batch_transform(self, batch):
+        # same crop offsets and flips for a and b, offsets in [0, 286 - 256 - 1] like the per-sample path
+        a, b = bt.random_crop(list(batch), 256, max_offset=max(0, 286 - 256 - 1))
+        return bt.random_flip([bt.normalize(bt.to_float(a)), bt.normalize(bt.to_float(b))])
+
+
+def select_classes(class_nums, classes, cap=10000):
+    """ keep the objects of `classes` in file order, at most cap + 1 per class when several classes are trained
+    together (cap None keeps all of them); returns their indices and class numbers starting from 0 """
+    class_nums = np.asarray(class_nums)
+    keep = np.isin(class_nums, classes)
+    if len(classes) > 1 and cap is not None:
+        for c in classes:
+            where = np.nonzero(class_nums == c)[0]
+            keep[where[cap + 1:]] = False
+    selected = np.nonzero(keep)[0]
+    classes_inv = np.zeros(max(max(classes), int(class_nums.max(initial=0))) + 1, dtype=np.int64)
+    classes_inv[np.asarray(classes)] = np.arange(len(classes))
+    return selected, classes_inv[class_nums[selected]]
+
+
+def obj_item(a, b, mask, label, image_size, uint8=False):
+    """ one coco_obj sample from the opened object, label and mask crops """
+    size = (image_size, image_size)
+    if uint8:
+        a = to_uint8(a.resize(size, Image.BICUBIC))
+        b = to_uint8(b.resize(size, Image.BICUBIC))
+        mask = to_uint8(mask.resize(size, Image.NEAREST))
+        if a.shape[0] == 1:
+            a = a.expand([3, -1, -1])  # a view, so the copy only happens once in collate
+        return a, b, mask, torch.tensor(label)
+    transform = transforms.Compose([transforms.Resize(size, Image.BICUBIC), transforms.ToTensor()])
+    a = transform(a)
+    b = transform(b)
+    mask = transforms.ToTensor()(transforms.Resize(size, Image.NEAREST)(mask))
+    t1 = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+    t2 = transforms.Normalize((0.5), (0.5))
+    if a.shape[0] == 1:
+        a = a.expand([3, -1, -1])
+    a, b = t1(a), t2(b)
+    return a, b, mask, torch.tensor(label)
+
+
+def obj_batch_transform(batch):
+    a, b, mask, labels = batch
+    return bt.normalize(bt.to_float(a)), bt.normalize(bt.to_float(b)), bt.to_float(mask), labels
+
 
 class coco_obj_dataset(Dataset):
     def __init__(self, path, train=True, **kwargs):
@@ -103,59 +219,142 @@ class coco_obj_dataset(Dataset):
             self.path = os.path.join(path, "val_cut")
             self.label_path = os.path.join(path, "val_label_cut")
             self.mask_path = os.path.join(path, "val_mask_cut")
-        data_list_path = os.path.join(self.path, "data_list.txt")
-        f = open(data_list_path)
         classes = kwargs.get('classes', None)
         if classes is None:
             assert 0
-        classes_inv = {}
-        for i in range(0, len(classes)):
-            classes_inv[classes[i]] = i
-        lines = f.readlines()
+        self.image_size = kwargs.get('image_size', 128)
+        self.uint8 = kwargs.get('batch_transform', False)
+        self.decode_backend = resolve_backend(kwargs.get('decode_backend', 'pil'))
 
         # annotation_dir = os.path.join(path, "annotations", "instances_{}2017.json".format("train" if train else 'val'))
         # self.coco = COCO(annotation_dir)
-        count = []
-        Max = 0
-        for x in classes:
-            Max = x if Max < x else Max
-        for i in range(0, Max + 1):
-            count.append(0)
-
-        self.file_name_label_list = []
+        # a class sampler balances the classes per epoch, the 10000 per class cap is only needed without one
+        cap = None if balances_classes(kwargs.get('sampler', None)) else 10000
+        objects = read_obj_index(self.path)
+        if objects is not None:
+            self.names = objects['names']
+            self.index, self.labels = select_objects(objects, classes, cap)  # class number start from 0
+        else:
+            # cuts from before objects.npz, or a hand edited data_list.txt
+            self.names, obj_ids, class_nums = read_data_list(os.path.join(self.path, "data_list.txt"))
+            self.names = np.array(self.names)
+            self.index, self.labels = select_classes(class_nums, classes, cap)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, id):
+        filename = self.names[self.index[id]]
+        return obj_item(open_image(os.path.join(self.path, filename), self.decode_backend),
+                        open_image(os.path.join(self.label_path, filename), self.decode_backend),
+                        open_image(os.path.join(self.mask_path, filename), self.decode_backend), self.labels[id],
+                        self.image_size, self.uint8)
+
+    def batch_transform(self, batch):
+        return obj_batch_transform(batch)
+
+
+class coco_obj_shard_dataset(ShardStream):
+    """ coco_obj_dataset read from the tar shards of tools/coco_shard.py; every object of `classes` is used,
+    the 10000 per class cap of coco_obj_dataset does not apply """
+
+    def __init__(self, path, train=True, **kwargs):
+        super(coco_obj_shard_dataset, self).__init__(obj_shard_dir(path, train), "obj", shuffle=train,
+                                                     shuffle_buffer=kwargs.get('shuffle_buffer', 1000))
+        classes = kwargs.get('classes', None)
+        if classes is None:
+            assert 0
+        self.classes_inv = {}
+        for i in range(0, len(classes)):
+            self.classes_inv[classes[i]] = i
         self.image_size = kwargs.get('image_size', 128)
-        for line in lines:
-            line = line[0:-1]
-            filename, class_num, class_name = line.split(' ', 2)
-            id, obj_id = filename.split('.')[0].split('_')
-            id, obj_id, class_num = int(id), int(obj_id), int(class_num)
-            if class_num not in classes:
-                continue
-            if len(classes) > 1 and count[class_num] > 10000:
-                continue
-            count[class_num] += 1
-            self.file_name_label_list.append([filename, obj_id, classes_inv[class_num]])  # class number start from 0
+        self.uint8 = kwargs.get('batch_transform', False)
+        self.decode_backend = resolve_backend(kwargs.get('decode_backend', 'pil'))
 
-        self.transform = transforms.Compose(
-            [transforms.Resize((self.image_size, self.image_size), Image.BICUBIC),
-             transforms.ToTensor(),
-             # transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
-             ])
+    def shard_count(self, shard):
+        return sum(n for class_num, n in shard['classes'].items() if int(class_num) in self.classes_inv)
+
+    def decode(self, key, parts, meta):
+        if meta['class_num'] not in self.classes_inv:
+            return None
+        return obj_item(open_image(parts['image.png'], self.decode_backend),
+                        open_image(parts['label.png'], self.decode_backend),
+                        open_image(parts['mask.png'], self.decode_backend), self.classes_inv[meta['class_num']],
+                        self.image_size, self.uint8)
+
+    def batch_transform(self, batch):
+        return obj_batch_transform(batch)
+
+
+class coco_obj_packed_dataset(Dataset):
+    """ same samples as coco_obj_dataset, read from the pack written by tools/coco_pack.py """
+
+    def __init__(self, path, train=True, **kwargs):
+        super(coco_obj_packed_dataset, self).__init__()
+        classes = kwargs.get('classes', None)
+        if classes is None:
+            assert 0
+        self.image_size = kwargs.get('image_size', 128)
+        self.pack = PackReader(path, train)
+        # see coco_obj_dataset
+        cap = None if balances_classes(kwargs.get('sampler', None)) else 10000
+        self.index, self.labels = select_classes(self.pack.class_nums, classes, cap)
+        self.uint8 = kwargs.get('batch_transform', False)
+        self.pack_size = self.image_size
+        if self.uint8 and self.image_size not in self.pack.sizes:
+            # read the closest packed size and let batch_transform resize whole batches
+            larger = [s for s in self.pack.sizes if s >= self.image_size]
+            self.pack_size = min(larger) if len(larger) > 0 else max(self.pack.sizes)
+        elif self.image_size not in self.pack.sizes:
+            raise ValueError("image_size {} is not packed in {}, available: {}; repack with coco_pack.py --sizes {} "
+                             "or set batch_transform to resize from another size".format(
+                                 self.image_size, self.pack.dir, self.pack.sizes, self.image_size))
 
     def __len__(self):
-        return len(self.file_name_label_list)
+        return len(self.index)
 
     def __getitem__(self, id):
-        a = self.transform(Image.open(os.path.join(self.path, self.file_name_label_list[id][0])))
-        b = self.transform(Image.open(os.path.join(self.label_path, self.file_name_label_list[id][0])))
-        mask = transforms.ToTensor()(transforms.Resize((self.image_size, self.image_size), Image.NEAREST)(
-            Image.open(os.path.join(self.mask_path, self.file_name_label_list[id][0]))))
-        t1 = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
-        t2 = transforms.Normalize((0.5), (0.5))
-        if a.shape[0] == 1:
-            a = a.expand([3, -1, -1])
-        a, b = t1(a), t2(b)
-        return a, b, mask, torch.tensor(self.file_name_label_list[id][2])
+        record = torch.from_numpy(self.pack.record(self.index[id], self.pack_size))
+        if self.uint8:
+            return record[0:3], record[3:4], record[4:5], torch.tensor(self.labels[id])
+        a = record[0:3].float().div_(127.5).sub_(1)  # ToTensor + Normalize(0.5, 0.5)
+        b = record[3:4].float().div_(127.5).sub_(1)
+        mask = record[4:5].float().div_(255)
+        return a, b, mask, torch.tensor(self.labels[id])
+
+    def batch_transform(self, batch):
+        a, b, mask, labels = batch
+        a = bt.normalize(bt.resize(bt.to_float(a), self.image_size))
+        b = bt.normalize(bt.resize(bt.to_float(b), self.image_size))
+        mask = bt.resize(bt.to_float(mask), self.image_size, mode='nearest')
+        return a, b, mask, labels
+
+
+def synthesis_item(image, ori, shape, image_size, uint8=False):
+    """ one coco_synthesis sample from the opened synthesized png and original jpeg, shape is [C, H, W] of the
+    original """
+    shape = torch.from_numpy(np.asarray(shape, dtype=np.int64))
+    size = (image_size, image_size)
+    if uint8:
+        image = to_uint8(image.resize(size, Image.BICUBIC))
+        ori = to_uint8(ori.resize(size, Image.BICUBIC))
+        if ori.shape[0] == 1:
+            ori = ori.expand([3, -1, -1])
+        return image, ori, shape
+
+    transform = transforms.Compose([transforms.Resize(size, Image.BICUBIC), transforms.ToTensor()])
+    t1 = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+    image = t1(transform(image))
+    ori = transform(ori)
+    if ori.shape[0] == 1:
+        ori = ori.expand([3, -1, -1])
+    ori = t1(ori)
+    return image, ori, shape
+
+
+def synthesis_batch_transform(batch):
+    image, ori, shape = batch
+    return bt.normalize(bt.to_float(image)), bt.normalize(bt.to_float(ori)), shape
 
 
 class coco_synthesis_dataset(Dataset):
@@ -198,154 +397,144 @@ class coco_synthesis_dataset(Dataset):
             self.file_name_to_base_image_name[line.split('.')[0]] = "img" + str(i).zfill(6) + ".png"
 
         self.image_size = kwargs.get('image_size', 64)
+        self.uint8 = kwargs.get('batch_transform', False)
+        self.decode_backend = resolve_backend(kwargs.get('decode_backend', 'pil'))
         self.transform = transforms.Compose(
             [transforms.Resize((self.image_size, self.image_size), Image.BICUBIC),
              transforms.ToTensor(),
              # transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
              ])
-        self.data = []
-        if not self.check_data():
-            self.valid_data=[]
-            self.coco = COCO(self.annotation_dir)
-            self.data = []
-            print("preparing synthesis data")
-            for i in tqdm(range(len(self.image_id_to_file_name))):
-                origin_image_id = self.image_id_to_file_name[i]
-                image_file_name = origin_image_id + ".png"
-                image_file_path = os.path.join(self.data_path, image_file_name)
-                #if os.path.exists(image_file_path):
-                #    continue
-                idata = self.prepare(i)
-                if idata is None:
-                    continue
-                self.valid_data.append(i)
-                image = (idata[0] / 2 + 0.5).clamp(0, 1)
-                if not os.path.exists(self.data_path):
-                    os.mkdir(self.data_path)
-                save_image(image, image_file_path)
+        if not os.path.exists(self.data_path):
+            os.mkdir(self.data_path)
+        # the generated files depend on the object generator, the classes and the output size
+        signature = "{}_{}_{}".format(getattr(self.obj_model, 'signature', type(self.obj_model).__name__),
+                                      self.classes, self.image_size)
+        self.manifest = SynthesisManifest(self.data_path, signature)
+        if kwargs.get('verify_synthesis', False):
+            self.manifest.verify()
+        todo = self.manifest.stale([name + ".png" for name in self.image_id_to_file_name])
+        if len(todo) > 0:
+            self.coco = open_coco_index(self.annotation_dir)
+            print("preparing synthesis data: {} of {} images missing or stale".format(len(todo),
+                                                                                   len(self.image_id_to_file_name)))
+            engine = SynthesisEngine(self, batch_size=kwargs.get('synthesis_batch_size', 64),
+                                     workers=kwargs.get('synthesis_workers', 4),
+                                     queue_size=kwargs.get('synthesis_queue_size', 16), manifest=self.manifest)
+            try:
+                engine.run(todo)
+            finally:
+                self.manifest.save()
+        self.valid_data = self.manifest.valid_ids(len(self.image_id_to_file_name))
+        self.draft_decode = kwargs.get('draft_decode', False)
+        self.shapes = self.load_shapes()
 
     def __len__(self):
         return len(self.valid_data)
 
     def __getitem__(self, id):
         id=self.valid_data[id]
-        t1 = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
         origin_image_id = self.image_id_to_file_name[id]
         image_file_name = origin_image_id + ".png"
         origin_image_file_name = origin_image_id + ".jpg"
         image_file_path = os.path.join(self.data_path, image_file_name)
         origin_image_file_path = os.path.join(self.origin_image_dir, origin_image_file_name)
 
-        image = t1(self.transform(Image.open(image_file_path)))
-        ori = Image.open(origin_image_file_path)
-        shape = torch.tensor(transforms.ToTensor()(ori).shape)
-        ori = self.transform(ori)
-        if ori.shape[0] == 1:
-            ori = ori.expand([3, -1, -1])
-        ori = t1(ori)
-        return image, ori, shape
-
-    def check_data(self):
-        print("checking synthesis data")
+        # draft_decode lets libjpeg decode at 1/2, 1/4 or 1/8 scale, still at least image_size on each side
+        return synthesis_item(open_image(image_file_path, self.decode_backend),
+                              open_image(origin_image_file_path, self.decode_backend,
+                                         (self.image_size, self.image_size) if self.draft_decode else None),
+                              self.shapes[id], self.image_size, self.uint8)
+
+    def load_shapes(self):
+        """ [C, H, W] of every original image, read from the jpeg headers once and cached in data_path """
+        shapes_path = os.path.join(self.data_path, "shapes.npy")
+        if os.path.exists(shapes_path):
+            shapes = np.load(shapes_path)
+            if len(shapes) == len(self.image_id_to_file_name):
+                return shapes
+        print("reading image shapes")
+        shapes = np.zeros([len(self.image_id_to_file_name), 3], dtype=np.int32)
         for id in tqdm(range(len(self.image_id_to_file_name))):
-            origin_image_id = self.image_id_to_file_name[id]
-            image_file_name = origin_image_id + ".png"
-            image_file_path = os.path.join(self.data_path, image_file_name)
-            if not os.path.exists(image_file_path):
-                return False
-        return True
+            # Image.open only parses the header
+            ori = Image.open(os.path.join(self.origin_image_dir, self.image_id_to_file_name[id] + ".jpg"))
+            shapes[id] = [len(ori.getbands()), ori.size[1], ori.size[0]]
+        np.save(shapes_path, shapes)
+        return shapes
 
-    def prepare(self, id):
-        upsample = nn.UpsamplingBilinear2d((self.image_size, self.image_size))
-        t1 = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+    def batch_transform(self, batch):
+        return synthesis_batch_transform(batch)
+
+    def load_objects(self, id):
+        """ decode one image and cut out its objects on the cpu, None when no object passes the filters """
         t2 = transforms.Normalize((0.5), (0.5))
 
         bg_image_file_name = "img" + str(id).zfill(6) + ".png"
         origin_image_id = self.image_id_to_file_name[id]
         origin_image_file_name = origin_image_id + ".jpg"
 
-        bg_image = transforms.ToTensor()(Image.open(os.path.join(self.bg_image_dir, bg_image_file_name))).cuda()
         # if origin_image_id in self.file_name_to_base_image_name.keys():
         #     base_image_file_name = self.file_name_to_base_image_name[origin_image_id]
         #     base_image = transforms.ToTensor()(Image.open(os.path.join(self.base_image_dir, base_image_file_name)))
         # else:
         #     base_image = None
-        origin_image = transforms.ToTensor()(
-            Image.open(os.path.join(self.origin_image_dir, origin_image_file_name))).cuda()
-        if origin_image.shape[0] == 1:
-            origin_image = origin_image.expand([3, -1, -1])
-        origin_label = Image.open(os.path.join(self.origin_label_dir, origin_image_id + ".png"))
-
-        bg_image = (nn.UpsamplingBilinear2d(size=origin_image.shape[1:])(bg_image.unsqueeze(0))).squeeze(0).cuda()
-        # if base_image is not None:
-        #     base_image = (nn.UpsamplingBilinear2d(size=origin_image.shape[1:])(base_image.unsqueeze(0))).squeeze(0)
-
         # print(origin_image_id)
-        annIds = self.coco.getAnnIds(imgIds=int(origin_image_id), catIds=[], iscrowd=None)
-        anns = self.coco.loadAnns(annIds)
+        # objects of at least 63x63 (floored bbox) and 6 pixels away from the border, checked on the index columns
+        # before anything is decoded
+        anns = self.coco.load_anns(int(origin_image_id), cat_ids=list(self.classes), min_size=63, border=6)
+        if len(anns) == 0:
+            return None
+        origin_label = open_image(os.path.join(self.origin_label_dir, origin_image_id + ".png"), self.decode_backend)
 
         objs = []
         for ann in anns:
-            if ann['category_id'] in self.classes:
-                bbox = ann['bbox']
-                for i in range(4):
-                    bbox[i] = math.floor(bbox[i])
-                if bbox[2] < 5 or bbox[3] < 5:
-                    continue
-                bbox[2] += bbox[0]
-                bbox[3] += bbox[1]
-
-                mask = self.coco.annToMask(ann) * 255
-                mask = Image.fromarray(mask)
-                obj_mask = mask.crop(bbox)
-                obj_mask = transforms.ToTensor()(obj_mask)
-
-                obj_label = origin_label.crop(bbox)
-
-                W, H = origin_label.size
-                w, h = obj_label.size
-                if w < 63 or h < 63:
-                    continue
-                if bbox[0] < 6 or bbox[1] < 6 or bbox[2] >= W - 6 or bbox[3] >= H - 6:
-                    continue
-
-                obj_label = self.transform(obj_label).cuda()
-
-                obj_input_catid = torch.tensor(self.classes_inv[ann['category_id']]).unsqueeze(0)
-
-                obj_label = t2(obj_label)
-                objs.append([obj_label, obj_mask, obj_input_catid, bbox, [h, w]])
-
-                # print(origin_image.shape)
-                # print(bbox, w, h)
-                # transforms.ToPILImage()(origin_image[:, bbox[1]:bbox[3], bbox[0]:bbox[2]]).show()
-                # transforms.ToPILImage()(transforms.ToTensor()(origin_label)[:, bbox[1]:bbox[3], bbox[0]:bbox[2]]).show()
-                # transforms.ToPILImage()(obj_label).show()
-                # transforms.ToPILImage()(obj_mask).show()
-                # transforms.ToPILImage()(bg_image[:, bbox[1]:bbox[3], bbox[0]:bbox[2]]).show()
-                # transforms.ToPILImage()(bg_image).show()
-                # if base_image is not None:
-                #     transforms.ToPILImage()(base_image).show()
-                #     transforms.ToPILImage()(origin_image).show()
-                #     exit(0)
+            bbox = ann['bbox']
+            w, h = bbox[2], bbox[3]
+            bbox[2] += bbox[0]
+            bbox[3] += bbox[1]
+
+            # the index stores the mask cropped to the bbox, 0/1 like ToTensor of the 0/255 crop
+            obj_mask = torch.from_numpy(self.coco.ann_mask(ann)).float().unsqueeze(0)
+
+            obj_label = self.transform(origin_label.crop(bbox))
+
+            obj_input_catid = torch.tensor(self.classes_inv[ann['category_id']]).unsqueeze(0)
+
+            obj_label = t2(obj_label)
+            objs.append([obj_label, obj_mask, obj_input_catid, bbox, [h, w]])
 
         if len(objs) == 0:
-            return None#t1(upsample(bg_image.unsqueeze(0)).squeeze(0)), \
-                   #t1(upsample(origin_image.unsqueeze(0)).squeeze(0)), torch.tensor(origin_image.shape)
-        objs_label = torch.cat([objs[i][0].cuda().unsqueeze(0) for i in range(0, len(objs))], 0)
-        objs_mask = [objs[i][1].cuda() for i in range(0, len(objs))]
-        objs_catid = torch.cat([objs[i][2].cuda() for i in range(0, len(objs))], 0)
-        objs_g = (self.obj_model.generate(objs_label, objs_catid) / 2 + 0.5).clamp(0, 1)
+            return None
+        bg_image = transforms.ToTensor()(open_image(os.path.join(self.bg_image_dir, bg_image_file_name),
+                                                    self.decode_backend))
+        origin_image = transforms.ToTensor()(open_image(os.path.join(self.origin_image_dir, origin_image_file_name),
+                                                        self.decode_backend))
+        if origin_image.shape[0] == 1:
+            origin_image = origin_image.expand([3, -1, -1])
+        return {'id': id, 'bg_image': bg_image, 'origin_image': origin_image, 'objs': objs}
+
+    def generate_objects(self, objs):
+        objs_label = torch.cat([objs[i][0].unsqueeze(0) for i in range(0, len(objs))], 0).cuda()
+        objs_catid = torch.cat([objs[i][2] for i in range(0, len(objs))], 0).cuda()
+        return (self.obj_model.generate(objs_label, objs_catid) / 2 + 0.5).clamp(0, 1)
+
+    def composite(self, data, objs_g):
+        """ paste the generated objects onto the upsampled background, returns the same tuple as prepare """
+        upsample = nn.UpsamplingBilinear2d((self.image_size, self.image_size))
+        t1 = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+        objs = data['objs']
+        origin_image = data['origin_image'].cuda()
+        bg_image = data['bg_image'].cuda()
+        bg_image = (nn.UpsamplingBilinear2d(size=origin_image.shape[1:])(bg_image.unsqueeze(0))).squeeze(0)
         # for i in range(objs_g.shape[0]):
         #    transforms.ToPILImage()(objs_g[i].squeeze(0)).show()
-        synthesis_image = bg_image.clone().cuda()
+        synthesis_image = bg_image.clone()
         for i in range(objs_g.shape[0]):
             # obj_g = transforms.ToPILImage()()
             # obj_g = obj_g.filter(ImageFilter.GaussianBlur(1))
             # obj_g = transforms.ToTensor()(objs_g[i])
             obj_g = nn.UpsamplingBilinear2d(objs[i][4])(objs_g[i].unsqueeze(0)).cuda()
             bbox = objs[i][3]
-            obj_mask = objs_mask[i]
+            obj_mask = objs[i][1].cuda()
             # print(synthesis_image[:, bbox[1]:bbox[3], bbox[0]:bbox[2]].shape, obj_g.shape)
             synthesis_image[:, bbox[1]:bbox[3], bbox[0]:bbox[2]] = synthesis_image[:, bbox[1]:bbox[3],
                                                                    bbox[0]:bbox[2]] * (1 - obj_mask) + obj_g * obj_mask
@@ -357,8 +546,93 @@ class coco_synthesis_dataset(Dataset):
         synthesis_image = t1(upsample(synthesis_image.unsqueeze(0)).squeeze(0))
         return synthesis_image, origin_image, torch.tensor(shape)
 
+    def prepare(self, id):
+        data = self.load_objects(id)
+        if data is None:
+            return None
+        return self.composite(data, self.generate_objects(data['objs']))
+
+
+class coco_synthesis_shard_dataset(ShardStream):
+    """ coco_synthesis_dataset read from the tar shards of tools/coco_shard.py. the shards are written from an
+    already built synthesis_{split}_{n} directory, nothing is synthesized here """
+
+    def __init__(self, path, train, **kwargs):
+        classes = kwargs.get('classes', None)
+        if classes is None:
+            assert 0
+        data_path = os.path.join(path, "..", "synthesis_{}_{}".format("train" if train else "val", len(classes)))
+        super(coco_synthesis_shard_dataset, self).__init__(synthesis_shard_dir(data_path), "synthesis",
+                                                           shuffle=train,
+                                                           shuffle_buffer=kwargs.get('shuffle_buffer', 1000))
+        self.image_size = kwargs.get('image_size', 64)
+        self.uint8 = kwargs.get('batch_transform', False)
+        self.draft_decode = kwargs.get('draft_decode', False)
+        self.decode_backend = resolve_backend(kwargs.get('decode_backend', 'pil'))
+
+    def decode(self, key, parts, meta):
+        return synthesis_item(open_image(parts['synthesis.png'], self.decode_backend),
+                              open_image(parts['origin.jpg'], self.decode_backend,
+                                         (self.image_size, self.image_size) if self.draft_decode else None),
+                              meta['shape'], self.image_size, self.uint8)
+
+    def batch_transform(self, batch):
+        return synthesis_batch_transform(batch)
+
+
+def loader_options(config, num_worker):
+    """ DataLoader keyword arguments from the `loader` section of config.yaml, e.g.
+        loader: {pin_memory: True, persistent_workers: True, prefetch_factor: 4, drop_last: True, device: cuda}
+    persistent_workers keeps the worker processes and their caches alive across epochs """
+    config = config if config is not None else {}
+    options = {'pin_memory': config.get('pin_memory', False) and torch.cuda.is_available(),
+               'drop_last': config.get('drop_last', False)}
+    if num_worker > 0:
+        # both are rejected by DataLoader without worker processes
+        options['persistent_workers'] = config.get('persistent_workers', False)
+        if config.get('prefetch_factor', None) is not None:
+            options['prefetch_factor'] = config['prefetch_factor']
+    return options
+
+
+def _loader(dataset, batch_size, num_worker, shuffle=True, sampler=None, loader=None, rank=0, world_size=1):
+    """ rank, world_size: the process of a distributed run (tools/dist.py), it loads its part of every epoch and
+    batch_size is per process """
+    options = loader_options(loader, num_worker)
+    if isinstance(dataset, IterableDataset):
+        # shard datasets shuffle themselves
+        if sampler is not None:
+            print("a sampler can not be used with {}".format(type(dataset).__name__))
+            assert 0
+        shuffle = False
+        if world_size > 1:
+            dataset.shard(rank, world_size)
+            # the worker seeds decide the shard order, every process has to draw the same ones
+            options['generator'] = torch.Generator().manual_seed(0)
+    elif sampler is None and shuffle:
+        # same as shuffle=True, but the order can be saved and restored mid-epoch
+        sampler = {'type': 'random'}
+    sampler = build_sampler(sampler, dataset, rank, world_size)
+    dataloader = DataLoader(dataset, batch_size, shuffle=shuffle and sampler is None, sampler=sampler,
+                            num_workers=num_worker, **options)
+    device = loader.get('device', None) if loader is not None else None
+    if device is not None:
+        if torch.device(device).type == 'cuda' and not torch.cuda.is_available():
+            device = 'cpu'
+        # the next batch is copied while the training step of the current one runs
+        dataloader = DevicePrefetcher(dataloader, device)
+    if getattr(dataset, 'uint8', False):
+        # workers return uint8 tensors, normalize/flip/resize run once per batch in the training process
+        return BatchTransformLoader(dataloader, dataset.batch_transform)
+    return dataloader
+
+
+def _dist(kwargs):
+    return {'rank': kwargs.get('rank', 0), 'world_size': kwargs.get('world_size', 1)}
+
 
 def build_data(tag, path, batch_size, training, num_worker, **kwargs):
+    """ rank, world_size in kwargs: the process of a distributed run, batch_size is per process """
     if tag == "mnist":
         transform = transforms.Compose([
             transforms.ToTensor(),
@@ -367,17 +641,26 @@ def build_data(tag, path, batch_size, training, num_worker, **kwargs):
         dataloader = DataLoader(mnist, batch_size, shuffle=True, num_workers=num_worker)
         return dataloader
     elif tag == "cifar10":
-        return DataLoader(cifar10_dataset(os.path.join(path, "cifar10"), **kwargs), batch_size, shuffle=True,
-                          num_workers=num_worker)
+        return _loader(cifar10_dataset(os.path.join(path, "cifar10"), train=training, **kwargs), batch_size,
+                       num_worker, loader=kwargs.get('loader', None), **_dist(kwargs))
     elif tag == "facades":
-        return DataLoader(facades_dataset(os.path.join(path, "facades")), batch_size, shuffle=True,
-                          num_workers=num_worker)
+        return _loader(facades_dataset(os.path.join(path, "facades"), **kwargs), batch_size, num_worker,
+                       loader=kwargs.get('loader', None), **_dist(kwargs))
     elif tag == "coco_obj":
-        return DataLoader(coco_obj_dataset(os.path.join(path, 'COCO'), **kwargs), batch_size, shuffle=True,
-                          num_workers=num_worker)
+        if kwargs.get('shards', False):
+            return _loader(coco_obj_shard_dataset(os.path.join(path, 'COCO'), **kwargs), batch_size, num_worker,
+                           sampler=kwargs.get('sampler', None), loader=kwargs.get('loader', None), **_dist(kwargs))
+        if kwargs.get('packed', False):
+            return _loader(coco_obj_packed_dataset(os.path.join(path, 'COCO'), **kwargs), batch_size, num_worker,
+                           sampler=kwargs.get('sampler', None), loader=kwargs.get('loader', None), **_dist(kwargs))
+        return _loader(coco_obj_dataset(os.path.join(path, 'COCO'), **kwargs), batch_size, num_worker,
+                       sampler=kwargs.get('sampler', None), loader=kwargs.get('loader', None), **_dist(kwargs))
     elif tag == 'coco_synthesis':
-        return DataLoader(coco_synthesis_dataset(path, train=training, **kwargs), batch_size, shuffle=True,
-                          num_workers=num_worker)
+        if kwargs.get('shards', False):
+            return _loader(coco_synthesis_shard_dataset(path, train=training, **kwargs), batch_size, num_worker,
+                           loader=kwargs.get('loader', None), **_dist(kwargs))
+        return _loader(coco_synthesis_dataset(path, train=training, **kwargs), batch_size, num_worker,
+                       loader=kwargs.get('loader', None), **_dist(kwargs))
 
 
 if __name__ == "__main__":
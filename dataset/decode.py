@@ -0,0 +1,152 @@
+import io
+import time
+import threading
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_GRAY
+    _turbo = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    # the python binding without the libturbojpeg library is as good as none
+    TurboJPEG = None
+    _turbo = None
+
+# image decoding behind one call, open_image(source, backend, size), returning a loaded PIL image so the
+# transforms of the datasets stay the same for every backend:
+#   pil:       PIL, jpeg draft mode for reduced-scale decode
+#   cv2:       OpenCV for jpeg and png (IMREAD_REDUCED_* for jpeg), other formats and palette png go to PIL
+#   turbojpeg: PyTurboJPEG (libjpeg-turbo) for jpeg with scaling factors, png through cv2 when available
+#   auto:      the first available of turbojpeg, cv2, pil
+# size (w, h) asks for a reduced-scale jpeg decode: 1/2, 1/4 or 1/8 as long as the result is still at least size
+BACKENDS = ['pil', 'cv2', 'turbojpeg']
+_SCALES = [8, 4, 2]
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def available_backends():
+    return [b for b in BACKENDS if b == 'pil' or (b == 'cv2' and cv2 is not None) or
+            (b == 'turbojpeg' and TurboJPEG is not None)]
+
+
+def resolve_backend(backend):
+    if backend == 'auto':
+        return available_backends()[-1]
+    if backend not in BACKENDS:
+        print("unknown decode backend: {}, choose from {}".format(backend, BACKENDS + ['auto']))
+        assert 0
+    if backend not in available_backends():
+        print("decode backend {} is not installed, using pil".format(backend))
+        return 'pil'
+    return backend
+
+
+def reduce_scale(image_size, size):
+    """ largest jpeg scale denominator that keeps an image of image_size (w, h) at least size (w, h), the same
+    choice as PIL's draft """
+    if size is None:
+        return 1
+    for scale in _SCALES:
+        if image_size[0] >= size[0] * scale and image_size[1] >= size[1] * scale:
+            return scale
+    return 1
+
+
+def _record(backend, seconds):
+    with _stats_lock:
+        count, total = _stats.get(backend, (0, 0.))
+        _stats[backend] = (count + 1, total + seconds)
+
+
+def decode_stats(reset=False):
+    """ {backend: (images, seconds, images per second)} of the decodes in this process """
+    with _stats_lock:
+        stats = {b: (n, t, n / t if t > 0 else 0.) for b, (n, t) in _stats.items()}
+        if reset:
+            _stats.clear()
+    return stats
+
+
+def _from_array(array):
+    if array.ndim == 3 and array.shape[2] == 1:
+        array = array[:, :, 0]
+    return Image.fromarray(array)
+
+
+def _cv2_decode(data, header, size):
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if header.format == 'JPEG':
+        scale = reduce_scale(header.size, size)
+        gray = header.mode == 'L'
+        if scale > 1:
+            flag = getattr(cv2, "IMREAD_REDUCED_{}_{}".format("GRAYSCALE" if gray else "COLOR", scale))
+        else:
+            flag = cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR
+        # PIL does not apply the exif orientation either
+        array = cv2.imdecode(buffer, flag | cv2.IMREAD_IGNORE_ORIENTATION)
+    else:
+        array = cv2.imdecode(buffer, cv2.IMREAD_UNCHANGED)
+    if array.ndim == 3 and array.shape[2] == 3:
+        array = cv2.cvtColor(array, cv2.COLOR_BGR2RGB)
+    elif array.ndim == 3 and array.shape[2] == 4:
+        array = cv2.cvtColor(array, cv2.COLOR_BGRA2RGBA)
+    return _from_array(array)
+
+
+def _turbo_decode(data, header, size):
+    scale = reduce_scale(header.size, size)
+    gray = header.mode == 'L'
+    array = _turbo.decode(data, pixel_format=TJPF_GRAY if gray else TJPF_RGB, scaling_factor=(1, scale))
+    return _from_array(array)
+
+
+def _pil_decode(data, header, size):
+    if size is not None and header.format == 'JPEG':
+        header.draft(None, size)
+    header.load()
+    return header
+
+
+def open_image(source, backend='pil', size=None):
+    """ source: a file path or the encoded bytes, backend: one of available_backends(), see resolve_backend """
+    start = time.time()
+    if backend == 'pil' and not isinstance(source, bytes):
+        image = _pil_decode(None, Image.open(source), size)
+        _record('pil', time.time() - start)
+        return image
+    if isinstance(source, bytes):
+        data = source
+    else:
+        with open(source, "rb") as f:
+            data = f.read()
+    header = Image.open(io.BytesIO(data))  # parses the header only
+    used = 'pil'
+    if header.format == 'JPEG' and header.mode in ['L', 'RGB'] and backend in ['cv2', 'turbojpeg']:
+        used = backend
+    elif header.format == 'PNG' and header.mode in ['L', 'RGB', 'RGBA'] and backend != 'pil' and cv2 is not None:
+        used = 'cv2'
+    if used == 'turbojpeg':
+        image = _turbo_decode(data, header, size)
+    elif used == 'cv2':
+        image = _cv2_decode(data, header, size)
+    else:
+        image = _pil_decode(data, header, size)
+    _record(used, time.time() - start)
+    return image
+
+
+def benchmark_backends(files, size=None, backends=None):
+    """ decode every file with every backend, returns {backend: images per second} """
+    result = {}
+    for backend in backends if backends is not None else available_backends():
+        backend = resolve_backend(backend)
+        start = time.time()
+        for file in files:
+            open_image(file, backend, size)
+        result[backend] = len(files) / max(time.time() - start, 1e-9)
+    return result
@@ -0,0 +1,94 @@
+import torch
+
+
+class BatchTransformLoader(object):
+    """ wraps a DataLoader whose dataset returns uint8 tensors and applies the dataset's batch_transform
+    in the training process, once per batch, on the device DevicePrefetcher moved the batch to, if any """
+
+    def __init__(self, dataloader, transform):
+        self.dataloader = dataloader
+        self.transform = transform
+
+    @property
+    def dataset(self):
+        return self.dataloader.dataset
+
+    @property
+    def batch_size(self):
+        return self.dataloader.batch_size
+
+    @property
+    def sampler(self):
+        return self.dataloader.sampler
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        for batch in self.dataloader:
+            yield self.transform(batch)
+
+
+def to_device(batch, device, non_blocking=True):
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(x, device, non_blocking) for x in batch)
+    return batch
+
+
+def _record_stream(batch, stream):
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for x in batch:
+            _record_stream(x, stream)
+
+
+class DevicePrefetcher(object):
+    """ copies batch i + 1 to `device` on a side cuda stream while the caller works on batch i. the DataLoader
+    should pin memory for the copy to be asynchronous; on a cpu device batches are just moved in order """
+
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+
+    @property
+    def dataset(self):
+        return self.dataloader.dataset
+
+    @property
+    def batch_size(self):
+        return self.dataloader.batch_size
+
+    @property
+    def sampler(self):
+        return self.dataloader.sampler
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.dataloader:
+                yield to_device(batch, self.device)
+            return
+        stream = torch.cuda.Stream(self.device)
+        it = iter(self.dataloader)
+        next_batch = self._preload(it, stream)
+        while next_batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            batch = next_batch
+            # the memory was allocated on the side stream, keep it alive until the main stream is done with it
+            _record_stream(batch, current)
+            next_batch = self._preload(it, stream)
+            yield batch
+
+    def _preload(self, it, stream):
+        try:
+            batch = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            return to_device(batch, self.device)
@@ -0,0 +1,61 @@
+import os
+import numpy as np
+from dataset.coco_pack import read_data_list
+
+# columnar index of the cut objects, {split}_cut/objects.npz next to data_list.txt, one row per line of it:
+#   names, image_ids, ann_ids, category, bbox [N, 4] (floored x, y, w, h), area, image_hw [N, 2]
+#   class_ids [C] (sorted), class_start [C + 1], order [N]: rows order[class_start[c]:class_start[c + 1]] are the
+#   objects of class_ids[c] in data_list order
+OBJ_INDEX = "objects.npz"
+
+
+def write_obj_index(cut_dir, coco):
+    """ objects.npz of the data_list.txt in cut_dir, the metadata comes from the coco index it was cut from """
+    names, obj_ids, class_nums = read_data_list(os.path.join(cut_dir, "data_list.txt"))
+    sorter = np.argsort(coco.ann_ids)
+    ks = sorter[np.searchsorted(coco.ann_ids, obj_ids, sorter=sorter)] if len(obj_ids) > 0 else obj_ids
+    images = np.searchsorted(coco.ann_start, ks, side='right') - 1
+    order = np.argsort(class_nums, kind='stable')
+    class_ids, counts = np.unique(class_nums, return_counts=True)
+    class_start = np.zeros([len(class_ids) + 1], dtype=np.int64)
+    class_start[1:] = np.cumsum(counts)
+    # written under a temporary name first, a half written index is never picked up
+    tmp_file = os.path.join(cut_dir, OBJ_INDEX + ".tmp.npz")
+    np.savez(tmp_file, names=np.array(names, dtype=np.str_), image_ids=np.asarray(coco.image_ids[images]),
+             ann_ids=obj_ids, category=class_nums, bbox=np.asarray(coco.bbox[ks]).reshape(-1, 4),
+             area=np.asarray(coco.area[ks]), image_hw=np.asarray(coco.image_hw[images]).reshape(-1, 2),
+             class_ids=class_ids.astype(np.int32), class_start=class_start, order=order.astype(np.int64))
+    os.replace(tmp_file, os.path.join(cut_dir, OBJ_INDEX))
+    return len(names)
+
+
+def read_obj_index(cut_dir):
+    """ the columns of objects.npz as a dict, None when it is missing or older than data_list.txt """
+    path = os.path.join(cut_dir, OBJ_INDEX)
+    if not os.path.exists(path):
+        return None
+    if os.path.getmtime(path) < os.path.getmtime(os.path.join(cut_dir, "data_list.txt")):
+        print("{} is older than data_list.txt, rerun coco_cut.py to refresh it".format(path))
+        return None
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files}
+
+
+def select_objects(objects, classes, cap=10000):
+    """ select_classes over the per-class ranges of objects.npz: the rows of `classes` in data_list order, at most
+    cap + 1 per class when several classes are used (cap None keeps all); returns rows and class numbers from 0 """
+    positions = np.searchsorted(objects['class_ids'], classes)
+    rows, labels = [], []
+    for label, (c, p) in enumerate(zip(classes, positions)):
+        if p >= len(objects['class_ids']) or objects['class_ids'][p] != c:
+            continue
+        class_rows = objects['order'][objects['class_start'][p]:objects['class_start'][p + 1]]
+        if len(classes) > 1 and cap is not None:
+            class_rows = class_rows[:cap + 1]
+        rows.append(class_rows)
+        labels.append(np.full([len(class_rows)], label, dtype=np.int64))
+    if len(rows) == 0:
+        return np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64)
+    rows, labels = np.concatenate(rows), np.concatenate(labels)
+    sort = np.argsort(rows, kind='stable')
+    return rows[sort], labels[sort]
@@ -0,0 +1,150 @@
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class ResumableSampler(Sampler):
+    """ base of the samplers whose order only depends on (seed, epoch). state_dict(consumed) is all a checkpoint
+    needs to continue an interrupted epoch at the exact batch: the order is rebuilt from seed and epoch and the
+    first `consumed` indices are skipped once.
+    shard(rank, world_size) splits every pass between data parallel processes: all of them build the same order,
+    pad it to a multiple of world_size and take every world_size-th index, so they run the same number of batches """
+
+    def __init__(self, seed=0):
+        super(ResumableSampler, self).__init__()
+        self.seed = seed
+        self.epoch = 0
+        self.current_epoch = 0
+        self.start = 0
+        self.rank = 0
+        self.world_size = 1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def shard(self, rank, world_size):
+        self.rank = rank
+        self.world_size = world_size
+
+    def size(self):
+        """ indices of one pass over all processes """
+        raise NotImplementedError
+
+    def __len__(self):
+        return (self.size() + self.world_size - 1) // self.world_size
+
+    def indices(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        indices = self.indices()
+        start, self.start = self.start, 0
+        self.current_epoch = self.epoch
+        self.epoch += 1
+        indices = indices[start:]
+        if self.world_size > 1:
+            pad = (-len(indices)) % self.world_size
+            indices = torch.cat([indices, indices[0:pad]])[self.rank::self.world_size]
+        return iter(indices.tolist())
+
+    def state_dict(self, consumed=0):
+        """ consumed: samples of the current pass the training loop has finished with, in this process; every
+        process consumes as many, the state counts them over all """
+        return {'seed': self.seed, 'epoch': self.current_epoch, 'consumed': consumed * self.world_size}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.current_epoch = state['epoch']
+        self.start = state['consumed']
+
+
+class RandomPermutationSampler(ResumableSampler):
+    """ shuffle=True of DataLoader, but checkpointable """
+
+    def __init__(self, length, seed=0):
+        super(RandomPermutationSampler, self).__init__(seed)
+        self.length = length
+
+    def size(self):
+        return self.length
+
+    def indices(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        return torch.randperm(self.length, generator=g)
+
+
+class ClassBalancedSampler(ResumableSampler):
+    """ per-epoch class mix over the full object index, the dataset itself is never filtered or copied.
+        mode 'quota':       per_class samples of every class each epoch, without replacement while a class has
+                            enough objects
+        mode 'temperature': epoch_size samples, class c drawn with probability ~ n_c ** (1 / temperature),
+                            1 keeps the natural mix, larger values flatten it towards uniform
+    the draw only depends on seed and epoch, the epoch advances after every pass """
+
+    def __init__(self, labels, mode='quota', per_class=1000, temperature=1.0, epoch_size=None, seed=0):
+        super(ClassBalancedSampler, self).__init__(seed)
+        labels = np.asarray(labels, dtype=np.int64)
+        self.mode = mode
+        self.per_class = per_class
+        self.temperature = temperature
+        self.epoch_size = epoch_size if epoch_size is not None else len(labels)
+        # objects grouped by class: order[offsets[c]:offsets[c + 1]] are the dataset indices of class c
+        self.order = torch.from_numpy(np.argsort(labels, kind='stable'))
+        self.counts = torch.from_numpy(np.bincount(labels)) if len(labels) > 0 else torch.zeros([0], dtype=torch.long)
+        self.offsets = torch.cat([torch.zeros([1], dtype=torch.long), self.counts.cumsum(0)])
+        self.sorted_labels = torch.repeat_interleave(torch.arange(len(self.counts)), self.counts)
+        if mode not in ['quota', 'temperature']:
+            print("unknown sampler mode: {}".format(mode))
+            assert 0
+
+    def size(self):
+        if self.mode == 'quota':
+            return int((self.counts > 0).sum()) * self.per_class
+        return self.epoch_size
+
+    def indices(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        if self.mode == 'quota':
+            picks = []
+            for c in torch.nonzero(self.counts > 0).view(-1).tolist():
+                n = int(self.counts[c])
+                members = self.order[self.offsets[c]:self.offsets[c + 1]]
+                pick = torch.cat([torch.randperm(n, generator=g) for _ in range(self.per_class // n + 1)])
+                picks.append(members[pick[0:self.per_class]])
+            picks = torch.cat(picks) if len(picks) > 0 else torch.zeros([0], dtype=torch.long)
+            return picks[torch.randperm(len(picks), generator=g)]
+        class_weight = self.counts.double().pow(1.0 / self.temperature)
+        sample_weight = (class_weight / self.counts.double().clamp(min=1))[self.sorted_labels]
+        picks = torch.multinomial(sample_weight, self.epoch_size, replacement=True, generator=g)
+        return self.order[picks]
+
+
+def balances_classes(config):
+    """ whether the `sampler` section picks a class balanced sampler, {type: random} only shuffles """
+    return config is not None and config.get('type', 'quota') != 'random'
+
+
+def build_sampler(config, dataset, rank=0, world_size=1):
+    """ config is the `sampler` section of config.yaml, e.g. {type: temperature, temperature: 2, epoch_size: 50000},
+    {type: random} is a plain shuffle. rank, world_size: this process' part of every pass in distributed training """
+    if config is None:
+        return None
+    if config.get('type', 'quota') == 'random':
+        # a fresh order per run like shuffle=True unless the seed is fixed, checkpoints store the seed either way.
+        # distributed processes have to build the same order, they default to seed 0
+        seed = torch.initial_seed() % (2 ** 31) if world_size == 1 else 0
+        sampler = RandomPermutationSampler(len(dataset), seed=config.get('seed', seed))
+    else:
+        labels = getattr(dataset, 'labels', None)
+        if labels is None:
+            print("{} has no labels to balance".format(type(dataset).__name__))
+            assert 0
+        sampler = ClassBalancedSampler(labels, mode=config.get('type', 'quota'),
+                                       per_class=config.get('per_class', 1000),
+                                       temperature=config.get('temperature', 1.0),
+                                       epoch_size=config.get('epoch_size', None), seed=config.get('seed', 0))
+    sampler.shard(rank, world_size)
+    return sampler
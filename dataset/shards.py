@@ -0,0 +1,253 @@
+import io
+import os
+import json
+import random
+import tarfile
+from PIL import Image
+from tqdm import tqdm
+from torch.utils.data import IterableDataset, get_worker_info
+from dataset.coco_pack import read_data_list
+
+# sequential storage for the coco datasets: plain tar files of a few thousand samples each, next to shards.json
+#   {"kind": "obj" | "synthesis", "shards": [{"file": "shard-000000.tar", "count": n, "classes": {class_num: n}}]}
+# every sample is a run of consecutive members <key>.<part> plus <key>.json with its metadata
+SHARD_INFO = "shards.json"
+
+
+def obj_shard_dir(path, train=True):
+    return os.path.join(path, "{}_shards".format("train" if train else "val"))
+
+
+def synthesis_shard_dir(data_path):
+    return data_path.rstrip('/\\') + "_shards"
+
+
+class ShardWriter(object):
+    def __init__(self, output_dir, kind, shard_size=5000):
+        self.output_dir = output_dir
+        self.kind = kind
+        self.shard_size = shard_size
+        self.shards = []
+        self.tar = None
+        if not os.path.exists(output_dir):
+            os.mkdir(output_dir)
+
+    def _add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def write(self, key, parts, meta):
+        """ parts: {part name: encoded bytes}, meta: json serializable dict, 'class_num' is counted per shard """
+        if self.tar is None or self.shards[-1]['count'] >= self.shard_size:
+            self._close_shard()
+            file_name = "shard-{}.tar".format(str(len(self.shards)).zfill(6))
+            self.tar = tarfile.open(os.path.join(self.output_dir, file_name + ".tmp"), "w")
+            self.shards.append({'file': file_name, 'count': 0, 'classes': {}})
+        for part, data in parts.items():
+            self._add("{}.{}".format(key, part), data)
+        self._add("{}.json".format(key), json.dumps(meta).encode())
+        shard = self.shards[-1]
+        shard['count'] += 1
+        if 'class_num' in meta:
+            class_num = str(meta['class_num'])
+            shard['classes'][class_num] = shard['classes'].get(class_num, 0) + 1
+
+    def _close_shard(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        file_name = os.path.join(self.output_dir, self.shards[-1]['file'])
+        os.replace(file_name + ".tmp", file_name)
+        self.tar = None
+
+    def close(self):
+        self._close_shard()
+        with open(os.path.join(self.output_dir, SHARD_INFO), "w") as f:
+            json.dump({'kind': self.kind, 'shards': self.shards}, f)
+
+
+def _read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_obj_shards(path, train=True, shard_size=5000, seed=0):
+    """ {split}_cut, {split}_label_cut and {split}_mask_cut -> {split}_shards, objects in a seeded random order
+    so that a shard mixes images and classes """
+    split = "train" if train else "val"
+    image_dir = os.path.join(path, "{}_cut".format(split))
+    label_dir = os.path.join(path, "{}_label_cut".format(split))
+    mask_dir = os.path.join(path, "{}_mask_cut".format(split))
+    names, obj_ids, class_nums = read_data_list(os.path.join(image_dir, "data_list.txt"))
+    order = list(range(len(names)))
+    random.Random(seed).shuffle(order)
+    writer = ShardWriter(obj_shard_dir(path, train), "obj", shard_size)
+    print("writing {} objects into {}".format(len(names), writer.output_dir))
+    for i in tqdm(order):
+        writer.write(names[i].split('.')[0], {
+            'image.png': _read_bytes(os.path.join(image_dir, names[i])),
+            'label.png': _read_bytes(os.path.join(label_dir, names[i])),
+            'mask.png': _read_bytes(os.path.join(mask_dir, names[i])),
+        }, {'class_num': int(class_nums[i])})
+    writer.close()
+    return writer.output_dir
+
+
+def write_synthesis_shards(data_path, origin_image_dir, shard_size=1000, seed=0):
+    """ the valid images of a built synthesis_{split}_{n} directory (see its manifest.json) together with their
+    original jpeg, the jpeg bytes are kept as they are so draft decoding still applies """
+    with open(os.path.join(data_path, "manifest.json")) as f:
+        entries = json.load(f)['entries']
+    files = sorted(entry['file'] for entry in entries.values() if entry['valid'])
+    random.Random(seed).shuffle(files)
+    writer = ShardWriter(synthesis_shard_dir(data_path), "synthesis", shard_size)
+    print("writing {} images into {}".format(len(files), writer.output_dir))
+    for file_name in tqdm(files):
+        name = file_name.split('.')[0]
+        ori = _read_bytes(os.path.join(origin_image_dir, name + ".jpg"))
+        header = Image.open(io.BytesIO(ori))  # only parses the header
+        writer.write(name, {'synthesis.png': _read_bytes(os.path.join(data_path, file_name)), 'origin.jpg': ori},
+                     {'shape': [len(header.getbands()), header.size[1], header.size[0]]})
+    writer.close()
+    return writer.output_dir
+
+
+def iter_shard(file_path):
+    """ (key, {part: bytes}) of every sample, reading the tar front to back """
+    key, parts = None, {}
+    with tarfile.open(file_path, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, part = member.name.split('.', 1)
+            if member_key != key and key is not None:
+                yield key, parts
+                parts = {}
+            key = member_key
+            parts[part] = tar.extractfile(member).read()
+    if key is not None:
+        yield key, parts
+
+
+class ShardStream(IterableDataset):
+    """ base class of the shard backed datasets. every DataLoader worker reads its own subset of the shards
+    sequentially and shuffles within a buffer of shuffle_buffer samples; subclasses decode a sample with
+    decode(key, parts, meta), returning None skips it.
+    shard(rank, world_size) splits the shards between data parallel processes as well; every worker of every process
+    then yields the same number of samples, going around its shards again when they run short, so no process runs
+    out of batches before the others """
+
+    def __init__(self, shard_dir, kind, shuffle=True, shuffle_buffer=1000, seed=0):
+        super(ShardStream, self).__init__()
+        info_path = os.path.join(shard_dir, SHARD_INFO)
+        if not os.path.exists(info_path):
+            print("no shards in {}, write them with tools/coco_shard.py first".format(shard_dir))
+            assert 0
+        with open(info_path) as f:
+            info = json.load(f)
+        if info['kind'] != kind:
+            print("{} holds {} shards, not {}".format(shard_dir, info['kind'], kind))
+            assert 0
+        self.shard_dir = shard_dir
+        self.shards = info['shards']
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.rank = 0
+        self.world_size = 1
+
+    def shard(self, rank, world_size):
+        if len(self.shards) < world_size:
+            print("{} shards in {} can not be split between {} processes".format(
+                len(self.shards), self.shard_dir, world_size))
+            assert 0
+        self.rank = rank
+        self.world_size = world_size
+
+    def shard_count(self, shard):
+        return shard['count']
+
+    def __len__(self):
+        return sum(self.shard_count(shard) for shard in self.shards) // self.world_size
+
+    def decode(self, key, parts, meta):
+        raise NotImplementedError
+
+    def _shards(self):
+        worker = get_worker_info()
+        if worker is None:
+            seed, worker_id, num_workers = self.seed + self.epoch, 0, 1
+        else:
+            # worker seeds are base_seed + id: all workers agree on the order. base_seed is fresh every epoch, unless
+            # the workers are persistent, then the epoch counter of every worker's own copy moves it on
+            seed, worker_id, num_workers = worker.seed - worker.id + self.epoch, worker.id, worker.num_workers
+        self.epoch += 1
+        shards = [shard['file'] for shard in self.shards]
+        if self.shuffle:
+            random.Random(seed).shuffle(shards)
+        # the processes share the seed (see _loader in data_builder.py), so their splits never overlap
+        stream = self.rank * num_workers + worker_id
+        streams = self.world_size * num_workers
+        shards = shards[stream::streams]
+        if self.world_size > 1 and len(shards) == 0:
+            # more streams than shards, the spare ones read a shard somebody else reads too
+            shards = [self.shards[stream % len(self.shards)]['file']]
+        return shards, random.Random(seed + stream)
+
+    def _samples(self, shards):
+        for file_name in shards:
+            for key, parts in iter_shard(os.path.join(self.shard_dir, file_name)):
+                yield key, parts
+
+    def _quota(self):
+        """ samples every worker yields in distributed training, None otherwise """
+        if self.world_size == 1:
+            return None
+        worker = get_worker_info()
+        if worker is None:
+            return len(self)
+        # split exactly, the first workers take one more
+        return len(self) // worker.num_workers + (1 if worker.id < len(self) % worker.num_workers else 0)
+
+    def _stream(self, shards, rng):
+        buffer = []
+        for sample in self._samples(shards):
+            if self.shuffle:
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                # the encoded bytes are buffered, decoding happens on the way out
+                k = rng.randrange(len(buffer))
+                buffer[k], sample = sample, buffer[k]
+            item = self._decode(*sample)
+            if item is not None:
+                yield item
+        rng.shuffle(buffer)
+        for sample in buffer:
+            item = self._decode(*sample)
+            if item is not None:
+                yield item
+
+    def __iter__(self):
+        shards, rng = self._shards()
+        quota = self._quota()
+        if quota is None:
+            for item in self._stream(shards, rng):
+                yield item
+            return
+        yielded = 0
+        while yielded < quota:
+            before = yielded
+            for item in self._stream(shards, rng):
+                yield item
+                yielded += 1
+                if yielded == quota:
+                    return
+            if yielded == before:
+                print("nothing to decode in {}".format(shards))
+                assert 0
+
+    def _decode(self, key, parts):
+        return self.decode(key, parts, json.loads(parts.pop('json').decode()))
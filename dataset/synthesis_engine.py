@@ -0,0 +1,157 @@
+import io
+import os
+import queue
+import hashlib
+import threading
+from tqdm import tqdm
+from torchvision.utils import save_image
+
+_DONE = object()
+
+
+class SynthesisEngine(object):
+    """ staged precompute pipeline for coco_synthesis_dataset:
+        decode (workers threads) -> generate (1 thread, objects of many images per obj_model.generate call)
+        -> composite (workers threads) -> png encode (workers threads)
+    the stages are joined by bounded queues, so decoding and encoding overlap with generation.
+    all stages are threads: PIL decode/encode and torch ops release the GIL, and the generator stays on one device """
+
+    def __init__(self, dataset, batch_size=64, workers=4, queue_size=16, manifest=None):
+        self.dataset = dataset
+        self.manifest = manifest
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.stop = threading.Event()
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def _put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _stage(self, fn):
+        def run(*args):
+            try:
+                fn(*args)
+            except BaseException as e:
+                self.errors.append(e)
+                self.stop.set()
+
+        return run
+
+    def _decode(self, ids, decoded, progress):
+        while True:
+            id = self._get(ids)
+            if id is _DONE:
+                return
+            data = self.dataset.load_objects(id)
+            if data is None:
+                if self.manifest is not None:
+                    self.manifest.record(id, self.dataset.image_id_to_file_name[id] + ".png")
+                progress()  # nothing to paste on this image
+                continue
+            self._put(decoded, data)
+
+    def _generate(self, decoded, generated):
+        pending = []
+        pending_objs = 0
+        while True:
+            item = self._get(decoded)
+            if item is not _DONE:
+                pending.append(item)
+                pending_objs += len(item['objs'])
+            if len(pending) > 0 and (pending_objs >= self.batch_size or item is _DONE):
+                objs_g = self.dataset.generate_objects([obj for data in pending for obj in data['objs']])
+                start = 0
+                for data in pending:
+                    self._put(generated, (data, objs_g[start:start + len(data['objs'])]))
+                    start += len(data['objs'])
+                pending = []
+                pending_objs = 0
+            if item is _DONE:
+                return
+
+    def _composite(self, generated, composited):
+        while True:
+            item = self._get(generated)
+            if item is _DONE:
+                return
+            data, objs_g = item
+            synthesis_image = self.dataset.composite(data, objs_g)[0]
+            self._put(composited, (data['id'], (synthesis_image / 2 + 0.5).clamp(0, 1).cpu()))
+
+    def _encode(self, composited, valid, progress):
+        while True:
+            item = self._get(composited)
+            if item is _DONE:
+                return
+            id, image = item
+            image_file_name = self.dataset.image_id_to_file_name[id] + ".png"
+            buffer = io.BytesIO()
+            save_image(image, buffer, format="png")
+            with open(os.path.join(self.dataset.data_path, image_file_name), "wb") as f:
+                f.write(buffer.getvalue())
+            if self.manifest is not None:
+                self.manifest.record(id, image_file_name, hashlib.sha1(buffer.getvalue()).hexdigest())
+            with self.lock:
+                valid.append(id)
+            progress()
+
+    def _start(self, n, fn, *args):
+        threads = [threading.Thread(target=self._stage(fn), args=args) for _ in range(n)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        return threads
+
+    def _finish(self, threads, next_queue, next_workers):
+        """ wait for a stage to drain, then tell every worker of the next stage to stop """
+        for t in threads:
+            t.join()
+        for _ in range(next_workers):
+            self._put(next_queue, _DONE)
+
+    def run(self, ids):
+        """ synthesize every image in ids, returns the sorted ids that produced a file """
+        ids = list(ids)
+        id_queue = queue.Queue()
+        for id in ids:
+            id_queue.put(id)
+        for _ in range(self.workers):
+            id_queue.put(_DONE)
+        decoded = queue.Queue(self.queue_size)
+        generated = queue.Queue(self.queue_size)
+        composited = queue.Queue(self.queue_size)
+        valid = []
+        bar = tqdm(total=len(ids))
+
+        def progress():
+            with self.lock:
+                bar.update(1)
+
+        decoders = self._start(self.workers, self._decode, id_queue, decoded, progress)
+        generator = self._start(1, self._generate, decoded, generated)
+        compositors = self._start(self.workers, self._composite, generated, composited)
+        encoders = self._start(self.workers, self._encode, composited, valid, progress)
+
+        self._finish(decoders, decoded, 1)
+        self._finish(generator, generated, self.workers)
+        self._finish(compositors, composited, self.workers)
+        self._finish(encoders, None, 0)
+        bar.close()
+        if len(self.errors) > 0:
+            raise self.errors[0]
+        return sorted(valid)
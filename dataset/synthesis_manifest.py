@@ -0,0 +1,74 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+class SynthesisManifest(object):
+    """ record of the synthesized images in data_path/manifest.json:
+        {"entries": {"<id>": {"valid": bool, "file": png name, "generator": signature, "sha1": png hash}}}
+    an image id is stale when it has no entry, was produced by another generator signature, now maps to
+    another file or its png was deleted """
+
+    def __init__(self, data_path, signature):
+        self.path = os.path.join(data_path, "manifest.json")
+        self.data_path = data_path
+        self.signature = signature
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.last_save = time.time()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)['entries']
+
+    def stale(self, file_names):
+        """ file_names[id] is the png name image id should have """
+        # one listing instead of a stat per image; hashes are only compared by verify()
+        present = set(os.listdir(self.data_path)) if os.path.isdir(self.data_path) else set()
+        todo = []
+        for id, file_name in enumerate(file_names):
+            entry = self.entries.get(str(id))
+            if entry is None or entry['generator'] != self.signature or entry['file'] != file_name:
+                todo.append(id)
+            elif entry['valid'] and file_name not in present:
+                todo.append(id)
+        return todo
+
+    def valid_ids(self, count):
+        return sorted(int(id) for id, entry in self.entries.items() if entry['valid'] and int(id) < count)
+
+    def record(self, id, file_name, sha1=None, save_interval=60):
+        """ thread safe; sha1 None marks an image without any object to paste, nothing was written for it """
+        with self.lock:
+            self.entries[str(id)] = {'valid': sha1 is not None, 'file': file_name, 'generator': self.signature,
+                                     'sha1': sha1}
+            # flush now and then so an interrupted rebuild resumes where it stopped
+            if time.time() - self.last_save > save_interval:
+                self._save()
+
+    def verify(self):
+        """ optional full check: drop entries whose png is missing or does not match its hash """
+        with self.lock:
+            for id, entry in list(self.entries.items()):
+                if not entry['valid']:
+                    continue
+                file_path = os.path.join(self.data_path, entry['file'])
+                if not os.path.exists(file_path) or file_sha1(file_path) != entry['sha1']:
+                    del self.entries[id]
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({'entries': self.entries}, f)
+        os.replace(tmp, self.path)
+        self.last_save = time.time()
+
+
+def file_sha1(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
@@ -1,15 +1,15 @@
 import torch
 from torch import nn
+from torch.nn.utils import spectral_norm
 from torchvision.models import resnet50
 from torchvision.models import resnet34
 from torchvision.models import resnet101
 
 
-def _conv_layer(in_channels, out_channels, kernel, stride, padding, bias=True, norm=True, act="relu"):
-    layers = [
-        nn.Conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel, stride=stride,
-                  padding=padding, bias=bias)
-    ]
+def _conv_layer(in_channels, out_channels, kernel, stride, padding, bias=True, norm=True, act="relu", sn=False):
+    conv = nn.Conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel, stride=stride,
+                     padding=padding, bias=bias)
+    layers = [spectral_norm(conv) if sn else conv]
     if norm:
         layers.append(nn.InstanceNorm2d(out_channels))
     if act == "relu":
@@ -117,49 +117,54 @@ class Resnet(nn.Module):
 
 
 class Discriminator(nn.Module):
-    def __init__(self, classes):
+    def __init__(self, classes, sn=False):
+        """ sn: spectral normalized convolutions and no instance norm, a 1-Lipschitz critic without a penalty """
         super(Discriminator, self).__init__()
         self.classes = classes
         self.conv = nn.Sequential(
             # 6,64,64
-            _conv_layer(4, 64, 4, 2, 1, norm=False),
+            _conv_layer(4, 64, 4, 2, 1, norm=False, sn=sn),
             # _pool_layer(2, 2, 0),
-            _conv_layer(64, 128, 4, 2, 1, bias=False),
+            _conv_layer(64, 128, 4, 2, 1, bias=sn, norm=not sn, sn=sn),
             # _pool_layer(2, 2, 0),
             # 128,16,16
-            _conv_layer(128, 256, 4, 2, 1, bias=False),
+            _conv_layer(128, 256, 4, 2, 1, bias=sn, norm=not sn, sn=sn),
             # _pool_layer(2, 2, 0),
-            _conv_layer(256, 512, 4, 1, 1, bias=False),
+            _conv_layer(256, 512, 4, 1, 1, bias=sn, norm=not sn, sn=sn),
             # 512,8,8
-            _conv_layer(512, 1, 4, 1, 1, norm=False),
+            _conv_layer(512, 1, 4, 1, 1, norm=False, sn=sn),
             # _conv_layer(128, 1, 3, 1, 1, bias=False),
             # 1,32,32
         )
         self.fc = nn.Sequential(nn.Linear(36, 100))
         self.label_layer = nn.Sequential(nn.Linear(100, self.classes), nn.LogSoftmax(dim=1))
 
-    def forward(self, x):
+    def forward(self, x, with_label=True):
+        """ with_label=False skips the class head and returns None in its place """
         x = self.conv(x)
+        if not with_label:
+            return x, None
         plabel = self.fc(x.view(x.shape[0], -1))
         plabel = self.label_layer(plabel)
         return x, plabel
 
 
 class Discriminator_post(nn.Module):
-    def __init__(self):
+    def __init__(self, sn=False):
+        """ sn: see Discriminator """
         super(Discriminator_post, self).__init__()
         self.conv = nn.Sequential(
             # 6,64,64
-            _conv_layer(3, 64, 4, 2, 1, norm=False),
+            _conv_layer(3, 64, 4, 2, 1, norm=False, sn=sn),
             # _pool_layer(2, 2, 0),
-            _conv_layer(64, 128, 4, 2, 1, bias=False),
+            _conv_layer(64, 128, 4, 2, 1, bias=sn, norm=not sn, sn=sn),
             # _pool_layer(2, 2, 0),
             # 128,16,16
-            _conv_layer(128, 256, 4, 2, 1, bias=False),
+            _conv_layer(128, 256, 4, 2, 1, bias=sn, norm=not sn, sn=sn),
             # _pool_layer(2, 2, 0),
-            _conv_layer(256, 512, 4, 1, 1, bias=False),
+            _conv_layer(256, 512, 4, 1, 1, bias=sn, norm=not sn, sn=sn),
             # 512,8,8
-            _conv_layer(512, 1, 4, 1, 1, norm=False),
+            _conv_layer(512, 1, 4, 1, 1, norm=False, sn=sn),
             # _conv_layer(128, 1, 3, 1, 1, bias=False),
             # 1,32,32
         )
@@ -183,9 +188,9 @@ def get_D(tag, **kwargs):
         if classes is None:
             print("dnn need parameter: classes")
             assert 0
-        return Discriminator(classes)
+        return Discriminator(classes, sn=kwargs.get("spectral_norm", False))
     elif tag == 'post':
-        return Discriminator_post()
+        return Discriminator_post(sn=kwargs.get("spectral_norm", False))
 
 
 if __name__ == "__main__":
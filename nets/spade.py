@@ -14,7 +14,7 @@ class SPADE(nn.Module):
         self.main_channel = main_channel
         self.n_hidden = 128
 
-        # self.batch = nn.SyncBatchNorm(self.main_channel)
+        # sync_spade_batchnorm turns it into a SyncBatchNorm for distributed training
         self.batch = nn.BatchNorm2d(self.main_channel)
 
         self.share_cov = nn.Sequential(
@@ -98,6 +98,17 @@ class SPADE_POOL(Module):
         return self.pool(x)
 
 
+def sync_spade_batchnorm(model, process_group=None):
+    """ the BatchNorm2d of every SPADE block in model as SyncBatchNorm, statistics over the batches of all processes
+    (tools/dist.py); SyncBatchNorm only runs on cuda. returns the number of converted blocks """
+    converted = 0
+    for module in model.modules():
+        if isinstance(module, SPADE) and isinstance(module.batch, nn.BatchNorm2d):
+            module.batch = nn.SyncBatchNorm.convert_sync_batchnorm(module.batch, process_group)
+            converted += 1
+    return converted
+
+
 if __name__ == "__main__":
     spade = SPADE_CONV(nn.Conv2d, 1, 64, 3, 1, 1)
     seg = torch.randn(32, 1, 64, 64)
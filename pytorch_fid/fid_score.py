@@ -51,6 +51,7 @@ except ImportError:
         return x
 
 from pytorch_fid.inception import InceptionV3
+from dataset.decode import BACKENDS, open_image, resolve_backend
 
 parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
 parser.add_argument('--batch-size', type=int, default=50,
@@ -63,6 +64,9 @@ parser.add_argument('--dims', type=int, default=2048,
                     choices=list(InceptionV3.BLOCK_INDEX_BY_DIM),
                     help=('Dimensionality of Inception features to use. '
                           'By default, uses pool3 features'))
+parser.add_argument('--decode-backend', type=str, default='pil',
+                    choices=BACKENDS + ['auto'],
+                    help='Image decoder, auto prefers turbojpeg, then cv2, then pil')
 parser.add_argument('path', type=str, nargs=2,
                     help=('Paths to the generated images or '
                           'to .npz statistic files'))
@@ -72,22 +76,24 @@ IMAGE_EXTENSIONS = {'bmp', 'jpg', 'jpeg', 'pgm', 'png', 'ppm',
 
 
 class ImagePathDataset(torch.utils.data.Dataset):
-    def __init__(self, files, transforms=None):
+    def __init__(self, files, transforms=None, backend='pil'):
         self.files = files
         self.transforms = transforms
+        self.backend = resolve_backend(backend)
 
     def __len__(self):
         return len(self.files)
 
     def __getitem__(self, i):
         path = self.files[i]
-        img = Image.open(path).convert('RGB')
+        img = open_image(path, self.backend).convert('RGB')
         if self.transforms is not None:
             img = self.transforms(img)
         return img
 
 
-def get_activations(files, model, batch_size=50, dims=2048, device='cpu', num_workers=8):
+def get_activations(files, model, batch_size=50, dims=2048, device='cpu', num_workers=8,
+                    backend='pil'):
     """Calculates the activations of the pool_3 layer for all images.
 
     Params:
@@ -101,6 +107,7 @@ def get_activations(files, model, batch_size=50, dims=2048, device='cpu', num_wo
     -- dims        : Dimensionality of features returned by Inception
     -- device      : Device to run calculations
     -- num_workers : Number of parallel dataloader workers
+    -- backend     : Image decoder, see dataset.decode
 
     Returns:
     -- A numpy array of dimension (num images, dims) that contains the
@@ -114,7 +121,7 @@ def get_activations(files, model, batch_size=50, dims=2048, device='cpu', num_wo
                'Setting batch size to data size'))
         batch_size = len(files)
 
-    dataset = ImagePathDataset(files, transforms=TF.ToTensor())
+    dataset = ImagePathDataset(files, transforms=TF.ToTensor(), backend=backend)
     dataloader = torch.utils.data.DataLoader(dataset,
                                              batch_size=batch_size,
                                              shuffle=False,
@@ -203,7 +210,7 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
 
 
 def calculate_activation_statistics(files, model, batch_size=50, dims=2048,
-                                    device='cpu', num_workers=8):
+                                    device='cpu', num_workers=8, backend='pil'):
     """Calculation of the statistics used by the FID.
     Params:
     -- files       : List of image files paths
@@ -214,6 +221,7 @@ def calculate_activation_statistics(files, model, batch_size=50, dims=2048,
     -- dims        : Dimensionality of features returned by Inception
     -- device      : Device to run calculations
     -- num_workers : Number of parallel dataloader workers
+    -- backend     : Image decoder, see dataset.decode
 
     Returns:
     -- mu    : The mean over samples of the activations of the pool_3 layer of
@@ -221,13 +229,15 @@ def calculate_activation_statistics(files, model, batch_size=50, dims=2048,
     -- sigma : The covariance matrix of the activations of the pool_3 layer of
                the inception model.
     """
-    act = get_activations(files, model, batch_size, dims, device, num_workers)
+    act = get_activations(files, model, batch_size, dims, device, num_workers,
+                          backend)
     mu = np.mean(act, axis=0)
     sigma = np.cov(act, rowvar=False)
     return mu, sigma
 
 
-def compute_statistics_of_path(path, model, batch_size, dims, device, num_workers=8):
+def compute_statistics_of_path(path, model, batch_size, dims, device, num_workers=8,
+                               backend='pil'):
     if path.endswith('.npz'):
         with np.load(path) as f:
             m, s = f['mu'][:], f['sigma'][:]
@@ -236,12 +246,14 @@ def compute_statistics_of_path(path, model, batch_size, dims, device, num_worker
         files = sorted([file for ext in IMAGE_EXTENSIONS
                        for file in path.glob('*.{}'.format(ext))])
         m, s = calculate_activation_statistics(files, model, batch_size,
-                                               dims, device, num_workers)
+                                               dims, device, num_workers,
+                                               backend)
 
     return m, s
 
 
-def calculate_fid_given_paths(paths, batch_size, device, dims, num_workers=8):
+def calculate_fid_given_paths(paths, batch_size, device, dims, num_workers=8,
+                              backend='pil'):
     """Calculates the FID of two paths"""
     for p in paths:
         if not os.path.exists(p):
@@ -252,9 +264,9 @@ def calculate_fid_given_paths(paths, batch_size, device, dims, num_workers=8):
     model = InceptionV3([block_idx]).to(device)
 
     m1, s1 = compute_statistics_of_path(paths[0], model, batch_size,
-                                        dims, device, num_workers)
+                                        dims, device, num_workers, backend)
     m2, s2 = compute_statistics_of_path(paths[1], model, batch_size,
-                                        dims, device, num_workers)
+                                        dims, device, num_workers, backend)
     fid_value = calculate_frechet_distance(m1, s1, m2, s2)
 
     return fid_value
@@ -272,7 +284,8 @@ def main():
                                           args.batch_size,
                                           device,
                                           args.dims,
-                                          args.num_workers)
+                                          args.num_workers,
+                                          args.decode_backend)
     print('FID: ', fid_value)
 
 
@@ -0,0 +1,16 @@
+import os
+import sys
+import pytest
+
+# the tools and datasets import each other from the repository root, like the scripts run with PYTHONPATH=..
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.make_fake_coco import parse_args, make_fake_coco  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def fake_coco(tmp_path_factory):
+    """ a small synthetic COCO directory with its cuts, indexes and objects.npz, see tools/make_fake_coco.py """
+    root = str(tmp_path_factory.mktemp("fake_coco"))
+    return make_fake_coco(parse_args([root, "--images", "24", "--splits", "train", "--class_nums", "1",
+                                      "--min_size", "160", "--max_size", "240"]))
@@ -0,0 +1,40 @@
+import torch
+import pytest
+from tools.amp import Amp, _grad_scaler, input_gradients
+
+
+def _penalty_gradients(scaler):
+    torch.manual_seed(0)
+    net = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.ReLU(), torch.nn.Conv2d(4, 1, 3))
+    x = torch.randn(2, 3, 8, 8, requires_grad=True)
+    return input_gradients(net(x), x, scaler)
+
+
+def test_scaled_input_gradients_match_fp32():
+    scaler = _grad_scaler('cpu', True)
+    assert torch.equal(_penalty_gradients(scaler), _penalty_gradients(None))
+
+
+def test_cpu_fp16_falls_back_to_bf16():
+    if torch.cuda.is_available():
+        pytest.skip("only on cpu")
+    assert Amp('fp16').mode == 'bf16'
+    assert Amp(False).mode == 'off'
+
+
+def test_scaler_state_round_trip():
+    amp = Amp(False)
+    amp.scalers['D'] = _grad_scaler('cpu', True)
+    w = torch.nn.Parameter(torch.ones(3))
+    opt = torch.optim.SGD([w], lr=0.1)
+    amp.backward((w * float('inf')).sum(), 'D')
+    amp.step(opt, 'D')  # an overflow lowers the scale
+    state = amp.state_dict()
+    assert state['D']['scale'] < 65536.0
+
+    resumed = Amp(False)
+    resumed.scalers['D'] = _grad_scaler('cpu', True)
+    resumed.load_state_dict(state)
+    assert resumed.scaler('D').get_scale() == amp.scaler('D').get_scale()
+    # without fp16 the scalers pass through and ignore the state
+    Amp(False).load_state_dict(state)
@@ -0,0 +1,83 @@
+import json
+import os
+import numpy as np
+import pytest
+from dataset.coco_index import open_coco_index, crop_mask, floor_bbox, window_mask
+
+pycocotools = pytest.importorskip("pycocotools.coco")
+
+
+@pytest.fixture(scope="module")
+def cocos(fake_coco):
+    annotation_file = os.path.join(fake_coco, "annotations", "instances_train2017.json")
+    return pycocotools.COCO(annotation_file), open_coco_index(annotation_file)
+
+
+@pytest.mark.parametrize("cat_ids, iscrowd", [(None, None), ([1, 19], None), (None, False), ([22], True)])
+def test_load_anns_matches_coco(cocos, cat_ids, iscrowd):
+    coco, index = cocos
+    for img_id in coco.getImgIds():
+        expected = coco.loadAnns(coco.getAnnIds(imgIds=img_id, catIds=cat_ids or [], iscrowd=iscrowd))
+        anns = index.load_anns(img_id, cat_ids=cat_ids, iscrowd=iscrowd)
+        assert [a['id'] for a in anns] == [a['id'] for a in expected]
+        for ann, ref in zip(anns, expected):
+            assert ann['category_id'] == ref['category_id']
+            assert ann['iscrowd'] == ref['iscrowd']
+            assert ann['bbox'] == floor_bbox(ref['bbox'])
+            assert ann['area'] == pytest.approx(ref['area'], rel=1e-6)
+            x0, y0, w, h = ann['bbox']
+            assert np.array_equal(index.ann_mask(ann), crop_mask(coco.annToMask(ref), x0, y0, w, h))
+
+
+def test_window_mask_matches_ann_to_mask(cocos):
+    coco, _ = cocos
+    for ref in coco.loadAnns(coco.getAnnIds()):
+        x0, y0, w, h = floor_bbox(ref['bbox'])
+        # the floored box and one reaching past the image
+        for window in [(x0, y0, w, h), (x0 - 3, y0 - 2, w + 7, h + 5)]:
+            assert np.array_equal(window_mask(coco, ref, *window), crop_mask(coco.annToMask(ref), *window))
+
+
+def paint_instances(coco, img_id, cat_ids=None):
+    """ the reference instance map: annToMask of every non-crowd annotation drawn in order """
+    img = coco.loadImgs(img_id)[0]
+    out = np.zeros([img['height'], img['width']], dtype=np.uint16)
+    for k, ann in enumerate(coco.loadAnns(coco.getAnnIds(imgIds=img_id, catIds=cat_ids or [], iscrowd=False))):
+        out[coco.annToMask(ann) > 0] = k + 1
+    return out
+
+
+def test_instance_map_matches_painter(cocos):
+    coco, index = cocos
+    for img_id in coco.getImgIds():
+        assert np.array_equal(index.instance_map(img_id), paint_instances(coco, img_id))
+
+
+def test_instance_map_tight_float_bboxes(tmp_path):
+    """ real coco bboxes are the float extents of the polygons, the floored box misses the last column or row of
+    the rasterized mask """
+    rng = np.random.RandomState(0)
+    images, annotations = [], []
+    for img_id in range(1, 9):
+        H, W = 60 + 7 * img_id, 80 - 3 * img_id
+        images.append({'id': img_id, 'file_name': "{:012d}.jpg".format(img_id), 'height': H, 'width': W})
+        for _ in range(6):
+            cx, cy, r = rng.uniform(0, W), rng.uniform(0, H), rng.uniform(2, 15)
+            angles = np.sort(rng.uniform(0, 2 * np.pi, 7))
+            xs = np.clip(cx + r * np.cos(angles), 0, W) + rng.choice([0, .3, .7], 7)
+            ys = np.clip(cy + r * np.sin(angles), 0, H) + rng.choice([0, .3, .7], 7)
+            xs, ys = np.minimum(xs, W), np.minimum(ys, H)
+            bbox = [xs.min(), ys.min(), xs.max() - xs.min(), ys.max() - ys.min()]
+            annotations.append({'id': len(annotations) + 1, 'image_id': img_id, 'category_id': 1, 'iscrowd': 0,
+                                'segmentation': [np.stack([xs, ys], 1).reshape(-1).round(2).tolist()],
+                                'bbox': [round(float(x), 2) for x in bbox], 'area': float(bbox[2] * bbox[3])})
+    annotation_file = str(tmp_path / "instances_tight.json")
+    with open(annotation_file, "w") as f:
+        json.dump({'images': images, 'annotations': annotations,
+                   'categories': [{'id': 1, 'name': "thing", 'supercategory': "thing"}]}, f)
+    coco, index = pycocotools.COCO(annotation_file), open_coco_index(annotation_file)
+    for img_id in coco.getImgIds():
+        assert np.array_equal(index.instance_map(img_id), paint_instances(coco, img_id))
+        for ann, ref in zip(index.load_anns(img_id), coco.loadAnns(coco.getAnnIds(imgIds=img_id))):
+            x0, y0, w, h = ann['bbox']
+            assert np.array_equal(index.ann_mask(ann), crop_mask(coco.annToMask(ref), x0, y0, w, h))
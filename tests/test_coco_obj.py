@@ -0,0 +1,61 @@
+import os
+import numpy as np
+import pytest
+import torch
+from dataset.coco_pack import write_pack, read_data_list
+from dataset.data_builder import coco_obj_dataset, coco_obj_packed_dataset, select_classes
+from dataset.obj_index import read_obj_index, select_objects
+
+CLASSES = [1, 19, 22, 24]
+
+
+@pytest.fixture(scope="module")
+def packed(fake_coco):
+    write_pack(fake_coco, [32, 64])
+    return fake_coco
+
+
+def _batch(dataset):
+    return [torch.stack(x) for x in zip(*[dataset[i] for i in range(len(dataset))])]
+
+
+def test_packed_matches_files(packed):
+    files = coco_obj_dataset(packed, classes=CLASSES, image_size=64)
+    pack = coco_obj_packed_dataset(packed, classes=CLASSES, image_size=64)
+    assert len(files) == len(pack) > 0
+    for i in range(len(files)):
+        for x, y in zip(files[i], pack[i]):
+            assert x.shape == y.shape
+            assert torch.allclose(x.float(), y.float(), atol=1e-6)
+
+
+def test_unpacked_size_fails_at_construction(packed):
+    with pytest.raises(ValueError):
+        coco_obj_packed_dataset(packed, classes=CLASSES, image_size=48)
+    # batch_transform resizes from the closest packed size
+    assert coco_obj_packed_dataset(packed, classes=CLASSES, image_size=48, batch_transform=True).pack_size == 64
+
+
+@pytest.mark.parametrize("packed_data", [False, True])
+def test_uint8_batches_match_float(packed, packed_data):
+    dataset = coco_obj_packed_dataset if packed_data else coco_obj_dataset
+    floats = dataset(packed, classes=CLASSES, image_size=64)
+    uint8 = dataset(packed, classes=CLASSES, image_size=64, batch_transform=True)
+    batch = uint8.batch_transform(_batch(uint8))
+    for x, y in zip(_batch(floats), batch):
+        assert x.shape == y.shape
+        assert torch.allclose(x.float(), y.float(), atol=1e-6)
+
+
+@pytest.mark.parametrize("classes", [[1], [19, 22], CLASSES, [1, 2, 3, 90]])
+@pytest.mark.parametrize("cap", [None, 0, 2, 10000])
+def test_select_objects_matches_select_classes(fake_coco, classes, cap):
+    cut_dir = os.path.join(fake_coco, "train_cut")
+    objects = read_obj_index(cut_dir)
+    assert objects is not None
+    names, obj_ids, class_nums = read_data_list(os.path.join(cut_dir, "data_list.txt"))
+    assert list(objects['names']) == names
+    rows, labels = select_objects(objects, classes, cap)
+    expected_rows, expected_labels = select_classes(class_nums, classes, cap)
+    assert np.array_equal(rows, expected_rows)
+    assert np.array_equal(labels, expected_labels)
@@ -0,0 +1,46 @@
+import torch
+import pytest
+from dataset.sampler import RandomPermutationSampler, ClassBalancedSampler
+
+LABELS = torch.tensor([0] * 11 + [1] * 5 + [2] * 2 + [3] * 1)
+
+
+def _samplers():
+    return [lambda: RandomPermutationSampler(len(LABELS), seed=3),
+            lambda: ClassBalancedSampler(LABELS, mode='quota', per_class=6, seed=3),
+            lambda: ClassBalancedSampler(LABELS, mode='temperature', temperature=2, epoch_size=23, seed=3)]
+
+
+@pytest.mark.parametrize("make", _samplers())
+@pytest.mark.parametrize("consumed", [0, 4, 9])
+def test_resume_matches_uninterrupted(make, consumed):
+    uninterrupted = make()
+    epochs = [list(uninterrupted) for _ in range(3)]
+
+    interrupted = make()
+    list(interrupted)
+    partial = iter(interrupted)
+    taken = [next(partial) for _ in range(consumed)]
+    state = interrupted.state_dict(consumed)
+
+    resumed = make()
+    resumed.load_state_dict(state)
+    assert taken + list(resumed) == epochs[1]
+    assert list(resumed) == epochs[2]
+
+
+@pytest.mark.parametrize("make", _samplers())
+@pytest.mark.parametrize("world_size", [2, 3])
+def test_shards_cover_the_epoch(make, world_size):
+    full = list(make())
+    parts = []
+    for rank in range(world_size):
+        sampler = make()
+        sampler.shard(rank, world_size)
+        part = list(sampler)
+        assert len(part) == len(sampler) == -(-len(full) // world_size)
+        parts.append(part)
+    # interleaved again, the padding repeats the first indices of the epoch
+    merged = [part[k] for k in range(len(parts[0])) for part in parts]
+    assert merged[:len(full)] == full
+    assert merged[len(full):] == full[:len(merged) - len(full)]
@@ -0,0 +1,84 @@
+import torch
+from torch import autograd
+
+# opt-in mixed precision for the training loops, `amp` in config.yaml:
+#   False / off (default): fp32 as before
+#   fp16: autocast to float16 with dynamic loss scaling, one GradScaler per optimizer
+#   bf16: autocast to bfloat16, same range as fp32 so no scaling; what fp16 falls back to on cpu
+#   True / auto: fp16 on cuda, bf16 on cpu
+# weights and optimizer states stay fp32. the losses are taken on fp32 copies of the network outputs, the WGAN critic
+# values are unbounded, and the gradient penalty unscales its input gradients and takes their norm in fp32
+# (input_gradients). a step whose scaled gradients overflow is skipped by its GradScaler and the scale lowered
+
+
+def _grad_scaler(device_type, enabled):
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device_type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+class Amp(object):
+    def __init__(self, mode=False):
+        self.device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+        # yaml reads off/on as booleans
+        if mode is None or mode is False:
+            mode = 'off'
+        if mode is True:
+            mode = 'auto'
+        if mode == 'auto':
+            mode = 'fp16' if self.device_type == 'cuda' else 'bf16'
+        if mode not in ['off', 'fp16', 'bf16']:
+            print("unknown amp mode: {}, choose from off, fp16, bf16, auto".format(mode))
+            assert 0
+        if mode == 'fp16' and self.device_type == 'cpu':
+            print("fp16 autocast needs cuda, using bf16")
+            mode = 'bf16'
+        self.mode = mode
+        self.dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(mode, None)
+        self.scalers = {}
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def scaler(self, name):
+        """ the GradScaler of one optimizer, a pass-through unless fp16 """
+        if name not in self.scalers:
+            self.scalers[name] = _grad_scaler(self.device_type, self.mode == 'fp16')
+        return self.scalers[name]
+
+    def backward(self, loss, name):
+        self.scaler(name).scale(loss).backward()
+
+    def step(self, optimizer, name):
+        scaler = self.scaler(name)
+        scaler.step(optimizer)
+        scaler.update()
+
+    def state_dict(self):
+        """ scale and growth tracker of every active GradScaler, saved next to the optimizer states so a resumed
+        fp16 run does not start over from the initial scale """
+        return {name: scaler.state_dict() for name, scaler in self.scalers.items() if scaler.is_enabled()}
+
+    def load_state_dict(self, state):
+        # a pass-through scaler (not fp16) ignores the state
+        for name, scaler_state in state.items():
+            self.scaler(name).load_state_dict(scaler_state)
+
+
+def input_gradients(outputs, inputs, scaler=None):
+    """ d sum(outputs) / d inputs with create_graph, for the gradient penalty, returned in fp32. with an active
+    scaler the outputs are scaled first so small fp16 gradients survive the backward, and unscaled after """
+    scale = None
+    if scaler is not None and scaler.is_enabled():
+        scale = scaler.scale(torch.ones([], device=outputs.device))
+        outputs = outputs * scale
+    gradients = autograd.grad(outputs=outputs, inputs=inputs, grad_outputs=torch.ones_like(outputs),
+                              create_graph=True, retain_graph=True, only_inputs=True)[0]
+    gradients = gradients.float()
+    if scale is not None:
+        gradients = gradients / scale
+    return gradients
@@ -0,0 +1,110 @@
+import time
+import json
+import platform
+import argparse
+import torch
+from nets.discriminator import get_D
+from tools.amp import Amp, input_gradients
+from tools.critic import critic_pass, PenaltySchedule
+
+# cost of one critic step (forward, penalty, backward, optimizer step) for every way of keeping the critic Lipschitz,
+# on random batches so the data pipeline and G are left out, e.g.
+#   python bench_critic.py --critics dnn post --bs 32 --image_size 64 --output critic.json
+# modes:
+#   gp:            three critic forwards and the gradient penalty on every step, what the training scripts do by default
+#   lazy_gp:       the penalty every --gp_interval steps (gp_interval in config.yaml)
+#   fused_gp:      real, fake and interpolates in one forward (fused_critic in config.yaml)
+#   fused_lazy_gp: both
+#   sn:            spectral normalized critic without a penalty (spectral_norm in config.yaml)
+#   none:          no penalty at all, the lower bound
+MODES = ['gp', 'lazy_gp', 'fused_gp', 'fused_lazy_gp', 'sn', 'none']
+
+
+def separate_pass(D, real, fake, cond, gp_lambda, scaler, with_label, penalty):
+    """ the unfused critic step of train.py / synthesis_train.py """
+    def forward(x):
+        if cond is not None:
+            x = torch.cat([cond, x], 1)
+        return D(x, with_label=with_label)[0] if with_label is not None else D(x)
+
+    real_validity, fake_validity = forward(real), forward(fake.detach())
+    gradient_penalty = torch.zeros([], device=real.device)
+    if penalty:
+        alpha = torch.rand(real.shape[0], 1, 1, 1).to(real.device)
+        interpolates = (alpha * real + (1 - alpha) * fake.detach()).detach()
+        interpolates.requires_grad = True
+        gradients = input_gradients(forward(interpolates), interpolates, scaler)
+        gradients = gradients.view(gradients.shape[0], -1)
+        gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean() * gp_lambda
+    return real_validity, fake_validity, gradient_penalty
+
+
+def bench(args, critic, mode, device):
+    D = get_D(critic, classes=args.classes, spectral_norm=mode == 'sn').to(device)
+    opt = torch.optim.Adam(D.parameters(), lr=1e-4, betas=(0.5, 0.9))
+    amp = Amp(args.amp)
+    size = [args.bs, 3, args.image_size, args.image_size]
+    real, fake = torch.randn(size, device=device), torch.randn(size, device=device)
+    # the pix2pix critic sees the mask in front of the image and validity only (the single class case)
+    cond = torch.randn([args.bs, 1, args.image_size, args.image_size], device=device) if critic == 'dnn' else None
+    with_label = False if critic == 'dnn' else None
+    interval = {'lazy_gp': args.gp_interval, 'fused_lazy_gp': args.gp_interval, 'sn': 0, 'none': 0}.get(mode, 1)
+    schedule = PenaltySchedule(10., interval)
+    times = []
+    for k in range(args.warmup + args.steps):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        opt.zero_grad()
+        penalty, gp_lambda = schedule.next()
+        with amp.autocast():
+            if mode.startswith('fused'):
+                real_validity, fake_validity, _, _, gradient_penalty = critic_pass(
+                    D, real, fake, cond, gp_lambda, amp.scaler('D'), with_label=with_label, penalty=penalty)
+            else:
+                real_validity, fake_validity, gradient_penalty = separate_pass(
+                    D, real, fake, cond, gp_lambda, amp.scaler('D'), with_label, penalty)
+            loss = fake_validity.float().mean() - real_validity.float().mean() + gradient_penalty
+        amp.backward(loss, 'D')
+        amp.step(opt, 'D')
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        if k >= args.warmup:
+            times.append(time.perf_counter() - start)
+    times = sorted(times)
+    return {'critic': critic, 'mode': mode, 'amp': amp.mode, 'bs': args.bs, 'image_size': args.image_size,
+            'device': device.type, 'mean_ms': sum(times) / len(times) * 1000, 'p50_ms': times[len(times) // 2] * 1000}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--critics", type=str, nargs='+', default=['dnn', 'post'])
+    parser.add_argument("--modes", type=str, nargs='+', default=MODES, choices=MODES)
+    parser.add_argument("--bs", type=int, default=32)
+    parser.add_argument("--image_size", type=int, default=64)
+    parser.add_argument("--classes", type=int, default=2, help="class head size of the dnn critic")
+    parser.add_argument("--gp_interval", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--amp", type=str, default='off', help="off, fp16, bf16 or auto, see tools/amp.py")
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    results = []
+    for critic in args.critics:
+        base = None
+        for mode in args.modes:
+            result = bench(args, critic, mode, device)
+            results.append(result)
+            base = result['mean_ms'] if base is None else base
+            print("{}/{}: {:.2f} ms per critic step, p50 {:.2f} ms ({:.2f}x of {})".format(
+                critic, mode, result['mean_ms'], result['p50_ms'], result['mean_ms'] / base, args.modes[0]))
+
+    if args.output is not None:
+        report = {'host': platform.node(), 'time': time.strftime("%Y-%m-%d %H:%M:%S"), 'torch': torch.__version__,
+                  'args': vars(args), 'results': results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("written to {}".format(args.output))
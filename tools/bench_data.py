@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import platform
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset
+from torch.utils.data.dataloader import default_collate
+from dataset.data_builder import build_data
+from dataset.decode import available_backends, decode_stats
+
+# throughput of the build_data pipelines on this host, e.g.
+#   python bench_data.py ../data --tags coco_obj facades --workers 0 2 4 8 --batch_sizes 32 64 --output bench.json
+#   python bench_data.py ../data --tags coco_obj --compare bench.json
+# for every tag, worker count, batch size and decode backend: samples/s and p50/p99 of the time spent waiting
+# for a batch. a single process profile per tag and backend splits the time of one batch into decode,
+# transform (the rest of __getitem__), collate and batch_transform
+
+
+def make_loader(args, tag, batch_size, num_worker, backend):
+    kwargs = {'classes': args.classes, 'image_size': args.image_size, 'batch_transform': args.batch_transform,
+              'packed': args.packed, 'shards': args.shards, 'decode_backend': backend,
+              'loader': {'pin_memory': args.pin_memory, 'persistent_workers': False,
+                         'prefetch_factor': args.prefetch_factor}}
+    path = args.data_path
+    if tag == 'coco_synthesis':
+        path = os.path.join(args.data_path, "COCO", "results_coco_train_{}".format(len(args.classes)))
+        if not args.shards:
+            # loading the synthesis data needs the generator it was built with, see synthesis_train.py
+            from tools.single_obj import SingleObj, open_config
+            kwargs['obj_model'] = SingleObj(open_config(args.obj_root), args.obj_root)
+    return build_data(tag, path, batch_size, True, num_worker, **kwargs)
+
+
+def measure(loader, batches, warmup):
+    """ seconds waited for each batch after the first `warmup` ones, and the samples they held """
+    waits = []
+    samples = 0
+    it = iter(loader)
+    for k in range(warmup + batches):
+        start = time.perf_counter()
+        try:
+            batch = next(it)
+        except StopIteration:
+            break
+        if k >= warmup:
+            waits.append(time.perf_counter() - start)
+            samples += len(batch[0])
+    del it
+    return waits, samples
+
+
+def profile(loader, batch_size):
+    """ one batch assembled in this process, the time split per stage in ms """
+    dataloader = loader
+    while hasattr(dataloader, 'dataloader'):  # BatchTransformLoader, DevicePrefetcher
+        dataloader = dataloader.dataloader
+    dataset = dataloader.dataset
+    decode_stats(reset=True)
+    start = time.perf_counter()
+    if isinstance(dataset, IterableDataset):
+        items = []
+        for item in dataset:
+            items.append(item)
+            if len(items) >= batch_size:
+                break
+    else:
+        items = [dataset[i] for i in range(min(batch_size, len(dataset)))]
+    getitem = time.perf_counter() - start
+    decode = sum(seconds for count, seconds, speed in decode_stats(reset=True).values())
+    start = time.perf_counter()
+    batch = default_collate(items)
+    collate = time.perf_counter() - start
+    batch_transform = 0.
+    if getattr(dataset, 'uint8', False):
+        start = time.perf_counter()
+        dataset.batch_transform(batch)
+        batch_transform = time.perf_counter() - start
+    return {'samples': len(items), 'decode_ms': decode * 1000, 'transform_ms': (getitem - decode) * 1000,
+            'collate_ms': collate * 1000, 'batch_transform_ms': batch_transform * 1000}
+
+
+def mode(args):
+    flags = [name for name in ['packed', 'shards', 'batch_transform'] if getattr(args, name)]
+    return '+'.join(flags) if len(flags) > 0 else 'files'
+
+
+def key(result):
+    return "{}[{}]/{}/w{}/bs{}".format(result['tag'], result['mode'], result['backend'], result['workers'],
+                                       result['batch_size'])
+
+
+def compare(results, path):
+    with open(path) as f:
+        old = {key(r): r for r in json.load(f)['results']}
+    print("compared with {}".format(path))
+    for result in results:
+        if key(result) in old and old[key(result)]['samples_per_s'] > 0:
+            print("{}: {:.1f} -> {:.1f} samples/s ({:+.1f}%)".format(
+                key(result), old[key(result)]['samples_per_s'], result['samples_per_s'],
+                (result['samples_per_s'] / old[key(result)]['samples_per_s'] - 1) * 100))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", type=str)
+    parser.add_argument("--tags", type=str, nargs='+', default=['cifar10', 'facades', 'coco_obj', 'coco_synthesis'])
+    parser.add_argument("--workers", type=int, nargs='+', default=[0, 2, 4, 8])
+    parser.add_argument("--batch_sizes", type=int, nargs='+', default=[32])
+    parser.add_argument("--backends", type=str, nargs='+', default=['pil'],
+                        help="decode backends, 'all' for every installed one")
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--classes", type=int, nargs='+', default=[1])
+    parser.add_argument("--image_size", type=int, default=64)
+    parser.add_argument("--batch_transform", default=False, action='store_true')
+    parser.add_argument("--packed", default=False, action='store_true')
+    parser.add_argument("--shards", default=False, action='store_true')
+    parser.add_argument("--pin_memory", default=False, action='store_true')
+    parser.add_argument("--prefetch_factor", type=int, default=None)
+    parser.add_argument("--obj_root", type=str, default='../experiments/pix2pix_person',
+                        help="generator of the coco_synthesis data")
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--compare", type=str, default=None)
+    args = parser.parse_args()
+    backends = available_backends() if args.backends == ['all'] else args.backends
+
+    results, profiles = [], []
+    for tag in args.tags:
+        for backend in backends:
+            for batch_size in args.batch_sizes:
+                for num_worker in args.workers:
+                    loader = make_loader(args, tag, batch_size, num_worker, backend)
+                    waits, samples = measure(loader, args.batches, args.warmup)
+                    if len(waits) == 0:
+                        print("{}: not enough batches for warmup {}".format(tag, args.warmup))
+                        continue
+                    result = {'tag': tag, 'mode': mode(args), 'backend': backend, 'workers': num_worker, 'batch_size': batch_size,
+                              'batches': len(waits), 'samples_per_s': samples / sum(waits),
+                              'p50_ms': float(np.percentile(waits, 50)) * 1000,
+                              'p99_ms': float(np.percentile(waits, 99)) * 1000}
+                    results.append(result)
+                    print("{}: {:.1f} samples/s, p50 {:.2f} ms, p99 {:.2f} ms".format(
+                        key(result), result['samples_per_s'], result['p50_ms'], result['p99_ms']))
+            split = profile(make_loader(args, tag, args.batch_sizes[0], 0, backend), args.batch_sizes[0])
+            split.update({'tag': tag, 'mode': mode(args), 'backend': backend})
+            profiles.append(split)
+            print("{}/{} one batch of {}: decode {:.1f} ms, transform {:.1f} ms, collate {:.1f} ms, "
+                  "batch_transform {:.1f} ms".format(tag, backend, split['samples'], split['decode_ms'],
+                                                     split['transform_ms'], split['collate_ms'],
+                                                     split['batch_transform_ms']))
+
+    report = {'host': platform.node(), 'time': time.strftime("%Y-%m-%d %H:%M:%S"), 'torch': torch.__version__,
+              'cpus': os.cpu_count(), 'args': vars(args), 'results': results, 'profiles': profiles}
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("written to {}".format(args.output))
+    if args.compare is not None:
+        compare(results, args.compare)
@@ -1,13 +1,16 @@
 import os
 import argparse
 import warnings
-from pycocotools.coco import COCO
+from dataset.coco_index import open_coco_index
+from dataset.decode import BACKENDS, open_image, resolve_backend
+from dataset.obj_index import write_obj_index, OBJ_INDEX
 import numpy as np
 from PIL import Image, ImageOps
 import skimage.io as io
 from skimage import transform
 from skimage.draw import polygon
 from tqdm import tqdm
+from multiprocessing import Pool
 from matplotlib import pyplot as plt
 import math
 import sys
@@ -25,83 +28,139 @@ classes = {1: 'person', 2: 'bicycle', 3: 'car', 4: 'motorcycle', 5: 'airplane',
            81: 'sink', 82: 'refrigerator', 84: 'book', 85: 'clock', 86: 'vase', 87: 'scissors', 88: 'teddy bear',
            89: 'hair drier', 90: 'toothbrush'}
 
-if __name__ == "__main__":
-    assert len(sys.argv) == 2
-    data_path = sys.argv[1]
-    print("loading data from: {}".format(data_path))
+# set in every worker process by _init_worker
+_job = None
 
-    pre = "val"
 
-    warnings.filterwarnings("ignore")
-    annotation_dir = os.path.join(data_path, "annotations", "instances_{}2017.json".format(pre))
-    coco = COCO(annotation_dir)
-    input_dir = os.path.join(data_path, "{}_image".format(pre))
-    output_dir = os.path.join(data_path, "{}_cut".format(pre))
-    input_label_dir = os.path.join(data_path, "{}_label".format(pre))
-    output_label_dir = os.path.join(data_path, "{}_label_cut".format(pre))
-    output_mask_dir = os.path.join(data_path, "{}_mask_cut".format(pre))
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
-    if not os.path.exists(output_label_dir):
-        os.mkdir(output_label_dir)
-    data_list_file = open(os.path.join(output_dir, "data_list.txt"), "w")
-
-    cats = coco.loadCats(coco.getCatIds())
-    imgIds = coco.getImgIds(catIds=coco.getCatIds(cats))
-    for ix in tqdm(range(len(imgIds))):
-        id = imgIds[ix]
-        img_dict = coco.loadImgs(id)[0]
-        filename = img_dict["file_name"]
-        image_path = os.path.join(input_dir, filename)
-        filename = filename[0:-4] + '.png'
-        label_path = os.path.join(input_label_dir, filename)
-        img = Image.open(image_path)
-        label = Image.open(label_path)
-        annIds = coco.getAnnIds(imgIds=id, catIds=[], iscrowd=False)
-        anns = coco.loadAnns(annIds)
-        '''
-        plt.axis('off')
-        plt.clf()
-        plt.imshow(img)
-        coco.showAnns(anns)
-        plt.show()
-        '''
+def _init_worker(job):
+    global _job
+    _job = dict(job)
+    _job['coco'] = open_coco_index(job['annotation_file'])
+
+
+def _save_atomic(image, path):
+    # a killed worker never leaves a truncated png behind, so existing files can be skipped on the next run
+    image.save(path + ".tmp", format="PNG")
+    os.replace(path + ".tmp", path)
+
+
+def cut_images(ids):
+    """ cut the objects of some images, returns their data_list lines; also appended to this worker's fragment.
+    image and label are decoded once per image and only when one of their crops is missing """
+    coco = _job['coco']
+    lines = []
+    for id in ids:
+        # size and border filters run over the index columns, masks are only decoded for the objects that pass
+        anns = coco.load_anns(id, cat_ids=_job['classes'], iscrowd=False, min_size=_job['min_size'],
+                              border=_job['border'])
+        if len(anns) == 0:
+            continue
+        file_name = coco.load_img(id)['file_name']
+        sources = {}
         for ann in anns:
+            obj_name = str(id) + "_" + str(ann['id']) + ".png"
             bbox = ann['bbox']
-            for i in range(4):
-                bbox[i] = math.floor(bbox[i])
             bbox[2] += bbox[0]
             bbox[3] += bbox[1]
-            mask = coco.annToMask(ann) * 255
-            mask = Image.fromarray(mask)
-
-            obj_mask = mask.crop(bbox)
-            # obj = img.crop(bbox)
-            obj_label = label.crop(bbox)
-
-            W, H = label.size
-            w, h = obj_label.size
-            if w < 64 or h < 64:
-                continue
-            if bbox[0] < 5 or bbox[1] < 5 or bbox[2] >= W - 5 or bbox[3] >= H - 5:
-                continue
-            # obj = np.array(obj)
-            # obj_label = np.array(obj_label)
-
-            # obj_label = np.array([255]) - obj_label
-            # obj_label = (obj_label) * obj_mask
-            # if len(obj.shape) == 3:
-            #    obj_mask = np.expand_dims(obj_mask, axis=2)
-            # obj = obj * obj_mask
-            # obj = ImageOps.invert(Image.fromarray(obj))
-            # obj_label = Image.fromarray(obj_label)
+            for part in _job['parts']:
+                obj_path = os.path.join(_job['output_dirs'][part], obj_name)
+                if os.path.exists(obj_path):
+                    continue
+                if part == 'mask':
+                    _save_atomic(Image.fromarray(coco.ann_mask(ann) * 255), obj_path)
+                    continue
+                if part not in sources:
+                    source_path = os.path.join(_job['input_dirs'][part], file_name)
+                    if part == 'label':
+                        source_path = os.path.splitext(source_path)[0] + ".png"
+                    sources[part] = open_image(source_path, _job['decode_backend'])
+                _save_atomic(sources[part].crop(bbox), obj_path)
+            lines.append("{} {} {}".format(obj_name, ann['category_id'], classes[ann['category_id']]))
+    with open(os.path.join(_job['output_dir'], "data_list.part-{}.txt".format(os.getpid())), "a") as f:
+        for line in lines:
+            print(line, file=f)
+    return lines
 
-            obj_name = str(id) + "_" + str(ann['id']) + ".png"
 
-            # obj_path = os.path.join(output_dir, obj_name)
-            # obj_label_path = os.path.join(output_label_dir, obj_name)
-            obj_mask_path = os.path.join(output_mask_dir, obj_name)
-            # obj.save(obj_path)
-            # obj_label.save(obj_label_path)
-            obj_mask.save(obj_mask_path)
-            print(obj_name, ann['category_id'], classes[ann['category_id']], file=data_list_file)
+def merge_data_list(output_dir, coco):
+    """ data_list.txt from the worker fragments, in annotation order of the index whatever the worker count """
+    rank = {int(ann_id): k for k, ann_id in enumerate(coco.ann_ids)}
+    lines = set()
+    fragments = [f for f in os.listdir(output_dir) if f.startswith("data_list.part-")]
+    for fragment in fragments:
+        with open(os.path.join(output_dir, fragment)) as f:
+            lines.update(line.rstrip('\n') for line in f if len(line.strip()) > 0)
+    lines = sorted(lines, key=lambda line: rank[int(line.split(' ')[0].split('.')[0].split('_')[1])])
+    with open(os.path.join(output_dir, "data_list.txt"), "w") as f:
+        for line in lines:
+            print(line, file=f)
+    for fragment in fragments:
+        os.remove(os.path.join(output_dir, fragment))
+    return len(lines)
+
+
+def cut_split(data_path, split="val", cut_classes=None, min_size=64, border=5, workers=0, chunk=64,
+              parts=('image', 'label', 'mask'), decode_backend='pil'):
+    """ {split}_cut, {split}_label_cut and {split}_mask_cut crops of every object that passes the filters, parts
+    picks which of them are written; data_list.txt and objects.npz list the objects either way """
+    annotation_file = os.path.join(data_path, "annotations", "instances_{}2017.json".format(split))
+    coco = open_coco_index(annotation_file)
+    job = {
+        'annotation_file': annotation_file,
+        'classes': cut_classes,
+        'min_size': min_size,
+        'border': border,
+        'parts': list(parts),
+        'decode_backend': resolve_backend(decode_backend),
+        'input_dirs': {'image': os.path.join(data_path, "{}_image".format(split)),
+                       'label': os.path.join(data_path, "{}_label".format(split))},
+        'output_dirs': {'image': os.path.join(data_path, "{}_cut".format(split)),
+                        'label': os.path.join(data_path, "{}_label_cut".format(split)),
+                        'mask': os.path.join(data_path, "{}_mask_cut".format(split))},
+    }
+    job['output_dir'] = job['output_dirs']['image']
+    for d in job['output_dirs'].values():
+        if not os.path.exists(d):
+            os.mkdir(d)
+    # fragments of an interrupted run are dropped, its finished objects are skipped below instead
+    for f in os.listdir(job['output_dir']):
+        if f.startswith("data_list.part-"):
+            os.remove(os.path.join(job['output_dir'], f))
+
+    # images with at least one annotation
+    imgIds = [int(x) for x in coco.image_ids[np.diff(coco.ann_start) > 0]]
+    chunks = [imgIds[k:k + chunk] for k in range(0, len(imgIds), chunk)]
+    bar = tqdm(total=len(imgIds))
+    if workers > 0:
+        with Pool(workers, initializer=_init_worker, initargs=(job,)) as pool:
+            for ids, _ in zip(chunks, pool.imap_unordered(cut_images, chunks)):
+                bar.update(len(ids))
+    else:
+        _init_worker(job)
+        for ids in chunks:
+            cut_images(ids)
+            bar.update(len(ids))
+    bar.close()
+    count = merge_data_list(job['output_dir'], coco)
+    write_obj_index(job['output_dir'], coco)
+    print("{} objects in {} and {}".format(count, os.path.join(job['output_dir'], "data_list.txt"), OBJ_INDEX))
+
+
+# python coco_cut.py ../data/COCO --split train --workers 16
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", type=str)
+    parser.add_argument("--split", type=str, default="val", choices=["train", "val"])
+    parser.add_argument("--classes", type=int, nargs='+', default=None, help="coco category ids, all by default")
+    parser.add_argument("--min_size", type=int, default=64, help="smallest object width and height")
+    parser.add_argument("--border", type=int, default=5, help="objects closer to the image border are skipped")
+    parser.add_argument("--parts", type=str, nargs='+', default=['image', 'label', 'mask'],
+                        choices=['image', 'label', 'mask'], help="which crops to write")
+    parser.add_argument("--decode-backend", type=str, default='pil', choices=BACKENDS + ['auto'])
+    parser.add_argument("--workers", type=int, default=0)
+    args = parser.parse_args()
+    print("loading data from: {}".format(args.data_path))
+
+    warnings.filterwarnings("ignore")
+    cut_split(args.data_path, args.split, args.classes, args.min_size, args.border, args.workers,
+              parts=args.parts, decode_backend=args.decode_backend)
@@ -0,0 +1,17 @@
+import os
+import argparse
+from dataset.coco_index import build_coco_index, index_dir
+
+# one-time conversion of the coco annotations into the compact index read by the data pipeline:
+#   python coco_index.py ../data/COCO --splits train val
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", type=str)
+    parser.add_argument("--splits", type=str, nargs='+', default=["train", "val"])
+    args = parser.parse_args()
+    for split in args.splits:
+        annotation_file = os.path.join(args.data_path, "annotations", "instances_{}2017.json".format(split))
+        if os.path.exists(index_dir(annotation_file)):
+            print("{} already exists".format(index_dir(annotation_file)))
+            continue
+        build_coco_index(annotation_file)
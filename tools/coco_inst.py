@@ -0,0 +1,77 @@
+import os
+import argparse
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+from multiprocessing import Pool
+from dataset.coco_index import open_coco_index
+
+# instance maps of the coco images from the annotation index, one 16 bit png per image with annotations:
+#   COCO/{split}_inst/<file name>.png, 0 background, 1 .. n the non-crowd annotations in index order
+# finished maps are skipped, so an interrupted run continues where it stopped
+#   python coco_inst.py ../data/COCO --split train --workers 16
+
+# set in every worker process by _init_worker
+_job = None
+
+
+def _init_worker(job):
+    global _job
+    _job = dict(job)
+    _job['coco'] = open_coco_index(job['annotation_file'])
+
+
+def write_instance_maps(ids):
+    coco = _job['coco']
+    written = 0
+    for id in ids:
+        file_name = coco.load_img(id)['file_name']
+        inst_name = os.path.join(_job['output_dir'], os.path.splitext(file_name)[0] + ".png")
+        if os.path.exists(inst_name):
+            continue
+        inst = coco.instance_map(id, cat_ids=_job['classes'])
+        # written under a temporary name first, a killed worker never leaves a truncated png behind
+        Image.fromarray(inst).save(inst_name + ".tmp", format="PNG")
+        os.replace(inst_name + ".tmp", inst_name)
+        written += 1
+    return written
+
+
+def build_instance_maps(data_path, split="val", classes=None, workers=0, chunk=64):
+    annotation_file = os.path.join(data_path, "annotations", "instances_{}2017.json".format(split))
+    coco = open_coco_index(annotation_file)
+    job = {
+        'annotation_file': annotation_file,
+        'classes': classes,
+        'output_dir': os.path.join(data_path, "{}_inst".format(split)),
+    }
+    if not os.path.exists(job['output_dir']):
+        os.mkdir(job['output_dir'])
+
+    # images with at least one annotation
+    imgIds = [int(x) for x in coco.image_ids[np.diff(coco.ann_start) > 0]]
+    chunks = [imgIds[k:k + chunk] for k in range(0, len(imgIds), chunk)]
+    written = 0
+    bar = tqdm(total=len(imgIds))
+    if workers > 0:
+        with Pool(workers, initializer=_init_worker, initargs=(job,)) as pool:
+            for ids, count in zip(chunks, pool.imap_unordered(write_instance_maps, chunks)):
+                written += count
+                bar.update(len(ids))
+    else:
+        _init_worker(job)
+        for ids in chunks:
+            written += write_instance_maps(ids)
+            bar.update(len(ids))
+    bar.close()
+    print("{} instance maps written, {} already in {}".format(written, len(imgIds) - written, job['output_dir']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", type=str)
+    parser.add_argument("--split", type=str, default="val", choices=["train", "val"])
+    parser.add_argument("--classes", type=int, nargs='+', default=None, help="coco category ids, all by default")
+    parser.add_argument("--workers", type=int, default=0)
+    args = parser.parse_args()
+    build_instance_maps(args.data_path, args.split, args.classes, args.workers)
@@ -0,0 +1,14 @@
+import os
+import argparse
+from dataset.coco_pack import write_pack
+
+# offline packer for the coco_obj dataset, run once after coco_cut.py:
+#   python coco_pack.py ../data/COCO --split train --sizes 64 128
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", type=str)
+    parser.add_argument("--split", type=str, default="train", choices=["train", "val"])
+    parser.add_argument("--sizes", type=int, nargs='+', default=[64])
+    args = parser.parse_args()
+    print("loading data from: {}".format(args.data_path))
+    write_pack(args.data_path, args.sizes, train=args.split == "train")
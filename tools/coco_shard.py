@@ -0,0 +1,24 @@
+import os
+import argparse
+from dataset.shards import write_obj_shards, write_synthesis_shards
+
+# offline writer of the tar shards read by build_data(..., shards=True), run after coco_cut.py for coco_obj:
+#   python coco_shard.py ../data/COCO --split train
+# and after the synthesis data of n classes has been built once for coco_synthesis:
+#   python coco_shard.py ../data/COCO --split train --kind synthesis --class_num 1
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", type=str)
+    parser.add_argument("--split", type=str, default="train", choices=["train", "val"])
+    parser.add_argument("--kind", type=str, default="obj", choices=["obj", "synthesis"])
+    parser.add_argument("--class_num", type=int, default=1)
+    parser.add_argument("--shard_size", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print("loading data from: {}".format(args.data_path))
+    if args.kind == "obj":
+        write_obj_shards(args.data_path, args.split == "train", shard_size=args.shard_size or 5000, seed=args.seed)
+    else:
+        data_path = os.path.join(args.data_path, "synthesis_{}_{}".format(args.split, args.class_num))
+        write_synthesis_shards(data_path, os.path.join(args.data_path, "{}_image".format(args.split)),
+                               shard_size=args.shard_size or 1000, seed=args.seed)
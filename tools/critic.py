@@ -0,0 +1,60 @@
+import torch
+from tools.amp import input_gradients
+
+# fused WGAN-GP critic step: real, fake and interpolated samples go through the critic as one batch of 3 * B instead
+# of three forwards of B. the critics only normalize per sample (InstanceNorm), so every row sees exactly what it
+# would see alone, and the gradient of the interpolate rows w.r.t. the interpolates is the gradient penalty's.
+# the penalty's double backward runs over the whole batch (zero gradients for the real and fake rows), so this
+# trades arithmetic for kernel launches, a win for the small batches the critics train on
+# `fused_critic` in config.yaml switches train.py and synthesis_train.py to it
+
+
+def critic_pass(netD, real, fake, cond=None, gp_lambda=10., scaler=None, with_label=None, penalty=True):
+    """ netD: a critic returning validity, or (validity, labels) when with_label is not None;
+    cond: channels concatenated in front of every sample (the mask of the pix2pix critic);
+    penalty=False leaves the interpolates out, for the steps a lazy penalty skips.
+    returns real validity, fake validity, real labels, fake labels, gradient penalty; labels are None without the
+    class head, the penalty is 0 without interpolates """
+    batch_size = real.shape[0]
+    fake = fake.detach()
+    parts = [real, fake]
+    if penalty:
+        alpha = torch.rand(batch_size, 1, 1, 1).to(real.device)
+        interpolates = (alpha * real + (1 - alpha) * fake).detach()
+        interpolates.requires_grad = True
+        parts.append(interpolates)
+    x = torch.cat(parts, 0)
+    if cond is not None:
+        x = torch.cat([torch.cat([cond] * len(parts), 0), x], 1)
+    if with_label is None:
+        validity, labels = netD(x), None
+    else:
+        validity, labels = netD(x, with_label=with_label)
+    validity = validity.split(batch_size, 0)
+    real_validity, fake_validity = validity[0], validity[1]
+
+    gradient_penalty = torch.zeros([], device=real.device)
+    if penalty:
+        gradients = input_gradients(validity[2], interpolates, scaler)
+        gradients = gradients.view(gradients.shape[0], -1)
+        gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean() * gp_lambda
+    if labels is None:
+        return real_validity, fake_validity, None, None, gradient_penalty
+    real_labels, fake_labels = labels[0:batch_size], labels[batch_size:2 * batch_size]
+    return real_validity, fake_validity, real_labels, fake_labels, gradient_penalty
+
+
+class PenaltySchedule(object):
+    """ lazy regularization: the gradient penalty on every interval-th critic step only, weighted by interval so the
+    average weight stays gp_lambda; interval 0 turns it off, the default for spectral normalized critics """
+
+    def __init__(self, gp_lambda, interval=1):
+        self.gp_lambda = gp_lambda
+        self.interval = interval
+        self.steps = 0
+
+    def next(self):
+        """ (whether this critic step computes the penalty, its weight) """
+        due = self.interval > 0 and self.steps % self.interval == 0
+        self.steps += 1
+        return due, self.gp_lambda * self.interval
@@ -0,0 +1,20 @@
+import os
+import argparse
+from dataset.decode import available_backends, benchmark_backends
+
+# decode throughput of every installed backend on this host, to pick decode_backend in config.yaml:
+#   python decode_bench.py ../data/COCO/train_image --limit 500 --size 64
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str)
+    parser.add_argument("--limit", type=int, default=500)
+    parser.add_argument("--size", type=int, default=None, help="reduced-scale jpeg decode target")
+    args = parser.parse_args()
+    files = sorted(os.path.join(args.path, f) for f in os.listdir(args.path)
+                   if f.lower().endswith(('.jpg', '.jpeg', '.png')))[0:args.limit]
+    size = (args.size, args.size) if args.size is not None else None
+    print("decoding {} files with {}".format(len(files), available_backends()))
+    # a warm-up pass, so the first backend does not pay for the cold page cache
+    benchmark_backends(files, size, ['pil'])
+    for backend, speed in benchmark_backends(files, size).items():
+        print("{}: {:.1f} images/s".format(backend, speed))
@@ -0,0 +1,94 @@
+import os
+import torch
+import datetime
+import torch.distributed as dist
+from contextlib import contextmanager
+
+# multi-process data parallel training for train.py and post_train.py, started with torchrun, e.g. two processes on
+# a cpu only node or one per gpu:
+#   torchrun --nproc_per_node 2 train.py --root ../experiments/pix2pix_person
+# every process loads its own part of every epoch (bs in config.yaml is per process), the gradients of G and D are
+# averaged over all processes before each optimizer step, and only rank 0 writes logs, events and checkpoints.
+# the `distributed` section of config.yaml is optional:
+#   distributed: {backend: gloo, sync_bn: False, threads: 4, timeout: 30}
+# gloo runs everywhere, nccl only between gpus. threads: torch threads per process, the cores of the node split
+# between its processes by default. timeout: minutes a process waits for the others, raise it when rank 0 has to
+# build the data (synthesis, indexes) first. sync_bn: the BatchNorm2d of the SPADE blocks normalizes over the batches
+# of all processes, which needs cuda. the gradients are reduced by hand instead of DistributedDataParallel, whose
+# reducer does not support the double backward of the gradient penalty
+# without torchrun (WORLD_SIZE unset) the scripts run a single process as before
+
+
+def init_distributed(config=None):
+    """ join the process group torchrun set up, returns (rank, world_size, device) """
+    config = config if config is not None else {}
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1, torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+    torch.set_num_threads(config.get('threads', max(1, (os.cpu_count() or 1) // local_world_size)))
+    timeout = datetime.timedelta(minutes=config.get('timeout', 30))
+    dist.init_process_group(config.get('backend', 'gloo'), timeout=timeout)
+    return dist.get_rank(), world_size, device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main():
+    """ whether this process logs and saves, always true without torchrun """
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextmanager
+def main_first():
+    """ rank 0 runs the block first, the others after it, for the steps that write shared files (data indexes,
+    caches), so they find them finished instead of building them at the same time """
+    if not is_main():
+        barrier()
+    yield
+    if is_main():
+        barrier()
+
+
+def broadcast_model(model):
+    """ parameters and buffers of rank 0 to all processes, after initialization or loading """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(tensor.data, 0)
+
+
+def all_reduce_grads(model):
+    """ average the gradients over all processes, between backward and the optimizer step. one all_reduce over
+    the flattened gradients; parameters without a gradient are left out on every process alike """
+    if not is_distributed():
+        return
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
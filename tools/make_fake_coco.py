@@ -0,0 +1,146 @@
+import os
+import json
+import argparse
+import numpy as np
+from PIL import Image, ImageDraw
+from tqdm import tqdm
+from tools.coco_cut import classes as coco_classes, cut_split
+
+# synthetic COCO tree in the layout the coco tools and datasets expect, for benchmarks and regression runs
+# without the real dataset:
+#   COCO/{split}_image/*.jpg, COCO/{split}_label/*.png, COCO/annotations/instances_{split}2017.json
+#   COCO/{split}_cut, {split}_label_cut, {split}_mask_cut with data_list.txt, written by coco_cut.py
+#   COCO/results_coco_{split}_{n}/img*.png + file_name.txt for every class count n, and results_coco_{split}
+# e.g. python make_fake_coco.py ../data_fake --images 200 --splits train val --class_nums 1 5
+# annotations are polygons, a fraction of them crowd regions as uncompressed RLE like in the real files.
+
+
+def smooth_image(rng, h, w, channels):
+    """ upsampled low resolution noise, compresses and decodes more like a photo than white noise does """
+    small = rng.randint(0, 256, (max(h // 16, 1), max(w // 16, 1), channels)).astype(np.uint8)
+    image = Image.fromarray(small if channels == 3 else small[:, :, 0])
+    return image.resize((w, h), Image.BILINEAR)
+
+
+def random_polygon(rng, x0, y0, w, h, points=8):
+    """ star-shaped polygon inside the box, flat [x1, y1, x2, y2, ...] as in the COCO files """
+    angles = np.sort(rng.uniform(0, 2 * np.pi, points))
+    radius = rng.uniform(0.6, 1.0, points)
+    xs = x0 + w / 2 + np.cos(angles) * radius * w / 2
+    ys = y0 + h / 2 + np.sin(angles) * radius * h / 2
+    return [float(v) for xy in zip(xs, ys) for v in xy]
+
+
+def polygon_mask(polygon, h, w):
+    mask = Image.new('L', (w, h), 0)
+    ImageDraw.Draw(mask).polygon(polygon, fill=1)
+    return np.asarray(mask)
+
+
+def uncompressed_rle(mask):
+    """ pycocotools' uncompressed RLE: column-major runs starting with zeros """
+    flat = np.asarray(mask, dtype=np.uint8).reshape(-1, order='F')
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate([[0], change, [flat.size]]))
+    if flat[0] != 0:
+        runs = np.concatenate([[0], runs])
+    return {'counts': [int(x) for x in runs], 'size': [int(mask.shape[0]), int(mask.shape[1])]}
+
+
+def write_images(path, split, images, rng, args, first_id):
+    """ images, labels and annotations of one split, returns the instances json """
+    image_dir = os.path.join(path, "{}_image".format(split))
+    label_dir = os.path.join(path, "{}_label".format(split))
+    for d in [image_dir, label_dir, os.path.join(path, "annotations")]:
+        if not os.path.exists(d):
+            os.mkdir(d)
+    instances = {'images': [], 'annotations': [],
+                 'categories': [{'id': c, 'name': coco_classes[c], 'supercategory': ''} for c in args.classes]}
+    ann_id = first_id * 100
+    for i in tqdm(range(images)):
+        id = first_id + i
+        h, w = rng.randint(args.min_size, args.max_size + 1, 2)
+        file_name = str(id).zfill(12) + ".jpg"
+        gray = rng.uniform() < args.gray
+        smooth_image(rng, h, w, 1 if gray else 3).save(os.path.join(image_dir, file_name), quality=90)
+        # stuff classes of cocostuff (92 - 182) in blocks, the objects painted over them with their category
+        label = np.asarray(smooth_image(rng, h, w, 1)) % 91 + 92
+        label = label.astype(np.uint8)
+        instances['images'].append({'id': id, 'file_name': file_name, 'height': int(h), 'width': int(w)})
+        for k in range(rng.randint(0, args.objects + 1)):
+            bw = rng.randint(min(args.min_object, w - 1), max(min(w * 3 // 4, w - 1), args.min_object) + 1)
+            bh = rng.randint(min(args.min_object, h - 1), max(min(h * 3 // 4, h - 1), args.min_object) + 1)
+            x0, y0 = rng.uniform(0, w - bw), rng.uniform(0, h - bh)
+            category = int(rng.choice(args.classes))
+            polygon = random_polygon(rng, x0, y0, bw, bh)
+            mask = polygon_mask(polygon, h, w)
+            ann = {'id': ann_id, 'image_id': id, 'category_id': category, 'bbox': [x0, y0, float(bw), float(bh)],
+                   'area': float(mask.sum()), 'iscrowd': 0, 'segmentation': [polygon]}
+            if rng.uniform() < args.crowd:
+                ann['iscrowd'] = 1
+                ann['segmentation'] = uncompressed_rle(mask)
+            instances['annotations'].append(ann)
+            label[mask > 0] = category - 1  # cocostuff labels are category id - 1
+            ann_id += 1
+        Image.fromarray(label).save(os.path.join(label_dir, file_name[0:-4] + ".png"))
+    with open(os.path.join(path, "annotations", "instances_{}2017.json".format(split)), "w") as f:
+        json.dump(instances, f)
+    return instances
+
+
+def write_results(path, split, instances, rng, class_nums, bg_size):
+    """ results_coco_{split}_{n}: the background images coco_synthesis_dataset pastes objects on, one per image
+    in file_name.txt order; results_coco_{split} is the base image directory it derives from the path """
+    names = [img['file_name'] for img in instances['images']]
+    for d in ["results_coco_{}".format(split)] + ["results_coco_{}_{}".format(split, n) for n in class_nums]:
+        d = os.path.join(path, d)
+        if not os.path.exists(d):
+            os.mkdir(d)
+        with open(os.path.join(d, "file_name.txt"), "w") as f:
+            for name in names:
+                print(name, file=f)
+        for i in range(len(names)):
+            smooth_image(rng, bg_size, bg_size, 3).save(os.path.join(d, "img" + str(i).zfill(6) + ".png"))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", type=str, help="the COCO directory is created inside, use it as data_path")
+    parser.add_argument("--images", type=int, default=100, help="images per split")
+    parser.add_argument("--splits", type=str, nargs='+', default=["train", "val"])
+    parser.add_argument("--classes", type=int, nargs='+', default=[1, 18, 19, 22, 24, 25])
+    parser.add_argument("--class_nums", type=int, nargs='+', default=[1, 5],
+                        help="class counts of the results_coco_{split}_{n} directories")
+    parser.add_argument("--objects", type=int, default=4, help="at most this many objects per image")
+    parser.add_argument("--min_size", type=int, default=240)
+    parser.add_argument("--max_size", type=int, default=480)
+    parser.add_argument("--min_object", type=int, default=32)
+    parser.add_argument("--gray", type=float, default=0.05, help="fraction of grayscale images")
+    parser.add_argument("--crowd", type=float, default=0.1, help="fraction of crowd annotations")
+    parser.add_argument("--bg_size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def make_fake_coco(args):
+    """ args: parse_args() of the command line above, the tests build their fixture with it too """
+    for n in args.class_nums:
+        if n >= 10:
+            # coco_synthesis_dataset finds the base images by cutting the last two characters off the path
+            print("class count {} does not fit results_coco_{{split}}_{{n}}".format(n))
+            assert 0
+
+    rng = np.random.RandomState(args.seed)
+    path = os.path.join(args.root, "COCO")
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for k, split in enumerate(args.splits):
+        print("writing {} {} images into {}".format(args.images, split, path))
+        instances = write_images(path, split, args.images, rng, args, (k + 1) * 1000000)
+        cut_split(path, split)
+        write_results(path, split, instances, rng, args.class_nums, args.bg_size)
+    return path
+
+
+if __name__ == "__main__":
+    make_fake_coco(parse_args())
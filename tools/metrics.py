@@ -0,0 +1,89 @@
+import queue
+import threading
+import torch
+
+# logging off the training step. MetricAccumulator adds the scalar losses of every step into one tensor on their
+# device, without waiting for the step to finish; pop() averages them since the last call with a single transfer
+# to the host, once per show_interval. LogWriter writes the log lines, scalars and images from a thread of its own,
+# so neither the SummaryWriter nor log.txt hold up the loop; close() writes whatever is still queued
+
+
+class MetricAccumulator(object):
+    def __init__(self):
+        self.names = None
+        self.sums = None
+        self.count = 0
+
+    def add(self, **metrics):
+        """ one step's scalars, tensors (all on one device) or numbers; every call has to pass the same names """
+        names = list(metrics.keys())
+        if self.names is None:
+            self.names = names
+        elif names != self.names:
+            print("metrics changed from {} to {}".format(self.names, names))
+            assert 0
+        device = next((v.device for v in metrics.values() if torch.is_tensor(v)), torch.device('cpu'))
+        values = torch.stack([v.detach().float().reshape([]) if torch.is_tensor(v) else
+                              torch.tensor(float(v), device=device) for v in metrics.values()])
+        self.sums = values if self.sums is None else self.sums + values
+        self.count += 1
+
+    def pop(self):
+        """ {name: mean since the last pop} as python floats, empty when nothing was added """
+        if self.count == 0:
+            return {}
+        means = (self.sums / self.count).tolist()
+        self.sums, self.count = None, 0
+        return dict(zip(self.names, means))
+
+
+class LogWriter(threading.Thread):
+    def __init__(self, log_file=None, writer=None):
+        """ log_file: an open text file, writer: a SummaryWriter; either may be None """
+        super(LogWriter, self).__init__(daemon=True)
+        self.log_file = log_file
+        self.writer = writer
+        self.records = queue.Queue()
+        self.start()
+
+    def text(self, s):
+        self.records.put(('text', s))
+
+    def scalars(self, values, step, prefix=""):
+        """ values: {tag: float} """
+        self.records.put(('scalars', (values, step, prefix)))
+
+    def image(self, tag, image, step, dataformats='HWC'):
+        """ image: a numpy array the caller does not change afterwards """
+        self.records.put(('image', (tag, image, step, dataformats)))
+
+    def _write(self, kind, record):
+        if kind == 'text':
+            if self.log_file is not None:
+                print(record, file=self.log_file)
+        elif self.writer is None:
+            return
+        elif kind == 'scalars':
+            values, step, prefix = record
+            for tag, value in values.items():
+                self.writer.add_scalar(prefix + tag, value, step)
+        elif kind == 'image':
+            tag, image, step, dataformats = record
+            self.writer.add_image(tag, image, step, dataformats=dataformats)
+
+    def run(self):
+        while True:
+            kind, record = self.records.get()
+            if kind == 'close':
+                break
+            self._write(kind, record)
+            if self.records.empty() and self.log_file is not None:
+                self.log_file.flush()
+
+    def close(self):
+        self.records.put(('close', None))
+        self.join()
+        if self.log_file is not None:
+            self.log_file.close()
+        if self.writer is not None:
+            self.writer.close()
@@ -18,15 +18,21 @@ import os
 import argparse
 from tools.coco_cut import classes as coco_classes
 from tools.single_obj import SingleObj
+from tools.resume import save_resume, load_resume
+from tools.amp import Amp, input_gradients
+from tools.metrics import MetricAccumulator, LogWriter
+from tools.dist import init_distributed, is_main, main_first, broadcast_model, all_reduce_grads, cleanup
 
-log_file = None
+log_writer = None
 
 
 def to_log(s, output=True):
-    global log_file
+    global log_writer
+    if not is_main():
+        return
     if output:
         print(s)
-    print(s, file=log_file)
+    log_writer.text(s)
 
 
 def open_config(root):
@@ -49,7 +55,11 @@ def load(models, epoch, root):
     if epoch is None:
         return -1
     for name, model in models.items():
-        ckpt = torch.load(os.path.join(root, "logs/" + name + "_epoch-{}.pth".format(epoch)))
+        ckpt_path = os.path.join(root, "logs/" + name + "_epoch-{}.pth".format(epoch))
+        if name == "amp" and not os.path.exists(ckpt_path):
+            # snapshots from before the scaler state was saved
+            continue
+        ckpt = torch.load(ckpt_path, map_location='cpu')
         ckpt = {k: v for k, v in ckpt.items()}
         model.load_state_dict(ckpt)
         to_log("load model: {} from epoch: {}".format(name, epoch))
@@ -57,21 +67,18 @@ def load(models, epoch, root):
     return epoch
 
 
-def calc_gradient_penalty(netD, origin, fake_data, batch_size, gp_lambda):
+def calc_gradient_penalty(netD, origin, fake_data, batch_size, gp_lambda, scaler=None):
     alpha = torch.rand(batch_size, 1, 1, 1)
     alpha = alpha.expand(origin.shape).contiguous()
-    alpha = alpha.cuda()
+    alpha = alpha.to(origin.device)
 
     interpolates = alpha * origin + ((1 - alpha) * fake_data)
 
-    interpolates = interpolates.cuda()
     interpolates.requires_grad = True
 
     disc_interpolates = netD(interpolates)
 
-    gradients = autograd.grad(outputs=disc_interpolates, inputs=interpolates,
-                              grad_outputs=torch.ones(disc_interpolates.size()).cuda(),
-                              create_graph=True, retain_graph=True, only_inputs=True)[0]
+    gradients = input_gradients(disc_interpolates, interpolates, scaler)
     gradients = gradients.view(gradients.shape[0], -1)
 
     gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean() * gp_lambda
@@ -95,16 +102,20 @@ def imagetensor2np(x):
 
 
 def train(args, root):
-    global log_file
-    if not os.path.exists(os.path.join(root, "logs")):
-        os.mkdir(os.path.join(root, "logs"))
-    if not os.path.exists(os.path.join(root, "logs/result/")):
-        os.mkdir(os.path.join(root, "logs/result/"))
-    if not os.path.exists(os.path.join(root, "logs/result/event")):
-        os.mkdir(os.path.join(root, "logs/result/event"))
-    log_file = open(os.path.join(root, "logs/log.txt"), "w")
+    global log_writer
+    # a single process unless started by torchrun, see tools/dist.py
+    rank, world_size, device = init_distributed(args.get('distributed', None))
+    if is_main():
+        if not os.path.exists(os.path.join(root, "logs")):
+            os.mkdir(os.path.join(root, "logs"))
+        if not os.path.exists(os.path.join(root, "logs/result/")):
+            os.mkdir(os.path.join(root, "logs/result/"))
+        if not os.path.exists(os.path.join(root, "logs/result/event")):
+            os.mkdir(os.path.join(root, "logs/result/event"))
+        # log.txt and the events are written by a thread of their own, see tools/metrics.py
+        log_writer = LogWriter(open(os.path.join(root, "logs/log.txt"), "w"),
+                               SummaryWriter(os.path.join(root, "logs/result/event/")))
     to_log(args)
-    writer = SummaryWriter(os.path.join(root, "logs/result/event/"))
 
     if args['classes'] == 'NONE':
         args['classes'] = list(coco_classes.keys())
@@ -118,61 +129,91 @@ def train(args, root):
     #    single_root = '../experiments/p2p_10class'
     else:
         assert 0
-    single_model = SingleObj(open_config(single_root), single_root)
+    # the shards hold finished synthesis images, the object model is only needed to build them
+    single_model = SingleObj(open_config(single_root), single_root) if not args.get('shards', False) else None
     data_root = os.path.join(args['data_path'], "COCO", "results_coco_train_{}".format(classes_num))
-    dataloader = build_data(args['data_tag'], data_root, args["bs"], True, num_worker=args["num_workers"],
-                            classes=args['classes'], image_size=args['image_size'], obj_model=single_model)
+    # rank 0 synthesizes missing images before the others read them
+    with main_first():
+        dataloader = build_data(args['data_tag'], data_root, args["bs"], True, num_worker=args["num_workers"],
+                                classes=args['classes'], image_size=args['image_size'], obj_model=single_model,
+                                batch_transform=args.get('batch_transform', False),
+                                synthesis_batch_size=args.get('synthesis_batch_size', 64),
+                                synthesis_workers=args.get('synthesis_workers', 4),
+                                draft_decode=args.get('draft_decode', False), shards=args.get('shards', False),
+                                loader=args.get('loader', None), decode_backend=args.get('decode_backend', 'pil'),
+                                rank=rank, world_size=world_size)
 
     # G = get_G("mini").cuda()
-    G = get_G("post", in_channels=3, out_channels=3, scale=5, image_size=args['image_size']).cuda()
+    G = get_G("post", in_channels=3, out_channels=3, scale=5, image_size=args['image_size']).to(device)
 
     g_opt = torch.optim.Adam(G.parameters(), lr=args["lr"], betas=(0.5, 0.9))
     g_sch = torch.optim.lr_scheduler.MultiStepLR(g_opt, args["lr_milestone"], gamma=0.5)
 
-    load_epoch = load({"G": G, "g_opt": g_opt, "g_sch": g_sch}, args["load_epoch"], root)
-    tot_iter = (load_epoch + 1) * len(dataloader)
+    amp = Amp(args.get('amp', False))
+    models = {"G": G, "g_opt": g_opt, "g_sch": g_sch, "amp": amp}
+    load_epoch = load(models, args["load_epoch"], root)
 
     max_iter_per_epoch = args['max_iter_per_epoch']
     if max_iter_per_epoch < 1:
         max_iter_per_epoch = len(dataloader.dataset)
+    epoch_iters = min(len(dataloader), max_iter_per_epoch)
+    tot_iter = (load_epoch + 1) * epoch_iters
+    start_epoch, start_iter = load_epoch + 1, 0
+    resume = load_resume(models, root, dataloader, load_epoch) if args["load_epoch"] == -1 else None
+    if resume is not None:
+        start_epoch, start_iter, tot_iter = resume
+    # every process starts from the weights of rank 0
+    broadcast_model(G)
+    resume_interval = args.get('resume_interval', 0)
+    metrics = MetricAccumulator()
     g_opt.step()
-    for epoch in range(load_epoch + 1, args['epoch']):
-        g_sch.step()
-        for i, (synthesis, origin, shapes) in enumerate(dataloader):
+    for epoch in range(start_epoch, args['epoch']):
+        if resume is None or epoch != start_epoch:
+            # a resumed epoch was saved after its scheduler step
+            g_sch.step()
+        for i, (synthesis, origin, shapes) in enumerate(dataloader, start_iter if epoch == start_epoch else 0):
             tot_iter += 1
-            synthesis, origin, shapes = synthesis.cuda(), origin.cuda(), shapes.cuda()
+            synthesis, origin, shapes = synthesis.to(device), origin.to(device), shapes.to(device)
             syn_ = synthesis.clone().detach()  # x/x'
             g_opt.zero_grad()
-            # G
-            G_out = G(synthesis)
+            # G, the losses in fp32 (ms-ssim does not survive half precision)
+            with amp.autocast():
+                G_out = G(synthesis).float()
             l1_loss = nn.L1Loss()(G_out, syn_) * args['lambda_l1']
             mse_loss = nn.MSELoss()(G_out, syn_) * args['lambda_mse']
             tv_loss = TV(args['lambda_tv'])(G_out)
             ssim_loss = (1 - SSIM_Loss.msssim(G_out, syn_, normalize=True)) * args['lambda_ssim']
 
             G_loss = l1_loss + mse_loss + ssim_loss + tv_loss
-            G_loss.backward()
-
-            g_opt.step()
-
-            if tot_iter % args['show_interval'] == 0:
-                to_log(
-                    'epoch: {}, batch: {}, l1_loss: {:.5f}, mse_loss: {:.5f}, ssim_loss: {:.5f}, tv_loss: {:5f}, G_loss: {:5f}, lr: {:.5f}'.format(
-                        epoch, i, l1_loss.item(), mse_loss.item(), ssim_loss.item(), tv_loss.item(), G_loss.item(),
-                        g_sch.get_last_lr()[0]))
-                writer.add_scalar("loss/G_loss", G_loss.item(), tot_iter)
-                writer.add_scalar("loss/l1_loss", l1_loss.item(), tot_iter)
-                writer.add_scalar("loss/mse_loss", mse_loss.item(), tot_iter)
-                writer.add_scalar("loss/ssim_loss", ssim_loss.item(), tot_iter)
-                writer.add_scalar("loss/tv_loss", tv_loss.item(), tot_iter)
-                writer.add_scalar("lr", g_sch.get_last_lr()[0], tot_iter)
+            amp.backward(G_loss, 'G')
+            all_reduce_grads(G)
+
+            amp.step(g_opt, 'G')
+            if is_main():
+                if resume_interval > 0 and tot_iter % resume_interval == 0 and i + 1 < epoch_iters:
+                    save_resume(models, root, dataloader, epoch, i + 1, tot_iter)
+
+                metrics.add(l1_loss=l1_loss, mse_loss=mse_loss, ssim_loss=ssim_loss, tv_loss=tv_loss, G_loss=G_loss)
+                if tot_iter % args['show_interval'] == 0:
+                    # averages since the last report, one transfer for all of them
+                    losses = metrics.pop()
+                    lr = g_sch.get_last_lr()[0]
+                    to_log(
+                        'epoch: {}, batch: {}, l1_loss: {l1_loss:.5f}, mse_loss: {mse_loss:.5f}, ' \
+                        'ssim_loss: {ssim_loss:.5f}, tv_loss: {tv_loss:5f}, G_loss: {G_loss:5f}, ' \
+                        'lr: {lr:.5f}'.format(epoch, i, lr=lr, **losses))
+                    log_writer.scalars(losses, tot_iter, prefix="loss/")
+                    log_writer.scalars({"lr": lr}, tot_iter)
             if i == max_iter_per_epoch - 1:
                 break
 
+        if not is_main():
+            continue
         if epoch % args["snapshot_interval"] == 0:
             torch.save(G.state_dict(), os.path.join(root, "logs/G_epoch-{}.pth".format(epoch)))
             torch.save(g_opt.state_dict(), os.path.join(root, "logs/g_opt_epoch-{}.pth".format(epoch)))
             torch.save(g_sch.state_dict(), os.path.join(root, "logs/g_sch_epoch-{}.pth".format(epoch)))
+            torch.save(amp.state_dict(), os.path.join(root, "logs/amp_epoch-{}.pth".format(epoch)))
         if epoch % args['test_interval'] == 0:
             # label = torch.tensor([5]).expand([64]).cuda()
             # input_test[:, 1, :, :] = label.reshape(64, 1, 1).expand(64, image_size, image_size)
@@ -187,9 +228,12 @@ def train(args, root):
             G_out = G_out / 2 + 0.5
             G_out = G_out.clamp(0, 1)
             save_image(G_out, os.path.join(root, "logs/output-{}.png".format(epoch)))
-            writer.add_image('image{}/mask'.format(epoch), origin, tot_iter, dataformats='HWC')
-            writer.add_image('image{}/fake'.format(epoch), image, tot_iter, dataformats='HWC')
-            writer.add_image('image{}/input'.format(epoch), synthesis, tot_iter, dataformats='HWC')
+            log_writer.image('image{}/mask'.format(epoch), origin, tot_iter, dataformats='HWC')
+            log_writer.image('image{}/fake'.format(epoch), image, tot_iter, dataformats='HWC')
+            log_writer.image('image{}/input'.format(epoch), synthesis, tot_iter, dataformats='HWC')
+    if is_main():
+        log_writer.close()
+    cleanup()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,61 @@
+import os
+import torch
+
+# iteration checkpoints for preemptible runs. logs/resume.pth holds the models, the position inside the epoch,
+# the sampler state and the rng states; it is rewritten every `resume_interval` iterations next to the
+# G_epoch-*.pth snapshots, which stay the long-term checkpoints
+
+
+def resume_path(root):
+    return os.path.join(root, "logs/resume.pth")
+
+
+def loader_sampler(dataloader):
+    """ the checkpointable sampler behind a DataLoader or one of its wrappers, None for shard streams """
+    sampler = getattr(dataloader, 'sampler', None)
+    return sampler if hasattr(sampler, 'load_state_dict') else None
+
+
+def save_resume(models, root, dataloader, epoch, iter, tot_iter):
+    """ iter: batches of `epoch` that are done """
+    sampler = loader_sampler(dataloader)
+    state = {
+        'epoch': epoch,
+        'iter': iter,
+        'tot_iter': tot_iter,
+        'sampler': sampler.state_dict(iter * dataloader.batch_size) if sampler is not None else None,
+        'models': {name: model.state_dict() for name, model in models.items()},
+        'rng': torch.get_rng_state(),
+        'cuda_rng': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+    # write then rename, a preemption while saving keeps the previous checkpoint
+    torch.save(state, resume_path(root) + ".tmp")
+    os.replace(resume_path(root) + ".tmp", resume_path(root))
+
+
+def load_resume(models, root, dataloader, load_epoch):
+    """ restore logs/resume.pth when it is ahead of the epoch snapshot load_epoch, returns (epoch, iter, tot_iter)
+    to continue from or None """
+    if not os.path.exists(resume_path(root)):
+        return None
+    state = torch.load(resume_path(root), map_location='cpu')
+    if state['epoch'] <= load_epoch:
+        return None
+    for name, model in models.items():
+        if name not in state['models']:
+            # resume files from before the entry was saved (the amp scaler state)
+            print("no {} in {}, keeping its initial state".format(name, resume_path(root)))
+            continue
+        model.load_state_dict(state['models'][name])
+    epoch, iter, tot_iter = state['epoch'], state['iter'], state['tot_iter']
+    sampler = loader_sampler(dataloader)
+    if sampler is not None and state['sampler'] is not None:
+        sampler.load_state_dict(state['sampler'])
+    else:
+        print("the data order is not checkpointable, epoch {} restarts from its first batch".format(epoch))
+        iter, tot_iter = 0, tot_iter - iter
+    torch.set_rng_state(state['rng'])
+    if state['cuda_rng'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda_rng'])
+    print("resume from epoch: {}, batch: {}".format(epoch, iter))
+    return epoch, iter, tot_iter
@@ -15,6 +15,8 @@ import numpy as np
 import yaml
 import os
 import argparse
+import json
+import hashlib
 from tools.coco_cut import classes as coco_classes
 
 
@@ -70,11 +72,21 @@ class SingleObj():
                        image_size=args['image_size'], classes_num=self.classes_num).cuda()
         self.D = get_D("dnn", classes=self.classes_num + 1).cuda()
 
-        load({"G": self.G}, args["load_epoch"], root)
+        epoch = load({"G": self.G}, args["load_epoch"], root)
+        self.signature = self.make_signature(args, root, epoch)
 
         self.G.eval()
         print("object generator ready!")
 
+    @staticmethod
+    def make_signature(args, root, epoch):
+        """ identifies the config and checkpoint that produce the generated objects """
+        ckpt = os.path.join(root, "logs/G_epoch-{}.pth".format(epoch))
+        stat = os.stat(ckpt) if os.path.exists(ckpt) else None
+        desc = {'root': os.path.abspath(root), 'epoch': epoch, 'config': args,
+                'ckpt': [stat.st_size, stat.st_mtime_ns] if stat is not None else None}
+        return hashlib.sha1(json.dumps(desc, sort_keys=True, default=str).encode()).hexdigest()
+
     def generate(self, mask, labels):
         noise = make_noise(mask.shape[0], self.noise_dim)
         with torch.no_grad():
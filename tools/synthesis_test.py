@@ -107,7 +107,8 @@ def test(args, root):
     data_root = os.path.join(args['data_path'], "COCO", "results_coco_val_{}".format(classes_num))
     from dataset.data_builder import coco_synthesis_dataset
     dataset = coco_synthesis_dataset(data_root, False, classes=args['classes'], image_size=args['image_size'],
-                                     obj_model=single_model)
+                                     obj_model=single_model, synthesis_batch_size=args.get('synthesis_batch_size', 64),
+                                     synthesis_workers=args.get('synthesis_workers', 4))
 
     #G = get_G("mini").cuda()
     G = get_G("post", in_channels=3, out_channels=3, scale=5, image_size=args['image_size']).cuda()
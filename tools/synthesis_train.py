@@ -17,15 +17,19 @@ import os
 import argparse
 from tools.coco_cut import classes as coco_classes
 from tools.single_obj import SingleObj
+from tools.resume import save_resume, load_resume
+from tools.amp import Amp, input_gradients
+from tools.critic import critic_pass, PenaltySchedule
+from tools.metrics import MetricAccumulator, LogWriter
 
-log_file = None
+log_writer = None
 
 
 def to_log(s, output=True):
-    global log_file
+    global log_writer
     if output:
         print(s)
-    print(s, file=log_file)
+    log_writer.text(s)
 
 
 def open_config(root):
@@ -48,7 +52,11 @@ def load(models, epoch, root):
     if epoch is None:
         return -1
     for name, model in models.items():
-        ckpt = torch.load(os.path.join(root, "logs/" + name + "_epoch-{}.pth".format(epoch)))
+        ckpt_path = os.path.join(root, "logs/" + name + "_epoch-{}.pth".format(epoch))
+        if name == "amp" and not os.path.exists(ckpt_path):
+            # snapshots from before the scaler state was saved
+            continue
+        ckpt = torch.load(ckpt_path)
         ckpt = {k: v for k, v in ckpt.items()}
         model.load_state_dict(ckpt)
         to_log("load model: {} from epoch: {}".format(name, epoch))
@@ -56,7 +64,7 @@ def load(models, epoch, root):
     return epoch
 
 
-def calc_gradient_penalty(netD, origin, fake_data, batch_size, gp_lambda):
+def calc_gradient_penalty(netD, origin, fake_data, batch_size, gp_lambda, scaler=None):
     alpha = torch.rand(batch_size, 1, 1, 1)
     alpha = alpha.expand(origin.shape).contiguous()
     alpha = alpha.cuda()
@@ -68,9 +76,7 @@ def calc_gradient_penalty(netD, origin, fake_data, batch_size, gp_lambda):
 
     disc_interpolates = netD(interpolates)
 
-    gradients = autograd.grad(outputs=disc_interpolates, inputs=interpolates,
-                              grad_outputs=torch.ones(disc_interpolates.size()).cuda(),
-                              create_graph=True, retain_graph=True, only_inputs=True)[0]
+    gradients = input_gradients(disc_interpolates, interpolates, scaler)
     gradients = gradients.view(gradients.shape[0], -1)
 
     gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean() * gp_lambda
@@ -94,16 +100,17 @@ def imagetensor2np(x):
 
 
 def train(args, root):
-    global log_file
+    global log_writer
     if not os.path.exists(os.path.join(root, "logs")):
         os.mkdir(os.path.join(root, "logs"))
     if not os.path.exists(os.path.join(root, "logs/result/")):
         os.mkdir(os.path.join(root, "logs/result/"))
     if not os.path.exists(os.path.join(root, "logs/result/event")):
         os.mkdir(os.path.join(root, "logs/result/event"))
-    log_file = open(os.path.join(root, "logs/log.txt"), "w")
+    # log.txt and the events are written by a thread of their own, see tools/metrics.py
+    log_writer = LogWriter(open(os.path.join(root, "logs/log.txt"), "w"),
+                           SummaryWriter(os.path.join(root, "logs/result/event/")))
     to_log(args)
-    writer = SummaryWriter(os.path.join(root, "logs/result/event/"))
 
     if args['classes'] == 'NONE':
         args['classes'] = list(coco_classes.keys())
@@ -120,85 +127,116 @@ def train(args, root):
     single_model = SingleObj(open_config(single_root), single_root)
     data_root = os.path.join(args['data_path'], "COCO", "results_coco_train_{}".format(classes_num))
     dataloader = build_data(args['data_tag'], data_root, args["bs"], True, num_worker=args["num_workers"],
-                            classes=args['classes'], image_size=args['image_size'], obj_model=single_model)
+                            classes=args['classes'], image_size=args['image_size'], obj_model=single_model,
+                            batch_transform=args.get('batch_transform', False),
+                            synthesis_batch_size=args.get('synthesis_batch_size', 64),
+                            synthesis_workers=args.get('synthesis_workers', 4),
+                            draft_decode=args.get('draft_decode', False), shards=args.get('shards', False),
+                            loader=args.get('loader', None), decode_backend=args.get('decode_backend', 'pil'))
 
     G = get_G("post", in_channels=3, out_channels=3, scale=6).cuda()
-    D = get_D("post", classes=2).cuda()
+    D = get_D("post", classes=2, spectral_norm=args.get('spectral_norm', False)).cuda()
 
     g_opt = torch.optim.Adam(G.parameters(), lr=args["lr"], betas=(0.5, 0.9))
     d_opt = torch.optim.Adam(D.parameters(), lr=args["lr"], betas=(0.5, 0.9))
     g_sch = torch.optim.lr_scheduler.MultiStepLR(g_opt, args["lr_milestone"], gamma=0.5)
     d_sch = torch.optim.lr_scheduler.MultiStepLR(d_opt, args["lr_milestone"], gamma=0.5)
 
-    load_epoch = load({"G": G, "g_opt": g_opt, "g_sch": g_sch, "D": D, "d_opt": d_opt, "d_sch": d_sch},
-                      args["load_epoch"], root)
-    tot_iter = (load_epoch + 1) * len(dataloader)
+    amp = Amp(args.get('amp', False))
+    models = {"G": G, "g_opt": g_opt, "g_sch": g_sch, "D": D, "d_opt": d_opt, "d_sch": d_sch, "amp": amp}
+    load_epoch = load(models, args["load_epoch"], root)
 
     max_iter_per_epoch = args['max_iter_per_epoch']
     if max_iter_per_epoch < 1:
         max_iter_per_epoch = len(dataloader.dataset)
+    epoch_iters = min(len(dataloader), max_iter_per_epoch)
+    tot_iter = (load_epoch + 1) * epoch_iters
+    start_epoch, start_iter = load_epoch + 1, 0
+    resume = load_resume(models, root, dataloader, load_epoch) if args["load_epoch"] == -1 else None
+    if resume is not None:
+        start_epoch, start_iter, tot_iter = resume
+    resume_interval = args.get('resume_interval', 0)
+    fused_critic = args.get('fused_critic', False)
+    # spectral normalized critics need no penalty unless gp_interval asks for one
+    gp_schedule = PenaltySchedule(args['gp_lambda'],
+                                  args.get('gp_interval', 0 if args.get('spectral_norm', False) else 1))
+    metrics = MetricAccumulator()
+    # the penalty is averaged over the critic steps that computed it, with gp_interval > 1 most of them skip it
+    penalties = MetricAccumulator()
     g_opt.step()
     d_opt.step()
-    for epoch in range(load_epoch + 1, args['epoch']):
-        g_sch.step()
-        d_sch.step()
-        for i, (synthesis, origin, shapes) in enumerate(dataloader):
+    for epoch in range(start_epoch, args['epoch']):
+        if resume is None or epoch != start_epoch:
+            # a resumed epoch was saved after its scheduler step
+            g_sch.step()
+            d_sch.step()
+        for i, (synthesis, origin, shapes) in enumerate(dataloader, start_iter if epoch == start_epoch else 0):
             if i >= max_iter_per_epoch:
                 break
             tot_iter += 1
             synthesis, origin, shapes = synthesis.cuda(), origin.cuda(), shapes.cuda()
             for _ in range(0, args['D_iter']):
                 d_opt.zero_grad()
-                # D_real
-                pvalidity = D(origin)
-                D_loss_real_val = -pvalidity.mean()
-                D_loss_real = D_loss_real_val
-                # D_fake
-                G_out = G(synthesis)
-                pvalidity = D(G_out)
-                D_loss_fake_val = pvalidity.mean()
-                D_loss_fake = D_loss_fake_val
-
-                # wgan-gp
-                gradient_penalty = calc_gradient_penalty(D, origin, G_out.detach(), origin.shape[0], args['gp_lambda'])
-
-                # D-cost
-                D_loss = D_loss_fake + D_loss_real + gradient_penalty
-                D_loss.backward()
-                d_opt.step()
+                penalty, gp_lambda = gp_schedule.next()
+                with amp.autocast():
+                    G_out = G(synthesis).float()
+                    if fused_critic:
+                        # real, fake and interpolates in one critic forward, see tools/critic.py
+                        pvalidity_real, pvalidity_fake, _, _, gradient_penalty = critic_pass(
+                            D, origin, G_out, None, gp_lambda, amp.scaler('D'), penalty=penalty)
+                    else:
+                        pvalidity_real = D(origin)
+                        pvalidity_fake = D(G_out.detach())
+                        gradient_penalty = torch.zeros([]).cuda()
+                        if penalty:
+                            # wgan-gp
+                            gradient_penalty = calc_gradient_penalty(D, origin, G_out.detach(), origin.shape[0],
+                                                                     gp_lambda, amp.scaler('D'))
+                    # D_real
+                    D_loss_real_val = -pvalidity_real.float().mean()
+                    D_loss_real = D_loss_real_val
+                    # D_fake
+                    D_loss_fake_val = pvalidity_fake.float().mean()
+                    D_loss_fake = D_loss_fake_val
+
+                    # D-cost
+                    D_loss = D_loss_fake + D_loss_real + gradient_penalty
+                if penalty:
+                    penalties.add(gradient_penalty=gradient_penalty)
+                amp.backward(D_loss, 'D')
+                amp.step(d_opt, 'D')
 
             g_opt.zero_grad()
-            # G
-            G_out = G(synthesis)
-            pvalidity = D(G_out)
-            l1_loss = (nn.L1Loss().cuda())(G_out, origin)
-            G_loss_val = -pvalidity.mean()
+            with amp.autocast():
+                # G
+                G_out = G(synthesis).float()
+                pvalidity = D(G_out)
+                l1_loss = (nn.L1Loss().cuda())(G_out, origin)
+                G_loss_val = -pvalidity.float().mean()
 
-            G_loss = G_loss_val + l1_loss * args['lambda_l1']
-            G_loss.backward()
+                G_loss = G_loss_val + l1_loss * args['lambda_l1']
+            amp.backward(G_loss, 'G')
 
-            g_opt.step()
+            amp.step(g_opt, 'G')
+            if resume_interval > 0 and tot_iter % resume_interval == 0 and i + 1 < epoch_iters:
+                save_resume(models, root, dataloader, epoch, i + 1, tot_iter)
 
+            metrics.add(D_loss=D_loss, D_loss_real=D_loss_real, D_loss_fake=D_loss_fake,
+                        D_loss_real_val=D_loss_real_val, D_loss_fake_val=D_loss_fake_val,
+                        G_loss=G_loss, G_loss_val=G_loss_val, l1=l1_loss)
             if tot_iter % args['show_interval'] == 0:
+                # averages since the last report, one transfer for all of them
+                losses = metrics.pop()
+                losses['gradient_penalty'] = penalties.pop().get('gradient_penalty', 0.0)
+                lr = g_sch.get_last_lr()[0]
                 to_log(
-                    'epoch: {}, batch: {}, D_loss: {:.5f}, D_loss_real: {:.5f}, D_loss_fake: {:.5f},' \
-                    'D_loss_real_val: {:.5f},  D_loss_fake_val: {:.5f},' \
-                    'G_loss: {:5f}, G_loss_val: {:.5f},' \
-                    'l1: {:5f}, gradient_penalty: {:5f}, lr: {:.5f}'.format(
-                        epoch, i, D_loss.item(), D_loss_real.item(), D_loss_fake.item(), D_loss_real_val.item(),
-                        D_loss_fake_val.item(), G_loss.item(),
-                        G_loss_val.item(), l1_loss.item(), gradient_penalty.item(),
-                        g_sch.get_last_lr()[0]))
-                writer.add_scalar("loss/D_loss", D_loss.item(), tot_iter)
-                writer.add_scalar("loss/D_loss_real", D_loss_real.item(), tot_iter)
-                writer.add_scalar("loss/D_loss_fake", D_loss_fake.item(), tot_iter)
-                writer.add_scalar("loss/D_loss_real_val", D_loss_real_val.item(), tot_iter)
-                writer.add_scalar("loss/D_loss_fake_val", D_loss_fake_val.item(), tot_iter)
-                writer.add_scalar("loss/G_loss", G_loss.item(), tot_iter)
-                writer.add_scalar("loss/G_loss_val", G_loss_val.item(), tot_iter)
-                writer.add_scalar("loss/l1", l1_loss.item(), tot_iter)
-                writer.add_scalar("loss/gradient_penalty", gradient_penalty.item(), tot_iter)
-                writer.add_scalar("lr", g_sch.get_last_lr()[0], tot_iter)
+                    'epoch: {}, batch: {}, D_loss: {D_loss:.5f}, D_loss_real: {D_loss_real:.5f}, ' \
+                    'D_loss_fake: {D_loss_fake:.5f},D_loss_real_val: {D_loss_real_val:.5f},  ' \
+                    'D_loss_fake_val: {D_loss_fake_val:.5f},G_loss: {G_loss:5f}, G_loss_val: {G_loss_val:.5f},' \
+                    'l1: {l1:5f}, gradient_penalty: {gradient_penalty:5f}, lr: {lr:.5f}'.format(
+                        epoch, i, lr=lr, **losses))
+                log_writer.scalars(losses, tot_iter, prefix="loss/")
+                log_writer.scalars({"lr": lr}, tot_iter)
 
         if epoch % args["snapshot_interval"] == 0:
             torch.save(G.state_dict(), os.path.join(root, "logs/G_epoch-{}.pth".format(epoch)))
@@ -207,6 +245,7 @@ def train(args, root):
             torch.save(d_opt.state_dict(), os.path.join(root, "logs/d_opt_epoch-{}.pth".format(epoch)))
             torch.save(g_sch.state_dict(), os.path.join(root, "logs/g_sch_epoch-{}.pth".format(epoch)))
             torch.save(d_sch.state_dict(), os.path.join(root, "logs/d_sch_epoch-{}.pth".format(epoch)))
+            torch.save(amp.state_dict(), os.path.join(root, "logs/amp_epoch-{}.pth".format(epoch)))
         if epoch % args['test_interval'] == 0:
             # label = torch.tensor([5]).expand([64]).cuda()
             # input_test[:, 1, :, :] = label.reshape(64, 1, 1).expand(64, image_size, image_size)
@@ -219,9 +258,10 @@ def train(args, root):
             G_out = G_out / 2 + 0.5
             G_out = G_out.clamp(0, 1)
             save_image(G_out, os.path.join(root, "logs/output-{}.png".format(epoch)))
-            writer.add_image('image{}/mask'.format(epoch), origin, tot_iter, dataformats='HWC')
-            writer.add_image('image{}/fake'.format(epoch), image, tot_iter,
+            log_writer.image('image{}/mask'.format(epoch), origin, tot_iter, dataformats='HWC')
+            log_writer.image('image{}/fake'.format(epoch), image, tot_iter,
                              dataformats='HWC')
+    log_writer.close()
 
 
 if __name__ == "__main__":
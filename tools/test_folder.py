@@ -8,12 +8,18 @@ from loss.SSIM_Loss import MSSSIM
 import torch
 import torch.nn as nn
 from torchvision import transforms
+from dataset.decode import BACKENDS, open_image, resolve_backend, decode_stats
 
 if __name__ == "__main__":
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
     parser.add_argument('path', type=str, nargs=1)
+    parser.add_argument('--decode-backend', type=str, default='pil', choices=BACKENDS + ['auto'])
+    # decode the original jpeg at 1/2, 1/4 or 1/8 scale before the resize to 64x64, slightly changes the metrics
+    parser.add_argument('--reduced-decode', default=False, action='store_true')
     args = parser.parse_args()
     path = args.path[0]
+    backend = resolve_backend(args.decode_backend)
+    origin_size = (64, 64) if args.reduced_decode else None
     origin_path = os.path.join("../data/COCO/val_image")
     msssim = MSSSIM()
     psnr = PNSR()
@@ -31,8 +37,9 @@ if __name__ == "__main__":
         for i in tqdm(range(len(names))):
             origin_id = names[i]
             image_name = "img" + str(i).zfill(6) + ".png"
-            image = Image.open(os.path.join(path, image_name))
-            origin_image = Image.open(os.path.join(origin_path, origin_id + ".jpg")).resize(size=(64, 64))
+            image = open_image(os.path.join(path, image_name), backend)
+            origin_image = open_image(os.path.join(origin_path, origin_id + ".jpg"), backend,
+                                      origin_size).resize(size=(64, 64))
 
             image = transforms.ToTensor()(image).unsqueeze(0)
             origin_image = transforms.ToTensor()(origin_image).unsqueeze(0)
@@ -50,8 +57,9 @@ if __name__ == "__main__":
                 file = files[i]
                 origin_id = file.split('.')[0]
 
-                image = Image.open(os.path.join(root, file))
-                origin_image = Image.open(os.path.join(origin_path, origin_id + ".jpg")).resize(size=(64, 64))
+                image = open_image(os.path.join(root, file), backend)
+                origin_image = open_image(os.path.join(origin_path, origin_id + ".jpg"), backend,
+                                          origin_size).resize(size=(64, 64))
                 image = transforms.ToTensor()(image).unsqueeze(0)
                 origin_image = transforms.ToTensor()(origin_image).unsqueeze(0)
                 if origin_image.shape[1] == 1:
@@ -62,3 +70,5 @@ if __name__ == "__main__":
                 l += l1(origin_image, image)
 
     print(p / data_sum, m / data_sum, l / data_sum)
+    for name, (count, seconds, speed) in decode_stats().items():
+        print("decode {}: {} images, {:.1f} images/s".format(name, count, speed))
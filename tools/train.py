@@ -16,16 +16,24 @@ import yaml
 import os
 import argparse
 from tools.coco_cut import classes as coco_classes
+from tools.resume import save_resume, load_resume
+from tools.amp import Amp, input_gradients
+from tools.critic import critic_pass, PenaltySchedule
+from tools.metrics import MetricAccumulator, LogWriter
+from tools.dist import init_distributed, is_main, main_first, broadcast_model, all_reduce_grads, cleanup
+from nets.spade import sync_spade_batchnorm
 from tools.network import define_G, define_D, GANLoss, get_scheduler, update_learning_rate, NLayerDiscriminator
 
-log_file = None
+log_writer = None
 
 
 def to_log(s, output=True):
-    global log_file
+    global log_writer
+    if not is_main():
+        return
     if output:
         print(s)
-    print(s, file=log_file)
+    log_writer.text(s)
 
 
 def open_config(root):
@@ -48,7 +56,11 @@ def load(models, epoch, root):
     if epoch is None:
         return -1
     for name, model in models.items():
-        ckpt = torch.load(os.path.join(root, "logs/" + name + "_epoch-{}.pth".format(epoch)))
+        ckpt_path = os.path.join(root, "logs/" + name + "_epoch-{}.pth".format(epoch))
+        if name == "amp" and not os.path.exists(ckpt_path):
+            # snapshots from before the scaler state was saved
+            continue
+        ckpt = torch.load(ckpt_path, map_location='cpu')
         ckpt = {k: v for k, v in ckpt.items()}
         model.load_state_dict(ckpt)
         to_log("load model: {} from epoch: {}".format(name, epoch))
@@ -56,21 +68,18 @@ def load(models, epoch, root):
     return epoch
 
 
-def calc_gradient_penalty(netD, real_data, label, fake_data, batch_size, gp_lambda):
+def calc_gradient_penalty(netD, real_data, label, fake_data, batch_size, gp_lambda, scaler=None):
     alpha = torch.rand(batch_size, 1, 1, 1)
     alpha = alpha.expand(real_data.shape).contiguous()
-    alpha = alpha.cuda()
+    alpha = alpha.to(real_data.device)
 
     interpolates = alpha * real_data + ((1 - alpha) * fake_data)
 
-    interpolates = interpolates.cuda()
     interpolates.requires_grad = True
 
-    disc_interpolates = netD(torch.cat([label, interpolates], 1))[0]
+    disc_interpolates = netD(torch.cat([label, interpolates], 1), with_label=False)[0]
 
-    gradients = autograd.grad(outputs=disc_interpolates, inputs=interpolates,
-                              grad_outputs=torch.ones(disc_interpolates.size()).cuda(),
-                              create_graph=True, retain_graph=True, only_inputs=True)[0]
+    gradients = input_gradients(disc_interpolates, interpolates, scaler)
     gradients = gradients.view(gradients.shape[0], -1)
 
     gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean() * gp_lambda
@@ -93,116 +102,171 @@ def imagetensor2np(x):
     return x
 
 
-def make_noise(bs, noise_dim):
+def make_noise(bs, noise_dim, device):
     if noise_dim == 0:
         return None
-    noise = torch.randn([bs, noise_dim]).cuda()
+    noise = torch.randn([bs, noise_dim]).to(device)
     return noise
 
 
 def train(args, root):
-    global log_file
-    if not os.path.exists(os.path.join(root, "logs")):
-        os.mkdir(os.path.join(root, "logs"))
-    if not os.path.exists(os.path.join(root, "logs/result/")):
-        os.mkdir(os.path.join(root, "logs/result/"))
-    if not os.path.exists(os.path.join(root, "logs/result/event")):
-        os.mkdir(os.path.join(root, "logs/result/event"))
-    log_file = open(os.path.join(root, "logs/log.txt"), "w")
+    global log_writer
+    # a single process unless started by torchrun, see tools/dist.py
+    dist_config = args.get('distributed', None) or {}
+    rank, world_size, device = init_distributed(dist_config)
+    if is_main():
+        if not os.path.exists(os.path.join(root, "logs")):
+            os.mkdir(os.path.join(root, "logs"))
+        if not os.path.exists(os.path.join(root, "logs/result/")):
+            os.mkdir(os.path.join(root, "logs/result/"))
+        if not os.path.exists(os.path.join(root, "logs/result/event")):
+            os.mkdir(os.path.join(root, "logs/result/event"))
+        # log.txt and the events are written by a thread of their own, see tools/metrics.py
+        log_writer = LogWriter(open(os.path.join(root, "logs/log.txt"), "w"),
+                               SummaryWriter(os.path.join(root, "logs/result/event/")))
     to_log(args)
-    writer = SummaryWriter(os.path.join(root, "logs/result/event/"))
 
     if args['classes'] == 'NONE':
         args['classes'] = list(coco_classes.keys())
     classes_num = len(args['classes'])
     noise_dim = args['noise_dim'] if classes_num > 1 else 0
 
-    dataloader = build_data(args['data_tag'], args['data_path'], args["bs"], True, num_worker=args["num_workers"],
-                            classes=args['classes'], image_size=args['image_size'])
+    # rank 0 builds missing data indexes before the others read them
+    with main_first():
+        dataloader = build_data(args['data_tag'], args['data_path'], args["bs"], True, num_worker=args["num_workers"],
+                                classes=args['classes'], image_size=args['image_size'],
+                                packed=args.get('packed', False), batch_transform=args.get('batch_transform', False),
+                                sampler=args.get('sampler', None), shards=args.get('shards', False),
+                                loader=args.get('loader', None), decode_backend=args.get('decode_backend', 'pil'),
+                                rank=rank, world_size=world_size)
     G = get_G("unet", in_channels=1, out_channels=3, scale=6, noise_dim=noise_dim,
-              image_size=args['image_size'], classes_num=classes_num + 1).cuda()
-    D = get_D("dnn", classes=classes_num + 1).cuda()
+              image_size=args['image_size'], classes_num=classes_num + 1)
+    if dist_config.get('sync_bn', False):
+        if device.type == 'cuda':
+            to_log("SyncBatchNorm in {} SPADE blocks".format(sync_spade_batchnorm(G)))
+        else:
+            to_log("SyncBatchNorm needs cuda, the SPADE blocks keep BatchNorm2d")
+    G = G.to(device)
+    D = get_D("dnn", classes=classes_num + 1, spectral_norm=args.get('spectral_norm', False)).to(device)
 
     g_opt = torch.optim.Adam(G.parameters(), lr=args["lr"], betas=(0.5, 0.9))
     d_opt = torch.optim.Adam(D.parameters(), lr=args["lr"], betas=(0.5, 0.9))
     g_sch = torch.optim.lr_scheduler.MultiStepLR(g_opt, args["lr_milestone"], gamma=0.5)
     d_sch = torch.optim.lr_scheduler.MultiStepLR(d_opt, args["lr_milestone"], gamma=0.5)
 
-    load_epoch = load({"G": G, "D": D, "g_opt": g_opt, "d_opt": d_opt, "g_sch": g_sch, "d_sch": d_sch},
-                      args["load_epoch"], root)
+    amp = Amp(args.get('amp', False))
+    models = {"G": G, "D": D, "g_opt": g_opt, "d_opt": d_opt, "g_sch": g_sch, "d_sch": d_sch, "amp": amp}
+    load_epoch = load(models, args["load_epoch"], root)
     tot_iter = (load_epoch + 1) * len(dataloader)
+    start_epoch, start_iter = load_epoch + 1, 0
+    resume = load_resume(models, root, dataloader, load_epoch) if args["load_epoch"] == -1 else None
+    if resume is not None:
+        start_epoch, start_iter, tot_iter = resume
+    # every process starts from the weights of rank 0
+    broadcast_model(G)
+    broadcast_model(D)
+    resume_interval = args.get('resume_interval', 0)
+    fused_critic = args.get('fused_critic', False)
+    # spectral normalized critics need no penalty unless gp_interval asks for one
+    gp_schedule = PenaltySchedule(args['gp_lambda'],
+                                  args.get('gp_interval', 0 if args.get('spectral_norm', False) else 1))
+    # the class head only feeds the label losses, there are none with a single class
+    with_label = classes_num > 1
+    metrics = MetricAccumulator()
+    # the penalty is averaged over the critic steps that computed it, with gp_interval > 1 most of them skip it
+    penalties = MetricAccumulator()
 
     g_opt.step()
     d_opt.step()
-    for epoch in range(load_epoch + 1, args['epoch']):
-        g_sch.step()
-        d_sch.step()
-        for i, (image, mask, M, real_labels) in enumerate(dataloader):
+    for epoch in range(start_epoch, args['epoch']):
+        if resume is None or epoch != start_epoch:
+            # a resumed epoch was saved after its scheduler step
+            g_sch.step()
+            d_sch.step()
+        for i, (image, mask, M, real_labels) in enumerate(dataloader, start_iter if epoch == start_epoch else 0):
             tot_iter += 1
-            image, mask, M, real_labels = image.cuda(), mask.cuda(), M.cuda(), real_labels.cuda()
-            fake_labels = classes_num * torch.ones(mask.shape[0:1], dtype=torch.long).cuda()
+            image, mask, M, real_labels = image.to(device), mask.to(device), M.to(device), real_labels.to(device)
+            fake_labels = classes_num * torch.ones(mask.shape[0:1], dtype=torch.long).to(device)
             for _ in range(0, args['D_iter']):
                 d_opt.zero_grad()
-                # D_real
-                pvalidity, plabels = D(torch.cat([mask, image], 1))
-                D_loss_real_val = -pvalidity.mean()
-                D_loss_real_label = (nn.NLLLoss().cuda())(plabels, real_labels) if classes_num > 1 else torch.tensor(0)
-                D_loss_real = D_loss_real_val + D_loss_real_label
-                # D_fake
-                noise = make_noise(mask.shape[0], noise_dim)
-                G_out = G(mask, noise, real_labels)
-                pvalidity, plabels = D(torch.cat([mask, G_out.detach()], 1))
-                D_loss_fake_val = pvalidity.mean()
-                D_loss_fake_label = (nn.NLLLoss().cuda())(plabels, fake_labels) if classes_num > 1 else torch.tensor(0)
-                D_loss_fake = D_loss_fake_val# + D_loss_fake_label
-
-                # wgan-gp
-                gradient_penalty = calc_gradient_penalty(D, image, mask, G_out.detach(), mask.shape[0],
-                                                         args['gp_lambda'])
-
-                # D-cost
-                D_loss = D_loss_fake + D_loss_real + gradient_penalty
-                D_loss.backward()
-                d_opt.step()
+                penalty, gp_lambda = gp_schedule.next()
+                with amp.autocast():
+                    noise = make_noise(mask.shape[0], noise_dim, device)
+                    G_out = G(mask, noise, real_labels).float()
+                    if fused_critic:
+                        # real, fake and interpolates in one critic forward, see tools/critic.py
+                        pvalidity_real, pvalidity_fake, plabels_real, plabels_fake, gradient_penalty = critic_pass(
+                            D, image, G_out, mask, gp_lambda, amp.scaler('D'), with_label=with_label, penalty=penalty)
+                    else:
+                        pvalidity_real, plabels_real = D(torch.cat([mask, image], 1), with_label=with_label)
+                        pvalidity_fake, plabels_fake = D(torch.cat([mask, G_out.detach()], 1), with_label=with_label)
+                        gradient_penalty = torch.zeros([]).to(device)
+                        if penalty:
+                            # wgan-gp
+                            gradient_penalty = calc_gradient_penalty(D, image, mask, G_out.detach(), mask.shape[0],
+                                                                     gp_lambda, amp.scaler('D'))
+                    # D_real
+                    D_loss_real_val = -pvalidity_real.float().mean()
+                    D_loss_real_label = (nn.NLLLoss().to(device))(plabels_real.float(), real_labels) if with_label \
+                        else torch.zeros([], device=device)
+                    D_loss_real = D_loss_real_val + D_loss_real_label
+                    # D_fake
+                    D_loss_fake_val = pvalidity_fake.float().mean()
+                    D_loss_fake_label = (nn.NLLLoss().to(device))(plabels_fake.float(), fake_labels) if with_label \
+                        else torch.zeros([], device=device)
+                    D_loss_fake = D_loss_fake_val# + D_loss_fake_label
+
+                    # D-cost
+                    D_loss = D_loss_fake + D_loss_real + gradient_penalty
+                if penalty:
+                    penalties.add(gradient_penalty=gradient_penalty)
+                amp.backward(D_loss, 'D')
+                all_reduce_grads(D)
+                amp.step(d_opt, 'D')
 
             g_opt.zero_grad()
-            # G
-            noise = make_noise(mask.shape[0], noise_dim)
-            G_out = G(mask, noise, real_labels)
-            pvalidity, plabels = D(torch.cat([mask, G_out], 1))
-            l1_loss = (nn.L1Loss().cuda())(G_out, image)
-            G_loss_val = -pvalidity.mean()
-            G_loss_label = (nn.NLLLoss().cuda())(plabels, real_labels) if classes_num > 1 else torch.tensor(0)
-
-            G_loss = G_loss_val + l1_loss * args['lambda_l1'] + G_loss_label
-            G_loss.backward()
-
-            g_opt.step()
-
+            with amp.autocast():
+                # G
+                noise = make_noise(mask.shape[0], noise_dim, device)
+                G_out = G(mask, noise, real_labels).float()
+                pvalidity, plabels = D(torch.cat([mask, G_out], 1), with_label=with_label)
+                l1_loss = (nn.L1Loss().to(device))(G_out, image)
+                G_loss_val = -pvalidity.float().mean()
+                G_loss_label = (nn.NLLLoss().to(device))(plabels.float(), real_labels) if classes_num > 1 \
+                    else torch.zeros([], device=device)
+
+                G_loss = G_loss_val + l1_loss * args['lambda_l1'] + G_loss_label
+            amp.backward(G_loss, 'G')
+            all_reduce_grads(G)
+
+            amp.step(g_opt, 'G')
+            if not is_main():
+                continue
+            if resume_interval > 0 and tot_iter % resume_interval == 0 and i + 1 < len(dataloader):
+                save_resume(models, root, dataloader, epoch, i + 1, tot_iter)
+
+            metrics.add(D_loss=D_loss, D_loss_real=D_loss_real, D_loss_fake=D_loss_fake,
+                        D_loss_real_val=D_loss_real_val, D_loss_real_label=D_loss_real_label,
+                        D_loss_fake_val=D_loss_fake_val, D_loss_fake_label=D_loss_fake_label,
+                        G_loss=G_loss, G_loss_val=G_loss_val, G_loss_label=G_loss_label,
+                        l1=l1_loss)
             if tot_iter % args['show_interval'] == 0:
+                # averages since the last report, one transfer for all of them
+                losses = metrics.pop()
+                losses['gradient_penalty'] = penalties.pop().get('gradient_penalty', 0.0)
+                lr = g_sch.get_last_lr()[0]
                 to_log(
-                    'epoch: {}, batch: {}, D_loss: {:.5f}, D_loss_real: {:.5f}, D_loss_fake: {:.5f},' \
-                    'D_loss_real_val: {:.5f}, D_loss_real_label: {:.5f}, D_loss_fake_val: {:.5f},' \
-                    'D_loss_fake_label: {:.5f} , G_loss: {:5f}, G_loss_val: {:.5f}, G_loss_label: {:.5f},' \
-                    'l1: {:5f}, gradient_penalty: {:5f}, lr: {:.5f}'.format(
-                        epoch, i, D_loss.item(), D_loss_real.item(), D_loss_fake.item(), D_loss_real_val.item(),
-                        D_loss_real_label.item(), D_loss_fake_val.item(), D_loss_fake_label.item(), G_loss.item(),
-                        G_loss_val.item(), G_loss_label.item(), l1_loss.item(), gradient_penalty.item(),
-                        g_sch.get_last_lr()[0]))
-                writer.add_scalar("loss/D_loss", D_loss.item(), tot_iter)
-                writer.add_scalar("loss/D_loss_real", D_loss_real.item(), tot_iter)
-                writer.add_scalar("loss/D_loss_fake", D_loss_fake.item(), tot_iter)
-                writer.add_scalar("loss/D_loss_real_val", D_loss_real_val.item(), tot_iter)
-                writer.add_scalar("loss/D_loss_real_label", D_loss_real_label.item(), tot_iter)
-                writer.add_scalar("loss/D_loss_fake_val", D_loss_fake_val.item(), tot_iter)
-                writer.add_scalar("loss/D_loss_fake_label", D_loss_fake_label.item(), tot_iter)
-                writer.add_scalar("loss/G_loss", G_loss.item(), tot_iter)
-                writer.add_scalar("loss/G_loss_val", G_loss_val.item(), tot_iter)
-                writer.add_scalar("loss/G_loss_label", G_loss_label.item(), tot_iter)
-                writer.add_scalar("loss/l1", l1_loss.item(), tot_iter)
-                writer.add_scalar("loss/gradient_penalty", gradient_penalty.item(), tot_iter)
-                writer.add_scalar("lr", g_sch.get_last_lr()[0], tot_iter)
-
+                    'epoch: {}, batch: {}, D_loss: {D_loss:.5f}, D_loss_real: {D_loss_real:.5f}, ' \
+                    'D_loss_fake: {D_loss_fake:.5f},D_loss_real_val: {D_loss_real_val:.5f}, ' \
+                    'D_loss_real_label: {D_loss_real_label:.5f}, D_loss_fake_val: {D_loss_fake_val:.5f},' \
+                    'D_loss_fake_label: {D_loss_fake_label:.5f} , G_loss: {G_loss:5f}, G_loss_val: {G_loss_val:.5f}, ' \
+                    'G_loss_label: {G_loss_label:.5f},l1: {l1:5f}, gradient_penalty: {gradient_penalty:5f}, ' \
+                    'lr: {lr:.5f}'.format(epoch, i, lr=lr, **losses))
+                log_writer.scalars(losses, tot_iter, prefix="loss/")
+                log_writer.scalars({"lr": lr}, tot_iter)
+
+        if not is_main():
+            continue
         if epoch % args["snapshot_interval"] == 0:
             torch.save(G.state_dict(), os.path.join(root, "logs/G_epoch-{}.pth".format(epoch)))
             torch.save(D.state_dict(), os.path.join(root, "logs/D_epoch-{}.pth".format(epoch)))
@@ -210,6 +274,7 @@ def train(args, root):
             torch.save(d_opt.state_dict(), os.path.join(root, "logs/d_opt_epoch-{}.pth".format(epoch)))
             torch.save(g_sch.state_dict(), os.path.join(root, "logs/g_sch_epoch-{}.pth".format(epoch)))
             torch.save(d_sch.state_dict(), os.path.join(root, "logs/d_sch_epoch-{}.pth".format(epoch)))
+            torch.save(amp.state_dict(), os.path.join(root, "logs/amp_epoch-{}.pth".format(epoch)))
         if epoch % args['test_interval'] == 0:
             # label = torch.tensor([5]).expand([64]).cuda()
             # input_test[:, 1, :, :] = label.reshape(64, 1, 1).expand(64, image_size, image_size)
@@ -222,9 +287,12 @@ def train(args, root):
             G_out = G_out / 2 + 0.5
             G_out = G_out.clamp(0, 1)
             save_image(G_out, os.path.join(root, "logs/output-{}.png".format(epoch)))
-            writer.add_image('image{}/mask'.format(epoch), mask, tot_iter, dataformats='HWC')
-            writer.add_image('image{}/fake'.format(epoch), cv2.cvtColor(image, cv2.COLOR_BGR2RGB), tot_iter,
+            log_writer.image('image{}/mask'.format(epoch), mask, tot_iter, dataformats='HWC')
+            log_writer.image('image{}/fake'.format(epoch), cv2.cvtColor(image, cv2.COLOR_BGR2RGB), tot_iter,
                              dataformats='HWC')
+    if is_main():
+        log_writer.close()
+    cleanup()
 
 
 if __name__ == "__main__":